@@ -7,6 +7,7 @@ from tqdm import tqdm
 
 from vfa.utils import collate, to_numpy
 from vfa.model.vfanet import VFANet
+from vfa.model.coverage import CoverageMask
 from vfa.data.encoder import ObjectEncoder
 from vfa.data.dataset import frameDataset
 from vfa.data.multiviewX import MultiviewX
@@ -49,7 +50,53 @@ def parse(opts):
 
     parser.add_argument('--config', type=Wildtrack_Config, default=opts) # MultiviewC_Config, MultiviewX_Config, Wildtrack_Config
 
+    parser.add_argument('--sparse_vfa', action='store_true',
+                        help='only sample the voxels that each camera can see in VFA')
+
+    parser.add_argument('--vfa_sampler', type=str, default='grid_sample',
+                        help='how VFA samples the box features, `grid_sample`, `native`, `torch` or `gather`,\
+                              the last one is approximate, see vfa/model/box_sum.py')
+
+    parser.add_argument('--vfa_max_tile_mb', type=float, default=None,
+                        help='memory budget of VFA in MB, the grid is aggregated in tiles under the budget')
+
+    parser.add_argument('--vfa_route_target', type=float, default=None,
+                        help='route each voxel to the one or two scales whose box area is close to the \
+                              target in pixels, the sampling only shrinks with --sparse_vfa')
+
+    parser.add_argument('--sparse_heads', action='store_true',
+                        help='only evaluate the regression heads at the top k peaks of the heatmap, \
+                              which excludes --coverage, --field_polygon and --coarse_factor')
+
+    parser.add_argument('--roi_crop', action='store_true',
+                        help='crop the images to the region covered by the projected voxels before the backbone,\
+                              in every mode that batches the cameras')
+
+    parser.add_argument('--coverage', action='store_true',
+                        help='only predict the cells seen by at least one camera. It takes precedence over\
+                              --coarse_factor, which then refines the covered cells, and the cameras are\
+                              always batched, see VFANet.forward')
+
+    parser.add_argument('--field_polygon', type=str, default=None,
+                        help='text file of the (x, y) vertices of the field in grid coordinates, one per line, \
+                              only predict the cells inside of it')
+
+    parser.add_argument('--coarse_factor', type=int, default=None,
+                        help='first detect on a grid with coarse_factor times bigger cubes, and then refine \
+                              the tiles around the coarse peaks at full resolution. The cameras are\
+                              always batched, see VFANet.forward')
+
+    parser.add_argument('--coarse_thresh', type=float, default=0.1,
+                        help='the coarse cells above the threshold are refined at full resolution')
+
+    parser.add_argument('--compile_vfa', action='store_true',
+                        help='run VFA of the fixed cameras as sparse matrices, saved next to the checkpoint and\
+                              rebuilt if they belong to another rig. They take several hundred MB of memory and\
+                              disk for the 7 cameras and the 156 x 156 grid of MultiviewC')
+
     args = parser.parse_args()
+    assert not args.sparse_heads or (not args.coverage and args.field_polygon is None and args.coarse_factor is None), \
+        '--sparse_heads excludes --coverage, --field_polygon and --coarse_factor'
     print('Settings:')
     print(vars(args))
     return args
@@ -62,7 +109,9 @@ def resume(resume_dir, device):
     model = VFANet(args=ck_args,
                     grid_height=ck_args.grid_h, 
                     cube_size=ck_args.cube_size,
-                    mode=ck_args.mode).to(device)
+                    mode=ck_args.mode,
+                    angle_mode=getattr(ck_args, 'angle_mode', 'csl'),
+                    angle_bins=getattr(ck_args, 'angle_bins', 8)).to(device)
     pretrain = checkpoints['model_state_dict']
     current = model.state_dict()
     state_dict = {k: v for k, v in pretrain.items() if k in current.keys()}
@@ -73,13 +122,10 @@ def resume(resume_dir, device):
 
 
 def construct_location(objects):
-    locaitons = list()
-    for i, obj in enumerate(objects):
-        tmp = np.zeros(shape=(1, 3))
-        tmp[:, 0] = i
-        tmp[:, :2] = to_numpy(obj.location)[:2]
-        locaitons.append(tmp)
-    return np.concatenate(locaitons, axis=0)
+    # (n, 3) of x, y, 0 of the ObjectBatch
+    locaitons = np.zeros(shape=(len(objects), 3))
+    locaitons[:, :2] = to_numpy(objects.location).reshape(-1, 3)[:, :2]
+    return locaitons
 
 class FormatAPAOSData():
     def __init__(self, save_dir, mode='pred') -> None:
@@ -91,24 +137,15 @@ class FormatAPAOSData():
     def add_item(self, batch, id):
         id = np.array(id).reshape(-1)
         # construct stored data with format: frame_id, x, y, z, l, w, h, rotation, conf
-        for obj in batch:
-            dimension = to_numpy(obj.dimension)[::-1]
-            location = to_numpy(obj.location)
-            rotation = to_numpy(obj.rotation).reshape(-1)
-            if self.mode == 'pred':
-                conf = to_numpy(obj.conf).reshape(-1)
-            if self.data is None:
-                if self.mode == 'pred':
-                    self.data = np.concatenate([id, location, dimension, rotation, conf], axis=0).reshape(1, -1)
-                else:
-                    self.data = np.concatenate([id, location, dimension, rotation], axis=0).reshape(1, -1)
-            else:
-                if self.mode == 'pred':
-                    tmp = np.concatenate([id, location, dimension, rotation, conf], axis=0).reshape(1, -1)
-                    self.data = np.vstack([self.data, tmp])
-                else:
-                    tmp = np.concatenate([id, location, dimension, rotation], axis=0).reshape(1, -1)
-                    self.data = np.vstack([self.data, tmp])
+        # batch: the ObjectBatch of the frame, whose columns are stored at once
+        dimension = to_numpy(batch.dimension).reshape(-1, 3)[:, ::-1]
+        location = to_numpy(batch.location).reshape(-1, 3)
+        rotation = to_numpy(batch.rotation).reshape(-1, 1)
+        columns = [np.repeat(id.reshape(1, -1), len(batch), axis=0), location, dimension, rotation]
+        if self.mode == 'pred':
+            columns.append(to_numpy(batch.conf).reshape(-1, 1))
+        tmp = np.concatenate(columns, axis=1)
+        self.data = tmp if self.data is None else np.vstack([self.data, tmp])
     def save(self):
         if not os.path.exists(os.path.dirname(self.save_dir)):
             os.mkdir(os.path.dirname(self.save_dir))
@@ -156,13 +193,27 @@ def main(opts):
     # Device: default 1 GPU
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')    
 
-    # Create encoder
-    encoder = ObjectEncoder(dataset)   
-
     # Resume
     resume_dir = os.path.join(args.savedir, args.resume, 'checkpoints', args.checkpoint)      
     model = resume(resume_dir, device)
 
+    # Create encoder, which decodes the orientation of the checkpoint
+    encoder = ObjectEncoder(dataset, angle_mode=model.angle_mode, angle_bins=model.angle_bins)   
+
+    max_tile_bytes = None if args.vfa_max_tile_mb is None else int(args.vfa_max_tile_mb * 2 ** 20)
+    model.configure_vfa(sparse=args.sparse_vfa, sampler=args.vfa_sampler, max_tile_bytes=max_tile_bytes,
+                        route_target=args.vfa_route_target)
+
+    model.coarse_factor, model.coarse_thresh = args.coarse_factor, args.coarse_thresh
+    model.roi_crop = args.roi_crop
+    model.head_topk = encoder.topk if args.sparse_heads else None
+    if args.coverage or args.field_polygon is not None:
+        polygon = None if args.field_polygon is None else np.loadtxt(args.field_polygon, ndmin=2)
+        model.set_coverage(CoverageMask(polygon))
+    compiled_vfa_dir = os.path.join(os.path.dirname(resume_dir), 'compiled_vfa.pth')
+    if args.compile_vfa and os.path.exists(compiled_vfa_dir):
+        model.load_compiled_vfa(compiled_vfa_dir)
+
     # define path
     ap_aos_dir_pred = r'.\experiments\{}\evaluation\ap_aos_pred.txt'.format(args.data)
     ap_aos_dir_gt = r'.\experiments\{}\evaluation\ap_aos_gt.txt'.format(args.data)
@@ -176,18 +227,24 @@ def main(opts):
 
     if not PR_pred.exist() or not PR_gt.exist() or not APAOS_pred.exist() or not APAOS_gt.exist():
         with tqdm(iterable=dataloader, desc=f'[EVALUATE] ', postfix=dict, mininterval=1) as pbar:
-            for batch_idx, (_, images, objects, _, calibs, grid) in enumerate(dataloader):
+            for batch_idx, (_, images, objects, _, calibs, grid, _) in enumerate(dataloader):
                 with torch.no_grad():
                     images, calibs, grid = images.to(device), calibs.to(device), grid.to(device)
+                    # the rig is fixed, thus the compiled VFA is checked on the first frame only
+                    if args.compile_vfa and batch_idx == 0 and not model.compiled_vfa_matches(calibs, grid, images.shape[-2:]):
+                        if model.compiled_vfa is not None:
+                            print('\033[31m{} is compiled for another rig, rebuild it\033[0m'.format(compiled_vfa_dir))
+                        model.compile_vfa(calibs, grid, images.shape[-2:])
+                        model.save_compiled_vfa(compiled_vfa_dir)
                     encoded_pred = model(images, calibs, grid)
-                    preds = encoder.batch_decode(encoded_pred, args.cls_thresh)
+                    preds = encoder.batch_decode(encoded_pred, args.cls_thresh).get_frame(0)
 
                     if args.eval_mode == '3D':
                         APAOS_pred.add_item(preds, batch_idx)
-                        APAOS_gt.add_item(objects[0], batch_idx)
+                        APAOS_gt.add_item(objects.get_frame(0), batch_idx)
 
                     PR_pred.add_item(preds, batch_idx)
-                    PR_gt.add_item(objects[0], batch_idx)
+                    PR_gt.add_item(objects.get_frame(0), batch_idx)
                    
                 pbar.update(1)
         # Save 
@@ -77,11 +77,16 @@ def main():
     model = resume(args.resume_dir, model)
 
     # Predict
-    _, images, objects, calibs, grid = next(iter(dataloader))
+    _, images, objects, heatmaps, calibs, grid, targets = next(iter(dataloader))
     images, calibs, grid = images.to(device), calibs.to(device), grid.to(device)
     
-    # Batch gt encode & visualize heatmap
-    encoded_gt = encoder.batch_encode(objects, grid)[0]
+    # Batch gt encode & visualize heatmap, the same as `Trainer.encode`
+    if targets is None:
+        # the heatmaps of None are rendered by the encoder
+        heatmaps = None if heatmaps is None else heatmaps.to(device)
+        encoded_gt = encoder.batch_encode(objects, heatmaps, grid)
+    else:
+        encoded_gt = {key: value.to(device) for key, value in targets.items()}
     gt_heatmap = (encoded_gt['heatmap'][0, 0].detach().cpu().numpy() * 255).astype(np.uint8)
     plt.subplot(121)
     plt.imshow(grid_rot180(gt_heatmap))
@@ -99,7 +104,7 @@ def main():
 
     # visualize bboxes
     for cam in range(dataset.num_cam):
-        fig = visualize_bboxes(images[cam], calibs[cam], objects[0], preds)
+        fig = visualize_bboxes(images[cam], calibs[cam], objects.get_frame(0), preds.get_frame(0))
         plt.show()
 
 if __name__ == '__main__':
@@ -87,13 +87,44 @@ def parse(opts):
     parser.add_argument('--angle_range', type=int, default=360,
                         help='the range of angle prediction for circle smooth label (CSL)')
 
+    parser.add_argument('--angle_mode', type=str, default='csl',
+                        help='orientation encoding, `csl`, circle smooth label over `angle_range` angles,\
+                              or `bin`, `angle_bins` angle bins with a sin/cos residual to the bin center')
+
+    parser.add_argument('--angle_bins', type=int, default=8,
+                        help='the number of angle bins of the `bin` orientation encoding')
+
     parser.add_argument('--pretrained', type=bool, default=True,
                         help='load the pretrained checkpoint of feature extractor eg. resnet18')  
                           
+    parser.add_argument('--vfa_sampler', type=str, default='grid_sample',
+                        help='how VFA samples the box features, `grid_sample`, `native` box sum op\
+                              with hand-written backward, its PyTorch fallback `torch`, or integer `gather`,\
+                              which is approximate: it averages the boxes rounded to whole feature pixels')
+
+    parser.add_argument('--target_format', type=str, default='dense',
+                        help='the regression targets, `dense`, maps of the grid, or `sparse`, only at the positive cells')
+
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='the number of DataLoader workers')
+
+    parser.add_argument('--encode_in_workers', action='store_true',
+                        help='encode the targets in the DataLoader workers instead of the training step')
+
+    parser.add_argument('--target_store', type=str, default=None,
+                        help='directory of the memory-mapped store of the encoded targets, keyed by the config hash.\
+                              It implies `--encode_in_workers`')
+
     parser.add_argument('--heatmap', type=str, default='GK',
                         help='the type of heatmap, `RGK`, rotated gaussian kernel heatmap,\
                               or `GK`, normal gaussian kernel')       
 
+    parser.add_argument('--heatmap_dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='the dtype of the saved heatmaps, which are memory-mapped and shared by the splits')
+
+    parser.add_argument('--render_heatmap', action='store_true',
+                        help='render the heatmaps with the encoder instead of building and loading the heatmap files')
+
     # Training options
     parser.add_argument('--seed', type=int, default=1, 
                         help='random seed')
@@ -133,6 +164,7 @@ def parse(opts):
                         help='Copy the whole repo before training')
 
     args = parser.parse_args()
+    args.encode_in_workers = args.encode_in_workers or args.target_store is not None
     print('Settings:')
     print(vars(args))
     return args
@@ -213,44 +245,43 @@ def train(opts):
     val_transform = transforms.Compose([transforms.Resize(args.resize_size),
                                           transforms.ToTensor()])
 
-    # Create datasets
+    # Create datasets, the splits share the labels and the memory-mapped heatmaps of one base dataset
     if opts.name == 'MultiviewC':
-        train_data = frameDataset(MultiviewC(root=args.root, heatmap_type=args.heatmap, 
-                                             ann_root=args.ann, calib_root=args.calib, 
-                                             world_size=args.world_size, cube_LWH=args.cube_size), 
-                                             transform=train_transform, split='train')
-        
-        val_data = frameDataset(MultiviewC(root=args.root, heatmap_type=args.heatmap, 
-                                           ann_root=args.ann, calib_root=args.calib, 
-                                           world_size=args.world_size, cube_LWH=args.cube_size),
-                                           transform=val_transform, split='val')
+        base = MultiviewC(root=args.root, heatmap_type=args.heatmap, ann_root=args.ann, calib_root=args.calib, 
+                          world_size=args.world_size, cube_LWH=args.cube_size, heatmap_dtype=args.heatmap_dtype,
+                          with_heatmaps=not args.render_heatmap)
     elif opts.name == 'MultiviewX':
-        train_data = frameDataset(MultiviewX(root=args.root, world_size=args.world_size, cube_LWH=args.cube_size), 
-                                             transform=train_transform, split='train')
-        
-        val_data = frameDataset(MultiviewX(root=args.root, world_size=args.world_size, cube_LWH=args.cube_size),
-                                           transform=val_transform, split='val')
-    
+        base = MultiviewX(root=args.root, world_size=args.world_size, cube_LWH=args.cube_size, 
+                          heatmap_dtype=args.heatmap_dtype, with_heatmaps=not args.render_heatmap)
     elif opts.name == 'Wildtrack':
-        train_data = frameDataset(Wildtrack(root=args.root, world_size=args.world_size, cube_LWH=args.cube_size), 
-                                             transform=train_transform, split='train')
-        
-        val_data = frameDataset(Wildtrack(root=args.root, world_size=args.world_size, cube_LWH=args.cube_size),
-                                           transform=val_transform, split='val')
+        base = Wildtrack(root=args.root, world_size=args.world_size, cube_LWH=args.cube_size, 
+                         heatmap_dtype=args.heatmap_dtype, with_heatmaps=not args.render_heatmap)
+    train_data = frameDataset(base, transform=train_transform, split='train')
+    val_data = frameDataset(base, transform=val_transform, split='val')
+
+    # Create encoder
+    encoder = ObjectEncoder(train_data, topk=args.topk, angle_range=args.angle_range, 
+                            angle_mode=args.angle_mode, angle_bins=args.angle_bins,
+                            target_format=args.target_format)
+    if args.encode_in_workers:
+        # the targets of each split are encoded by the DataLoader workers of the split
+        train_data.set_encoder(encoder, args.target_store)
+        val_data.set_encoder(ObjectEncoder(val_data, topk=args.topk, angle_range=args.angle_range, 
+                                           angle_mode=args.angle_mode, angle_bins=args.angle_bins,
+                                           target_format=args.target_format), args.target_store)
 
     # Create dataloader
-    train_loader = DataLoader(train_data, batch_size=args.batch_size, shuffle=True, num_workers=0, collate_fn=collate)
-    val_loader = DataLoader(val_data, batch_size=args.batch_size, shuffle=False, num_workers=0, collate_fn=collate)
+    train_loader = DataLoader(train_data, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, collate_fn=collate)
+    val_loader = DataLoader(val_data, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, collate_fn=collate)
 
     # Device: default 1 GPU
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     
     # Build model
     model = VFANet(args=args, grid_height=args.grid_h, cube_size=args.cube_size, angle_range=args.angle_range,
-                    mode=args.mode, pretrained=args.pretrained).to(device)
-
-    # Create encoder
-    encoder = ObjectEncoder(train_data, topk=args.topk)
+                    mode=args.mode, pretrained=args.pretrained, angle_mode=args.angle_mode, 
+                    angle_bins=args.angle_bins).to(device)
+    model.configure_vfa(sampler=args.vfa_sampler)
 
     # Create optimizer
     optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
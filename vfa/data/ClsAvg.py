@@ -1,5 +1,6 @@
 import json
 import numpy as np
+from vfa.data.cache import atomic_save
 
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -26,6 +27,14 @@ class ClassAverage(object):
         assert cls_ in self.dimension_map.keys()
         self.dimension_map[cls_]['total'] += dimension
         self.dimension_map[cls_]['count'] += 1
+
+    def add_items(self, cls, dimensions):
+        # dimensions: (n, 3) of the objects of `cls`
+        cls_ = cls.lower()
+        assert cls_ in self.dimension_map.keys()
+        dimensions = np.asarray(dimensions, dtype=np.float64).reshape(-1, 3)
+        self.dimension_map[cls_]['total'] += dimensions.sum(axis=0).astype(np.float32)
+        self.dimension_map[cls_]['count'] += len(dimensions)
     
     def get_mean(self, cls):
         cls_ = cls.lower()
@@ -36,8 +45,10 @@ class ClassAverage(object):
     def dump_to_file(self):
         for cls in self.dimension_map.keys():
             self.dimension_map[cls]['mean'] = self.get_mean(cls)
-        with open(self.save_path, 'w') as f:
-            json.dump(self.dimension_map, f, cls=NumpyEncoder, indent=4)
+        def save(path):
+            with open(path, 'w') as f:
+                json.dump(self.dimension_map, f, cls=NumpyEncoder, indent=4)
+        atomic_save(self.save_path, save)
     
     def load_from_file(self):
         with open(self.save_path, 'r') as f:
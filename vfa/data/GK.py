@@ -1,18 +1,36 @@
 import os
 import torch
 import numpy as np
+from collections import OrderedDict
 from scipy.stats import multivariate_normal
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
+from vfa.data.cache import atomic_save
 class RotationGaussianKernel(object):
     # rotated gaussian kernel
     def __init__(self, save_dir,
                  alpha=0.01,
-                 GKRatio=8):
+                 GKRatio=8,
+                 cache_size=4096,
+                 length_quantum=0.,
+                 angle_quantum=0.,
+                 dtype=np.float32):
+        """
+            dtype: the dtype of the saved heatmaps, np.float16 halves the file and the memory-mapped pages
+            cache_size: the number of rotated kernels kept in the LRU cache
+            length_quantum, angle_quantum: the box length, width (cm) and angle (degree) are rounded to the multiple
+                                           of the quanta before computing the kernel, thus near-identical boxes
+                                           share a cached kernel. 0: no rounding, the heatmaps are exact.
+                                           [NOTICE]: rounding may move the peak of a kernel by one cell
+        """
         self.save_dir = save_dir
         self.GKRatio = GKRatio
         self.alpha = alpha
         self.heatmaps = list()
+        self.cache_size = cache_size
+        self.length_quantum, self.angle_quantum = length_quantum, angle_quantum
+        self.kernel_cache = OrderedDict()
+        self.dtype = np.dtype(dtype)
 
     
     def gaussian_kernel_heatmap(self, heatmap, box_cx, box_cy, box_l, box_w, angle, alpha=0.01, gaussian_kernel_ratio=8):
@@ -26,7 +44,39 @@ class RotationGaussianKernel(object):
                 alpha: determine the gaussian kernel size of target in 128x128 heatmap, larger alpha, larger gaussian kernel will have.
                 gaussian_kernel_ratio: also determine the size of gaussian kernel. Below comment has more details.
         """
-        heatmap_dtype = heatmap.dtype
+        gaussian_kernel, (g_t, g_l) = self.rotated_kernel(box_l, box_w, angle, heatmap.dtype, alpha, gaussian_kernel_ratio)
+        g_r = gaussian_kernel.shape[1] - g_l
+        g_b = gaussian_kernel.shape[0] - g_t
+        # Padding operation can ensure the rotated gaussian kernel does not exceed the boundary of heatmap.
+        pad = (gaussian_kernel.shape[0] - 1) // 2
+        heatmap = np.pad(heatmap, pad_width=[[pad, pad],[pad, pad]], mode='constant', constant_values=0)
+        padded_cx = box_cx + pad 
+        padded_cy = box_cy + pad 
+        l = int(padded_cx) - g_l
+        r = int(padded_cx) + g_r
+        t = int(padded_cy) - g_t
+        b = int(padded_cy) + g_b
+        heatmap[t:b, l:r] = np.maximum(heatmap[t:b, l:r], gaussian_kernel)
+        heatmap = heatmap[pad:-pad, pad:-pad]
+
+        # Determine the unique center of gaussian kernel that also represents the valid and correct location of target.
+        heatmap[int(box_cy), int(box_cx)] = 1
+        return heatmap
+    
+    def rotated_kernel(self, box_l, box_w, angle, dtype, alpha=0.01, gaussian_kernel_ratio=8):
+        """
+            The rotated gaussian kernel of a box and its center (row, col), cached by the quantized box and angle.
+            The cached kernel is read-only.
+        """
+        def quantize(value, quantum):
+            return value if quantum == 0 else round(value / quantum) * quantum
+        box_l, box_w = quantize(float(box_l), self.length_quantum), quantize(float(box_w), self.length_quantum)
+        angle = quantize(float(angle), self.angle_quantum)
+        key = (box_l, box_w, angle, np.dtype(dtype).str, alpha, gaussian_kernel_ratio)
+        if key in self.kernel_cache:
+            self.kernel_cache.move_to_end(key)
+            return self.kernel_cache[key]
+
         std_w = box_w * alpha # y
         std_l = box_l * alpha # x
         var_w = std_w ** 2
@@ -34,37 +84,25 @@ class RotationGaussianKernel(object):
         # Create a gaussian kernel whose size depends on the maximum side of box's width and length
         # Also, this gaussian kernel is used to store the distribution of target. Because the target is almost 
         # rectangle in MultiviewC, the distribution of gaussian kernel will be elliptical.
-        kernel_size = np.int(np.ceil(np.maximum(std_w, std_l)) * gaussian_kernel_ratio)
+        kernel_size = int(np.ceil(np.maximum(std_w, std_l)) * gaussian_kernel_ratio)
 
-        xx, yy = np.meshgrid(np.arange(-kernel_size//2, kernel_size//2 + 1, dtype=heatmap_dtype), np.arange(-kernel_size//2, kernel_size//2 + 1, dtype=heatmap_dtype))
+        xx, yy = np.meshgrid(np.arange(-kernel_size//2, kernel_size//2 + 1, dtype=dtype), np.arange(-kernel_size//2, kernel_size//2 + 1, dtype=dtype))
             
         gaussian_kernel = np.exp( - (xx)**2 / (2. * var_l) - (yy)**2 / (2. * var_w))
         
         gaussian_kernel = self.bi_rotate(gaussian_kernel, angle)
+        gaussian_kernel.setflags(write=False)
         # In order to ensure that there is a unique center, firstly find the center of gaussian kernel. 
         # In order to ensure that there is a unique center, the center of the Gaussian kernel is used
         # as the origin for assignment. 
         gaussian_center = np.where(gaussian_kernel == gaussian_kernel.max())
-        g_l = gaussian_center[1].item() 
-        g_r = gaussian_kernel.shape[1] - gaussian_center[1].item()
-        g_t = gaussian_center[0].item() 
-        g_b = gaussian_kernel.shape[0] - gaussian_center[0].item()
-        # Padding operation can ensure the rotated gaussian kernel does not exceed the boundary of heatmap.
-        pad = kernel_size//2
-        heatmap = np.pad(heatmap, pad_width=[[pad, pad],[pad, pad]], mode='constant', constant_values=0)
-        padded_cx = box_cx + pad 
-        padded_cy = box_cy + pad 
-        l = int(padded_cx) - g_l
-        r = int(padded_cx) + g_r
-        t = int(padded_cy) - g_t
-        b = int(padded_cy) + g_b
-        heatmap[t:b, l:r] = np.maximum(heatmap[t:b, l:r], gaussian_kernel)
-        heatmap = heatmap[pad:-pad, pad:-pad]
+        value = (gaussian_kernel, (gaussian_center[0].item(), gaussian_center[1].item()))
+
+        self.kernel_cache[key] = value
+        if len(self.kernel_cache) > self.cache_size:
+            self.kernel_cache.popitem(last=False)
+        return value
 
-        # Determine the unique center of gaussian kernel that also represents the valid and correct location of target.
-        heatmap[int(box_cy), int(box_cx)] = 1
-        return heatmap
-    
     def bi_rotate(self, Array, angle, rotate_mode='Clockwise'):
         """
             Bilinear interpolation when rotating
@@ -93,53 +131,58 @@ class RotationGaussianKernel(object):
                             [0, -1, 0],
                             [0.5 * H, 0.5 * W, 1]])
 
-        new_data = np.zeros_like(Array,dtype=Array.dtype)
-
-        for i in range(H):
-            for j in range(W):
+        # The coordinates of all pixels at once, [i, j, 1] @ matrix1 @ matrix2 @ matrix3
+        i, j = np.meshgrid(np.arange(H), np.arange(W), indexing='ij')
+        new_coordinate = np.stack([i, j, np.ones_like(i)], axis=-1)
+        for matrix in [matrix1, matrix2, matrix3]:
+            new_coordinate = np.matmul(new_coordinate, matrix)
 
-                dot1 = np.matmul(np.array([i, j, 1]), matrix1)
-                dot2 = np.matmul(dot1, matrix2)
-                dot3 = np.matmul(dot2, matrix3)
+        new_i = np.floor(new_coordinate[..., 0]).astype(np.int64)
+        new_j = np.floor(new_coordinate[..., 1]).astype(np.int64)
 
-                new_coordinate = dot3
+        u = new_coordinate[..., 0] - new_i
+        v = new_coordinate[..., 1] - new_j
 
-                new_i = int(np.floor(new_coordinate[0]))
-                new_j = int(np.floor(new_coordinate[1]))
+        skip = (new_j>=W) | (new_i >=H) | (new_i<1) | (new_j<1) | ((i+1)>=H) | ((j+1)>=W)
+        nearest = ~skip & (((new_i + 1)>=H) | ((new_j+1)>=W))
+        bilinear = ~skip & ~nearest
 
-                u = new_coordinate[0] - new_i
-                v = new_coordinate[1] - new_j
+        # the neighbours of the skipped pixels are clipped into the array, they are not written anyway
+        i0, j0 = np.clip(new_i, 0, H - 1), np.clip(new_j, 0, W - 1)
+        i1, j1 = np.clip(new_i + 1, 0, H - 1), np.clip(new_j + 1, 0, W - 1)
+        interpolated = (1-u)*(1-v)*Array[i0,j0] + \
+                       (1-u)*v*Array[i0,j1] + \
+                       u*(1-v)*Array[i1,j0] +\
+                       u*v*Array[i1,j1]
 
-                if new_j>=W or new_i >=H or new_i<1 or new_j<1 or (i+1)>=H or (j+1)>=W:
-                    continue
-
-                if (new_i + 1)>=H or (new_j+1)>=W:
-                    new_data[i, j] = Array[new_i,new_j]
-
-                else:
-                    new_data[i, j] = (1-u)*(1-v)*Array[new_i,new_j] + \
-                                    (1-u)*v*Array[new_i,new_j+1] + \
-                                    u*(1-v)*Array[new_i+1,new_j] +\
-                                    u*v*Array[new_i+1,new_j+1]
+        new_data = np.zeros_like(Array,dtype=Array.dtype)
+        new_data[nearest] = Array[i0, j0][nearest]
+        new_data[bilinear] = interpolated[bilinear]
         return new_data
     
     def add_item(self, heatmap):
         self.heatmaps.append(heatmap)
 
     def RGKExist(self):
-        return os.path.exists(self.save_dir)
+        # the saved heatmaps of another dtype are rebuilt
+        return os.path.exists(self.save_dir) and np.load(self.save_dir, mmap_mode='r').dtype == self.dtype
     
-    def load_from_file(self):
+    def load_from_file(self, mmap_mode='c'):
+        """
+            mmap_mode: 'c' memory-maps the heatmaps copy-on-write, thus the pages are shared by the datasets 
+                       and the DataLoader workers, and are only read on access. None: load into memory
+        """
         try:
-            return np.load(self.save_dir)
+            return np.load(self.save_dir, mmap_mode=mmap_mode)
         except:
             print('\033[31mRGK load error.\033[0m ')
     
     def dump_to_file(self):
         if isinstance(self.heatmaps, list):
             self.heatmaps = np.stack(self.heatmaps, axis=0)
+        self.heatmaps = self.heatmaps.astype(self.dtype, copy=False)
         try:
-            np.save(self.save_dir, self.heatmaps)
+            atomic_save(self.save_dir, lambda path: np.save(path, self.heatmaps))
             print('RGK has been save %s' %self.save_dir)
         except:
             print('\033[31mRGK save error.\033[0m')
@@ -148,9 +191,12 @@ class RotationGaussianKernel(object):
 class GaussianKernel(object):
     def __init__(self, 
                 save_dir,
-                grid_reduce = 4
+                grid_reduce = 4,
+                dtype = np.float32 # the dtype of the saved heatmaps
                 ):
         self.save_dir = save_dir
+        self.dtype = np.dtype(dtype)
+        self.grid_reduce = grid_reduce
         self.heatmaps = list()
         map_sigma, map_kernel_size = 8 / grid_reduce, 8
         x, y = np.meshgrid(np.arange(-map_kernel_size, map_kernel_size + 1),
@@ -166,38 +212,49 @@ class GaussianKernel(object):
         heatmap[int(box_cy), int(box_cx)] = 1
         return heatmap
 
-    def generate(self):
+    def convolve(self, occupancy):
+        """
+            The gaussian kernel heatmaps (N, h, w) of the occupancy maps (N, h, w), see `build_heatmaps`
+        """
         # in order to boost the gaussian kernel heatmap generation,
         # send the tensor to default device: cuda:0
         device = torch.device('cpu')
 
-        if isinstance(self.heatmaps, list):
-            self.heatmaps = np.stack(self.heatmaps, axis=0)
-        heatmaps = torch.Tensor(self.heatmaps)[:, None, :, :].to(device) # bs, 1, h, w
+        heatmaps = torch.Tensor(occupancy)[:, None, :, :].to(device) # bs, 1, h, w
         mask = torch.where(heatmaps == 1.)
         with torch.no_grad(): 
             heatmaps = F.conv2d(heatmaps, self.map_kernel.float().to(device), \
                                 padding=int((self.map_kernel.shape[-1] - 1) / 2))
             heatmaps[mask] = 1.
-        self.heatmaps = heatmaps.squeeze(1).cpu().numpy()
+        return heatmaps.squeeze(1).cpu().numpy()
+
+    def generate(self):
+        if isinstance(self.heatmaps, list):
+            self.heatmaps = np.stack(self.heatmaps, axis=0)
+        self.heatmaps = self.convolve(self.heatmaps)
        
     def add_item(self, heatmap):
         self.heatmaps.append(heatmap)
 
     def GKExist(self):
-        return os.path.exists(self.save_dir)
+        # the saved heatmaps of another dtype are rebuilt
+        return os.path.exists(self.save_dir) and np.load(self.save_dir, mmap_mode='r').dtype == self.dtype
     
-    def load_from_file(self):
+    def load_from_file(self, mmap_mode='c'):
+        """
+            mmap_mode: see `RotationGaussianKernel.load_from_file`
+        """
         try:
-            return np.load(self.save_dir)
+            return np.load(self.save_dir, mmap_mode=mmap_mode)
         except:
             print('\033[31mRGK load error.\033[0m')
     
     def dump_to_file(self):
         self.generate()
+        self.heatmaps = self.heatmaps.astype(self.dtype, copy=False)
         # self.viz_gk()
         try:
-            np.save(self.save_dir, self.heatmaps)
+            atomic_save(self.save_dir, lambda path: np.save(path, self.heatmaps))
             print('RGK has been save %s' %self.save_dir)
         except:
             print('\033[31mRGK save error.\033[0m')
@@ -0,0 +1,95 @@
+import os, sys, json, hashlib
+sys.path.append(os.getcwd())
+
+"""
+#--------------------------------------#
+-     Cache of the derived artifacts   -
+#--------------------------------------#
+    The heatmaps, the class average and gt.txt are derived from the annotations of a dataset and the
+    params which build them. ArtifactCache names every artifact by the fingerprint of the dataset root,
+    the size and mtime of the annotation files and the params, thus an artifact is only built when one of
+    them changes, and a stale artifact is never read. The artifacts are written by `atomic_save`, thus
+    an interrupted build does not leave an incomplete artifact behind.
+    The artifacts of growing recordings are named by the params only (no annotation files in the
+    fingerprint) and updated in place: the manifest next to such an artifact keeps the annotation files 
+    it is built from, and `delta` gives the new or modified files since then, see `refresh_index`.
+"""
+class ArtifactCache(object):
+    def __init__(self, root=r'vfa/data/cache'):
+        self.root = root
+
+    @staticmethod
+    def annotation_stats(ann_paths):
+        # the name, size and mtime of the annotation files, which change with the annotations
+        stats = list()
+        for path in sorted(ann_paths):
+            stat = os.stat(path)
+            stats.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+        return stats
+
+    def fingerprint(self, data_root, ann_paths, **params):
+        digest = hashlib.sha1(repr(os.path.abspath(data_root)).encode())
+        digest.update(repr(self.annotation_stats(ann_paths)).encode())
+        digest.update(repr(sorted((key, str(value)) for key, value in params.items())).encode())
+        return digest.hexdigest()[:16]
+
+    @staticmethod
+    def delta(path, ann_paths):
+        """
+            The annotation files changed since the artifact `path` was committed, see `commit`.
+            Return (stale, previous): the artifact has the frames of the first `previous` files, `stale` are the 
+            indices of its modified files, and the files from `previous` on are new.
+            None: the artifact must be built from scratch. It does not exist, or files are removed, renamed 
+                  or inserted before the last frame of the artifact, thus the frames are not append-only.
+        """
+        manifest = path + '.json'
+        if not os.path.exists(path) or not os.path.exists(manifest):
+            return None
+        with open(manifest, 'r') as f:
+            previous = [tuple(stat) for stat in json.load(f)]
+        current = ArtifactCache.annotation_stats(ann_paths)
+        if len(current) < len(previous) or any(old[0] != new[0] for old, new in zip(previous, current)):
+            return None
+        stale = [i for i, (old, new) in enumerate(zip(previous, current)) if old != new]
+        return stale, len(previous)
+
+    @staticmethod
+    def changed(delta, count):
+        # the indices of the frames to process of `delta` with `count` annotation files
+        if delta is None:
+            return list(range(count))
+        stale, previous = delta
+        return stale + list(range(previous, count))
+
+    @staticmethod
+    def commit(path, ann_paths):
+        """
+            Record the annotation files of the artifact `path` after it is written, see `delta`
+        """
+        stats = ArtifactCache.annotation_stats(ann_paths)
+        def save(temp):
+            with open(temp, 'w') as f:
+                json.dump(stats, f)
+        atomic_save(path + '.json', save)
+
+    def path(self, name, fingerprint, ext):
+        """
+            The path of the artifact `name` built with `fingerprint`, e.g. cache/mc_GK-<fingerprint>.npy
+        """
+        os.makedirs(self.root, exist_ok=True)
+        return os.path.join(self.root, '{}-{}{}'.format(name, fingerprint, ext))
+
+def atomic_save(path, save):
+    """
+        save: function of a path that writes the artifact. It writes into a temporary file of the same
+              directory, which is renamed to `path` after it is complete.
+        [NOTICE] the memory maps of `path` must be released before, os.replace fails on a mapped file on Windows
+    """
+    base, ext = os.path.splitext(path)
+    temp = '{}.{}.tmp{}'.format(base, os.getpid(), ext)
+    try:
+        save(temp)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
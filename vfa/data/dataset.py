@@ -13,6 +13,7 @@ from torchvision.transforms import ToTensor
 from vfa.data.multiviewX import MultiviewX
 from vfa.data.multiviewC import MultiviewC
 from vfa.data.wildtrack import Wildtrack
+from vfa.data.target_store import TargetStore
 from vfa.utils import make_grid
 
 class frameDataset(VisionDataset):
@@ -41,16 +42,32 @@ class frameDataset(VisionDataset):
         self.labels, self.heatmaps = self.split(base.labels, base.heatmaps)
         self.fpaths = self.base.get_image_fpaths(self.frame_range)
         self.grid = make_grid(world_size=self.world_size, cube_LW=self.cube_LWH[:2], dataset=base.__name__) # (l, w, 3)
+        # Encode the targets of every frame in __getitem__, see `set_encoder`
+        self.encoder, self.target_store = None, None
         pass
+
+    def set_encoder(self, encoder, store_root=None):
+        """
+            Return the targets of ObjectEncoder with every frame, thus they are encoded in the DataLoader workers.
+            With `store_root`, the targets of all frames are encoded once into a TargetStore and read from it.
+        """
+        self.encoder = encoder
+        self.target_store = None if store_root is None else TargetStore(store_root, encoder, self)
     
     def split(self, labels, heatmaps):
-        assert len(labels) == len(heatmaps), 'the number of labels must be equal to that of heatmaps'
+        # the heatmaps of a base dataset without heatmaps are rendered by ObjectEncoder
+        assert heatmaps is None or len(labels) == len(heatmaps), 'the number of labels must be equal to that of heatmaps'
         if self.base.__name__ == Wildtrack.__name__:
-            labels = [labels[id] for id, i in enumerate(range(0, self.num_frame, 5)) if i in self.frame_range]
-            heatmaps = [heatmaps[id] for id, i in enumerate(range(0, self.num_frame, 5)) if i in self.frame_range]
+            ids = [id for id, i in enumerate(range(0, self.num_frame, 5)) if i in self.frame_range]
         else:
-            labels = [labels[i] for i in range(len(labels)) if i in self.frame_range]
-            heatmaps = [heatmaps[i] for i in range(len(heatmaps)) if i in self.frame_range]
+            ids = [i for i in range(len(labels)) if i in self.frame_range]
+        labels = [labels[i] for i in ids]
+        if heatmaps is None:
+            return labels, None
+        # the frames of a split are contiguous, thus the heatmaps of the split are a view of the 
+        # memory-mapped heatmaps of the base dataset without copy
+        heatmaps = heatmaps[ids[0]:ids[-1] + 1] if len(ids) else heatmaps[:0]
+        assert len(heatmaps) == len(ids), 'the frames of a split must be contiguous'
               
         return labels, heatmaps
 
@@ -63,9 +80,20 @@ class frameDataset(VisionDataset):
         images = [ self.transform(Image.open(p).convert('RGB')) for p in batch_img_fpaths ]
         calibs = [ self.intrinsic_matrices[cam] @ self.extrinsic_matrices[cam] for cam in range(self.num_cam)]
         objects = self.labels[index]
-        heatmaps = torch.Tensor(self.heatmaps[index])
         grid = self.grid
-        return index, images, objects, heatmaps, calibs, grid
+        heatmaps, targets = None, None
+        if self.heatmaps is not None:
+            # wrap the memory-mapped heatmap, which is only copied if it is not saved as float32
+            heatmaps = torch.from_numpy(self.heatmaps[index]).float()
+        if self.encoder is not None:
+            if heatmaps is None:
+                heatmaps = self.encoder.render_heatmaps([objects], grid[None])[0]
+            if self.target_store is None:
+                positives = self.encoder.encode_positives([objects], grid[None])
+            else:
+                positives = self.target_store[index]
+            targets = self.encoder.assemble(positives, heatmaps[None], grid[None])
+        return index, images, objects, heatmaps, calibs, grid, targets
 
 if __name__ == '__main__':
     from vfa.visualization.figure import _format_bboxes, _format_bottom
@@ -81,7 +109,7 @@ if __name__ == '__main__':
     r = 1
     data = frameDataset(Wildtrack(root=args.root, world_size=args.world_size, cube_LWH=args.cube_size),
                                   transform=transform, split='val')
-    index, images, objects, heatmaps, calibs, grid  = next(iter(data))
+    index, images, objects, heatmaps, calibs, grid, _  = next(iter(data))
     colors = ['green', 'purple']
     heatmaps = (heatmaps.cpu().numpy()*255).clip(0, 255)
     for cam in range(0, data.num_cam):
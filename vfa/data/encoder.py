@@ -13,12 +13,13 @@ import torch.nn.functional as F
 import torch.nn as nn
 from scipy.stats import multivariate_normal
 
-from vfa.utils import Obj2D, Obj3D
+from vfa.utils import ObjectBatch
 from vfa.data.multiviewC import MultiviewC
 from vfa.data.multiviewX import MultiviewX
 from vfa.data.wildtrack import Wildtrack
 from vfa.data.dataset import frameDataset
-from vfa.data.smooth_label import gaussian_label
+from vfa.data.smooth_label import gaussian_label, bin_residual_label
+from vfa.data.heatmap_render import HeatmapRenderer
 
 
 class ObjectEncoder(object):
@@ -29,7 +30,10 @@ class ObjectEncoder(object):
                      angle_range=360,
                      angle_radius=6,
                      topk=100, 
-                     kernel_type='RGK'):
+                     kernel_type='RGK',
+                     angle_mode='csl',
+                     angle_bins=8,
+                     target_format='dense'):
         
         self.dataset = dataset
         self.classname = dataset.base.label_names
@@ -37,7 +41,17 @@ class ObjectEncoder(object):
         # angle range and radius are the params of CSL
         self.angle_range=angle_range
         self.angle_radius = angle_radius
+        # `csl`: 360-way circular smooth label, `bin`: `angle_bins` angle bins + sin/cos residual to the bin center
+        assert angle_mode in ['csl', 'bin'], 'angle mode error, expect `csl` or `bin`, got {}'.format(angle_mode)
+        self.angle_mode = angle_mode
+        self.angle_bins = angle_bins
+        # The circular smooth label of every integer degree, (angle_range, angle_range)
+        self.csl_table = torch.from_numpy(np.stack([gaussian_label(degree, angle_range, sigma=angle_radius) 
+                                                    for degree in range(angle_range)]))
         self.topk = topk
+        # `dense`: the regression targets are maps of the grid, `sparse`: the targets of the positive cells only
+        assert target_format in ['dense', 'sparse'], 'target format error, expect `dense` or `sparse`, got {}'.format(target_format)
+        self.target_format = target_format
         # MultiviewC: world_size: (3900, 3900), cube_LWH: (30, 30, 32); units of all are centimeter(cm)
         # MultiviewX: world_size: (640, 1000), real_world_size:(16m, 25m), cube_LWH:(4, 4, 36)
         # Wildtrack: world: (480, 1440) real_world_size:(12m, 36m)
@@ -46,123 +60,158 @@ class ObjectEncoder(object):
         if kernel_type == 'GK' and self.dataset.base.__name__ == 'MultiviewC':
             self.map_kernel = self.gaussian_kernel(map_sigma, map_kernel_size)
         self.maxpool = nn.MaxPool2d(kernel_size=5, padding=2, stride=1)
+        # Render the heatmaps of the frames whose heatmaps are not loaded, see `render_heatmaps`
+        self.renderer = HeatmapRenderer(kernel_type=getattr(dataset.base, 'heatmap_type', 'GK'))
 
     def batch_encode(self, objects, heatmaps, grids):
-        if self.dataset.base.__name__ in ['MultiviewC', 'MVM3D']:
-            # Encode element by element
-            batch_encoded = [self.encode3d(objs, heatmap, grid) \
-                        for objs, heatmap, grid in zip(objects, heatmaps, grids)]
-            return batch_encoded
-        elif self.dataset.base.__name__ in ['MultiviewX', 'Wildtrack']:
-            batch_encoded = [self.encode2d(objs, heatmap, grid) \
-                        for objs, heatmap, grid in zip(objects, heatmaps, grids)]
-            return batch_encoded
-        else:
-            raise ValueError("""Dataset Error: only support `MultivewC` `MVM3D` for 3D detection, 
-                                and `MultiviewX` `Wildtrack` for 2D detection.""")
-
-    def encode3d(self, objects:Obj3D, heatmap:torch.Tensor, grid:torch.Tensor, visualize=False):
-        # Filter the object by class name. MultiviewC only has on class
-        objects = [obj for obj in objects if obj.classname in self.classname]
+        """
+            Encode the objects of a batch of frames at once, objects: the ObjectBatch of the frames, or a list of
+            the objects of every frame,
+            heatmaps: (B, L, W), grids: (B, L, W, 3). Return the stacked targets of the batch
+                mask, heatmap: (B, 1, L, W), loc_offset: (B, L, W, 2), and for 3D detection
+                dim_offset: (B, L, W, 3), rotation: (B, L, W, 360) or (B, L, W, 3) of `bin` mode
+            Sparse targets have the regression targets of the M positive cells, (M, C) instead of (B, L, W, C),
+            and their `index` (M, 2) of [frame, cell] where cell is the flat index into L*W
+            heatmaps=None: the heatmaps are rendered from the objects, see `render_heatmaps`
+        """
+        if heatmaps is None:
+            heatmaps = self.render_heatmaps(objects, grids)
+        return self.assemble(self.encode_positives(objects, grids), heatmaps, grids)
 
-        # Return empty encode if there are no any objects
-        if len(objects) == 0:
-            return self._encode_empty3d(grid)
+    def render_heatmaps(self, objects, grids):
+        """
+            The GK or RGK heatmaps (B, L, W) of the objects of a batch of frames on the device of grids (B, L, W, 3)
+        """
+        frame, location, dimension, rotation = self._flatten(objects, grids)
+        row, col = self._grid_cell(location, grids)
+        if self.renderer.kernel_type == 'RGK':
+            # dimension: h, w, l
+            return self.renderer(frame, row, col, grids.shape[:3], box_l=dimension[:, 2], box_w=dimension[:, 1], 
+                                 angle=torch.rad2deg(rotation))
+        return self.renderer(frame, row, col, grids.shape[:3])
 
-        location = grid.new([obj.location for obj in objects]) # [n, 3]
-        dimension = grid.new([obj.dimension for obj in objects]) # [n, 3]
-        rotation = grid.new([obj.rotation for obj in objects]) # [n, ]
-
-        # Assign the target to the grid 
-        # mask: dict key: 0 - nclass, value: torch.Tensor, storing the distribution of targets
-        mask, indices = self._assign_to_grid(location, grid) 
-
-        # Encode heatmap
-        # heatmap = self._encode_heatmap(mask)
-        heatmap = heatmap[None, None, :, :] 
-        
+    def encode3d(self, objects:ObjectBatch, heatmap:torch.Tensor, grid:torch.Tensor, visualize=False):
+        # Encode a single frame as a batch of one
         if visualize:
-            viz_heatmaps = (heatmap.squeeze(0).squeeze(0) * 255).cpu().numpy().clip(0, 255).astype(np.uint8)
+            viz_heatmaps = (heatmap * 255).cpu().numpy().clip(0, 255).astype(np.uint8)
             plt.imshow(viz_heatmaps)
             plt.show()
-      
-        # Encode location
-        location_offset = self._encode_location(location, grid)
-
-        # Encode dimension
-        dimension_offset = self._encode_dimension(dimension, grid, indices)
+        return self.batch_encode([objects], heatmap[None], grid[None])
 
-        # Encode rotation
-        rotation = self._encode_rotation(rotation, grid, indices)
+    def encode2d(self, objects:ObjectBatch, heatmap:torch.Tensor, grid:torch.Tensor, visualize=False):
+        # Encode a single frame as a batch of one
+        if visualize:
+            viz_heatmaps = (heatmap * 255).cpu().numpy().clip(0, 255).astype(np.uint8)
+            plt.imshow(viz_heatmaps)
+            plt.show()
+        return self.batch_encode([objects], heatmap[None], grid[None])
 
-        encoded_gt = {'mask' : mask, 
-                   'heatmap' : heatmap,
-                   'loc_offset' : location_offset.permute(0, 2, 3, 1),
-                   'dim_offset' : dimension_offset.permute(0, 2, 3, 1),
-                   'rotation' : rotation.permute(0, 2, 3, 1)}
-        return encoded_gt
+    @property
+    def three_d(self):
+        if self.dataset.base.__name__ in ['MultiviewC', 'MVM3D']:
+            return True
+        elif self.dataset.base.__name__ in ['MultiviewX', 'Wildtrack']:
+            return False
+        else:
+            raise ValueError("""Dataset Error: only support `MultivewC` `MVM3D` for 3D detection, 
+                                and `MultiviewX` `Wildtrack` for 2D detection.""")
 
-    def encode2d(self, objects:Obj2D, heatmap:torch.Tensor, grid:torch.Tensor, visualize=False):
-        # Filter the object by class name. MultiviewX, WildTrack only has on class
-        objects = [obj for obj in objects if obj.classname in self.classname]
+    def encode_positives(self, objects, grids):
+        """
+            The regression targets of the positive cells of a batch of frames, which only depend on the
+            objects and the config of the encoder, see `TargetStore`. Return index (M, 2) of [frame, cell],
+            loc_offset (M, 2), and for 3D detection dim_offset (M, 3), rotation (M, 360) or (M, 3)
+        """
+        three_d = self.three_d
+        frame, location, dimension, rotation = self._flatten(objects, grids)
 
-        # Return empty encode if there are no any objects
-        if len(objects) == 0:
-            return self._encode_empty2d(grid)
-   
-        location = grid.new([obj.location for obj in objects]) # [n, 3]
+        # Assign the target to the grid, cell: the flat index of the objects into (B*L*W)
+        cell, keep = self._assign_to_grid(frame, location, grids)
+        cells = grids.shape[1:3].numel()
 
-        # Assign the target to the grid
-        mask, _ = self._assign_to_grid(location, grid)
+        # Encode location
+        positives = {'index' : torch.stack([cell // cells, cell % cells], dim=-1),
+                     'loc_offset' : self._encode_location(location, grids, keep)}
+        if three_d:
+            # Encode dimension
+            positives['dim_offset'] = self._encode_dimension(dimension, keep)
+            # Encode rotation
+            positives['rotation'] = self._encode_rotation(rotation, grids, keep)
+        return positives
 
-        if visualize:
-            viz_heatmaps = (heatmap * 255).cpu().numpy().clip(0, 255).astype(np.uint8)
-            plt.imshow(viz_heatmaps)
-            plt.show()
+    def assemble(self, positives, heatmaps, grids):
+        """
+            The targets of `batch_encode` from the heatmaps and the `positives` of `encode_positives`
+        """
+        batch, length, width = grids.shape[:3]
+        cell = positives['index'][:, 0] * length * width + positives['index'][:, 1]
+        foreground = grids.new_zeros(batch * length * width) # B, 1, H, W
+        foreground[cell] = 1.
 
         # Encode heatmap
         # heatmap = self._encode_heatmap(mask)
-        heatmap = heatmap[None, None, :, :] 
+        heatmap = heatmaps[:, None, :, :]
 
-        # Encode location
-        location_offset = self._encode_location(location, grid)
-
-        encoded_gt = {'mask' : mask, 
-                      'heatmap' : heatmap,
-                      'loc_offset' : location_offset.permute(0, 2, 3, 1)}
+        encoded_gt = {'mask' : foreground.view(batch, 1, length, width), 
+                      'heatmap' : heatmap}
+        if self.target_format == 'sparse':
+            encoded_gt['index'] = positives['index']
+        for key in ['loc_offset', 'dim_offset', 'rotation']:
+            if key not in positives:
+                continue
+            values = positives[key].to(grids.dtype)
+            if self.target_format == 'dense':
+                # (n, C) of the positive cells => (B, H, W, C)
+                target = grids.new_zeros(batch * length * width, values.shape[-1])
+                target[cell] = values
+                values = target.view(batch, length, width, values.shape[-1])
+            encoded_gt[key] = values
         return encoded_gt
-        
-        
-    def _encode_empty3d(self, grid):
-        # if empty, encode mask(1, H, W), heatmaps(1, H, W), 
-        # location_offsets(2, H, W), dimension_offsets(3, H, W), rotation(360, H, W)
-        mask = grid.new_zeros(1, *grid.size()[:-1])
-        heatmaps = grid.new_zeros(1, *grid.size()[:-1])
-        location_offsets = grid.new_zeros(2, *grid.size()[:-1])
-        dimension_offsets = grid.new_zeros(3, *grid.size()[:-1])
-        rotation = grid.new_zeros(self.angle_range, *grid.size()[:-1])
-        return mask, heatmaps, location_offsets, dimension_offsets, rotation
 
-    def _encode_empty2d(self, grid):
-        mask = grid.new_zeros(1, *grid.size()[:-1])
-        heatmaps = grid.new_zeros(1, *grid.size()[:-1])
-        location_offsets = grid.new_zeros(2, *grid.size()[:-1])
-        return mask, heatmaps, location_offsets
+    def _flatten(self, objects, grids):
+        """
+            Filter the object by class name and flatten the objects of all frames, objects: an ObjectBatch or
+            a list of the objects of every frame.
+            Return frame (n, ), location (n, 3), and for 3D detection dimension (n, 3), rotation (n, ) 
+        """
+        three_d = self.three_d
+        if not isinstance(objects, ObjectBatch):
+            objects = ObjectBatch.cat([objs if isinstance(objs, ObjectBatch) else ObjectBatch.from_objects(objs, three_d)
+                                       for objs in objects])
+        # MultiviewC only has on class, MultiviewX, WildTrack only has on class
+        objects = objects.select(self.classname)
+        def as_tensor(values, *shape):
+            # the columns are converted from float64, the same as the values of the annotations
+            return values.to(grids.device, torch.float64).to(grids.dtype).view(*shape)
+        frame = objects.frame.to(grids.device) # [n, ]
+        location = as_tensor(objects.location, len(frame), 3) # [n, 3]
+        dimension, rotation = None, None
+        if three_d:
+            dimension = as_tensor(objects.dimension, len(frame), 3) # [n, 3]
+            rotation = as_tensor(objects.rotation, len(frame)) # [n, ]
+        return frame, location, dimension, rotation
 
-    def _assign_to_grid(self, location, grid):
+    def _grid_cell(self, location, grids):
+        # The cell (row, col) of the locations (n, 3) in the grids (B, L, W, 3)
         location = location[..., :2]
         # normalize locations
-        location = location / location.new(self.world_size).view(-1, 2) * location.new([grid.size()[:2]]) 
-        foreground = grid.new_zeros(1, *grid.size()[:-1]) # B, 1, H, W
-        indices = list()
-        for loc in location:
-            coord_x, coord_y = int(loc[0]), int(loc[1])
-            if self.dataset.base.__name__ == Wildtrack.__name__:
-                foreground[:, coord_x, coord_y] = 1.
-            else:
-                foreground[:, coord_y, coord_x] = 1.
-            indices.append([coord_x, coord_y])
-        return foreground.unsqueeze(0), indices
+        location = location / location.new(self.world_size).view(-1, 2) * location.new([grids.shape[1:3]]) 
+        coord = location.long() # [n, 2]
+        if self.dataset.base.__name__ == Wildtrack.__name__:
+            return coord[:, 0], coord[:, 1]
+        return coord[:, 1], coord[:, 0]
+
+    def _assign_to_grid(self, frame, location, grids):
+        batch, length, width = grids.shape[:3]
+        row, col = self._grid_cell(location, grids)
+        inside = (row >= 0) & (row < length) & (col >= 0) & (col < width)
+        cell = torch.where(inside, (frame * length + row) * width + col, torch.zeros_like(row))
+        # The later object of a cell overwrites the earlier ones, thus keep the last object of every cell
+        order = torch.arange(len(cell), device=cell.device)
+        last = order.new_full((batch * length * width, ), -1)
+        last.scatter_reduce_(0, cell[inside], order[inside], reduce='amax')
+        keep = inside & (last[cell] == order)
+        return cell[keep], keep
 
     def _encode_heatmap(self, mask):
         heatmap = mask.to(torch.float32)  # (1, 1, H, W)
@@ -170,51 +219,49 @@ class ObjectEncoder(object):
             heatmap = F.conv2d(heatmap, self.map_kernel.float().to(heatmap.device), padding=int((self.map_kernel.shape[-1] - 1) / 2))
         return heatmap.clip(min=0., max=1.)
 
-    def _encode_location(self, location, grid):
+    def _encode_location(self, location, grids, keep):
         # z coordinate value of target is zero by default
-        # thus, location offset is (2, H, W)
+        # thus, location offset is (n, 2) of offset_x, offset_y
         location = location[..., :2]
-        location = location / location.new(self.world_size).view(-1, 2) * location.new([grid.size()[:2]])# normalize location
-        location_offset = grid.new_zeros((1, 2, *grid.size()[:-1]))
-        for loc in location:
-            coord_x, coord_y = int(loc[0]), int(loc[1])
-            offset_x = loc[0] - coord_x
-            offset_y = loc[1] - coord_y
-            if self.dataset.base.__name__ == Wildtrack.__name__:
-                location_offset[:, 0, coord_x, coord_y] = offset_x
-                location_offset[:, 1, coord_x, coord_y] = offset_y
-            else:
-                location_offset[:, 0, coord_y, coord_x] = offset_x
-                location_offset[:, 1, coord_y, coord_x] = offset_y
-
-        return location_offset
+        location = location / location.new(self.world_size).view(-1, 2) * location.new([grids.shape[1:3]])# normalize location
+        location_offset = location - location.long()
+        return location_offset[keep]
         
-    def _encode_dimension(self, dimension, grid, indices):
+    def _encode_dimension(self, dimension, keep):
         # default one class 'Cow'
         dimension_mean = self.dataset.classAverage.get_mean(self.classname[0])
         dimension_mean = dimension.new(dimension_mean) # convert to same device and dtype
         # FORMULA: exp(dim_off) * dim_mean = dim
-        dimension_offset = grid.new_zeros((1, 3, *grid.size()[:-1])) # (3, H, W)
-        for dim, index in zip(dimension, indices):
-            coord_x, coord_y = index
-            # offset of height, width, length
-            offset_dim = torch.log(dim / dimension_mean) 
-            dimension_offset[:, 0, coord_y, coord_x] = offset_dim[0] # offset_height
-            dimension_offset[:, 1, coord_y, coord_x] = offset_dim[1] # offset_width
-            dimension_offset[:, 2, coord_y, coord_x] = offset_dim[2] # offset_length
+        # offset of height, width, length, (n, 3)
+        dimension_offset = torch.log(dimension / dimension_mean)
+        return dimension_offset[keep]
 
-        return dimension_offset
+    @property
+    def rotation_channels(self):
+        # CSL: the smooth label of every angle; bin: [bin, sin(residual), cos(residual)]
+        return self.angle_range if self.angle_mode == 'csl' else 3
 
-    def _encode_rotation(self, rotation, grid, indices):
+    def _encode_rotation(self, rotation, grids, keep):
         # angle => [cos(angle), sin(angle)] discarded.
-        # TODO: CSL for angle prediction
-        rotation_offset = grid.new_zeros((1, *grid.size()[:-1], self.angle_range)) #(360, H, W)
-        for angle, index in zip(rotation, indices):
-            coord_x, coord_y = index
-            smooth_label = gaussian_label(torch.rad2deg(angle).item(), self.angle_range, sigma=self.angle_radius)
-            rotation_offset[:, coord_y, coord_x, :] = torch.tensor(smooth_label)[None, :]
-        
-        return rotation_offset.permute(0, 3, 1, 2)
+        # (n, 360) or (n, 3)
+        degree = torch.rad2deg(rotation[keep])
+        if self.angle_mode == 'csl':
+            # gaussian_label of the integer degree, which wraps around angle_range
+            label = self.csl_table.to(degree.device)[torch.remainder(degree.long(), self.angle_range)]
+        else:
+            label = torch.from_numpy(bin_residual_label(degree.double().cpu().numpy(), self.angle_bins))
+        return label.to(grids.device, grids.dtype)
+
+    def _decode_rotation(self, orient):
+        # (B, K, C) => angle in radian [0, 2pi), (B, K)
+        if self.angle_mode == 'csl':
+            orient = torch.sigmoid(orient)
+            _, orient_idx = torch.max(orient, dim=-1)
+            return torch.deg2rad(orient_idx.to(torch.float32))
+        bin_width = 2 * np.pi / self.angle_bins
+        _, orient_bin = torch.max(orient[..., :self.angle_bins], dim=-1)
+        residual = torch.atan2(orient[..., self.angle_bins], orient[..., self.angle_bins + 1])
+        return torch.remainder((orient_bin.to(torch.float32) + 0.5) * bin_width + residual.to(torch.float32), 2 * np.pi)
 
     def gaussian_kernel(self, map_sigma = 1., map_kernel_size = 10):
         x, y = np.meshgrid(np.arange(-map_kernel_size, map_kernel_size + 1),
@@ -231,66 +278,81 @@ class ObjectEncoder(object):
         mask = torch.eq(self.maxpool(heatmap), heatmap).to(heatmap.dtype)
         return mask * heatmap
 
+    def peaks(self, pred, heatmap_conf, keys):
+        """
+            The top k cells of heatmap_conf (B, L*W) and the heads `keys` of pred at them (B, K, C).
+            The heads of a sparse prediction (see `VFANet.predict_peaks`) are already at `peak_index`.
+        """
+        if 'peak_index' in pred:
+            return pred['peak_index'], [pred[key] for key in keys]
+        _, topk_index = torch.topk(heatmap_conf, k=self.topk, dim=1)
+        heads = [torch.gather(pred[key].flatten(1, 2), 1, topk_index[..., None].expand(-1, -1, pred[key].shape[-1]))
+                 for key in keys]
+        return topk_index, heads
+
     def decode3d(self, pred, cls_thresh):
-        heatmap, tytx, thtwtl, orient = pred['heatmap'],  pred['loc_offset'],\
-                                        pred['dim_offset'], pred['rotation']
+        heatmap = pred['heatmap']
         device, dtype = heatmap.device, heatmap.dtype                                    
         heatmap = self.nms(torch.sigmoid(heatmap))
         # (1, 1, L, W)
         heatmap = heatmap.flatten(start_dim=2).transpose(1, 2)
         heatmap_conf, _ = torch.max(heatmap, dim=-1)
+        # Do not decode the cells outside of the coverage of the rig, see `CoverageMask`
+        if 'coverage' in pred:
+            heatmap_conf = heatmap_conf * pred['coverage'].flatten(start_dim=1).to(dtype)
         L, W = pred['heatmap'].shape[2:]
-        grid_y, grid_x = torch.meshgrid( torch.arange(L, dtype=dtype, device=device), \
-                                         torch.arange(W, dtype=dtype, device=device))
+        # Only decode the top k cells, (B, K)
+        topk_index, (tytx, thtwtl, orient) = self.peaks(pred, heatmap_conf, ['loc_offset', 'dim_offset', 'rotation'])
+        grid_y, grid_x = (topk_index // W).to(dtype), (topk_index % W).to(dtype)
         # Decode location
         tytx = torch.sigmoid(tytx)
-        bboxes_cy = (grid_y[None, ...] + tytx[..., 0]).flatten(start_dim=1) / self.grid_size[0] * self.world_size[0]
-        bboxes_cx = (grid_x[None, ...] + tytx[..., 1]).flatten(start_dim=1) / self.grid_size[1] * self.world_size[1]
+        bboxes_cy = (grid_y + tytx[..., 0]) / self.grid_size[0] * self.world_size[0]
+        bboxes_cx = (grid_x + tytx[..., 1]) / self.grid_size[1] * self.world_size[1]
         # Decode dimension
         dimension_mean = self.dataset.classAverage.get_mean(self.classname[0])
-        bboxes_h = torch.exp(thtwtl[..., 0]).flatten(start_dim=1) * dimension_mean[0]
-        bboxes_w = torch.exp(thtwtl[..., 1]).flatten(start_dim=1) * dimension_mean[1]
-        bboxes_l = torch.exp(thtwtl[..., 2]).flatten(start_dim=1) * dimension_mean[2]
+        bboxes_h = torch.exp(thtwtl[..., 0]) * dimension_mean[0]
+        bboxes_w = torch.exp(thtwtl[..., 1]) * dimension_mean[1]
+        bboxes_l = torch.exp(thtwtl[..., 2]) * dimension_mean[2]
         # Decode rotation
-        orient = torch.sigmoid(orient)
-        _, orient_idx = torch.max(orient, dim=-1)
-        orient_idx = orient_idx.flatten(start_dim=1)
-        # Concatenate conf, location, dimension and rotation
-        _, topk_index = torch.topk(heatmap_conf, k=self.topk, dim=1)
+        orient = self._decode_rotation(orient)
         # output: list contain tensor [1, topk]
-        output = [ torch.gather(x, dim=1, index=topk_index)
-                   for x in [heatmap_conf, bboxes_cy, bboxes_cx, bboxes_h, bboxes_w, bboxes_l, orient_idx] ]
+        output = [torch.gather(heatmap_conf, dim=1, index=topk_index), 
+                  bboxes_cy, bboxes_cx, bboxes_h, bboxes_w, bboxes_l, orient]
         # Construct output
         mask = output[0] > cls_thresh
         conf = output[0][mask]
         location = torch.stack([output[2][mask], output[1][mask], torch.zeros_like(output[1][mask])], dim=-1) # x y z
         dimension = torch.stack([output[3][mask], output[4][mask], output[5][mask]], dim=-1)
-        rotation = torch.deg2rad(output[6][mask].to(torch.float32))
-        return {'conf': conf,
+        rotation = output[6][mask]
+        return {'frame': mask.nonzero()[:, 0],
+                'conf': conf,
                 'location': location,
                 'dimension': dimension,
                 'rotation': rotation
                 }
             
     def decode2d(self, pred, cls_thresh):
-        heatmap, tytx = pred['heatmap'],  pred['loc_offset']
+        heatmap = pred['heatmap']
         device, dtype = heatmap.device, heatmap.dtype                                    
         heatmap = self.nms(torch.sigmoid(heatmap))
         # (1, 1, L, W)
         heatmap = heatmap.flatten(start_dim=2).transpose(1, 2)
         heatmap_conf, _ = torch.max(heatmap, dim=-1)
+        # Do not decode the cells outside of the coverage of the rig, see `CoverageMask`
+        if 'coverage' in pred:
+            heatmap_conf = heatmap_conf * pred['coverage'].flatten(start_dim=1).to(dtype)
         L, W = pred['heatmap'].shape[2:]
-        grid_y, grid_x = torch.meshgrid( torch.arange(L, dtype=dtype, device=device), \
-                                         torch.arange(W, dtype=dtype, device=device))
+        # Only decode the top k cells, (B, K)
+        topk_index, (tytx, ) = self.peaks(pred, heatmap_conf, ['loc_offset'])
+        grid_y, grid_x = (topk_index // W).to(dtype), (topk_index % W).to(dtype)
         # Decode location
         tytx = torch.sigmoid(tytx)
-        bboxes_cy = (grid_y[None, ...] + tytx[..., 0]).flatten(start_dim=1) / self.grid_size[0] * self.world_size[0]
-        bboxes_cx = (grid_x[None, ...] + tytx[..., 1]).flatten(start_dim=1) / self.grid_size[1] * self.world_size[1]
+        bboxes_cy = (grid_y + tytx[..., 0]) / self.grid_size[0] * self.world_size[0]
+        bboxes_cx = (grid_x + tytx[..., 1]) / self.grid_size[1] * self.world_size[1]
         
-        _, topk_index = torch.topk(heatmap_conf, k=self.topk, dim=1)
         # output: list contain tensor [1, topk]
-        output = [ torch.gather(x, dim=1, index=topk_index)
-                   for x in [heatmap_conf, bboxes_cy, bboxes_cx] ] # TODO: check bboxes_cx, bboxes_cy ?
+        output = [torch.gather(heatmap_conf, dim=1, index=topk_index), 
+                  bboxes_cy, bboxes_cx] # TODO: check bboxes_cx, bboxes_cy ?
         # Construct output
         mask = output[0] > cls_thresh
         conf = output[0][mask]
@@ -300,34 +362,25 @@ class ObjectEncoder(object):
         else:
             location = torch.stack([output[2][mask], output[1][mask], torch.zeros_like(output[1][mask])], dim=-1) # x y z
         
-        return {'conf': conf,
+        return {'frame': mask.nonzero()[:, 0],
+                'conf': conf,
                 'location': location
                 }                           
     
     def batch_decode(self, pred, cls_thresh):
+        """
+            The ObjectBatch of the detections of every frame of pred
+        """
         # for MultiviewC, MVM3D dataset
         if self.dataset.base.__name__ in ['MultiviewC', 'MVM3D']:
             batch = self.decode3d(pred, cls_thresh)
-            objects = list()
-            for i in range(len(batch['conf'])):
-                objects.append(Obj3D(
-                    classname=self.dataset.base.label_names[0], # default one class
-                    conf=batch['conf'][i],
-                    location=batch['location'][i],
-                    dimension=batch['dimension'][i],
-                    rotation=batch['rotation'][i]))
-            return objects
         # for MultiviewX, WildTrack dataset
         elif self.dataset.base.__name__ in ['MultiviewX', 'Wildtrack']:
             batch = self.decode2d(pred, cls_thresh)
-            objects = list()
-            for i in range(len(batch['conf'])):
-                objects.append(Obj2D(
-                    classname=self.dataset.base.label_names[0],
-                    conf=batch['conf'][i],
-                    location=batch['location'][i],
-                    ))
-            return objects
         else:
             raise ValueError("""Dataset Error: only support `MultivewC` `MVM3D` for 3D detection, 
                                 and `MultiviewX` `Wildtrack` for 2D detection.""")
+        # default one class
+        classname = np.full(len(batch['conf']), self.dataset.base.label_names[0])
+        return ObjectBatch(batch['frame'], classname, batch['location'], batch.get('dimension'), batch.get('rotation'),
+                           batch['conf'], num_frames=pred['heatmap'].shape[0])
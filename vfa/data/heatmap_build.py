@@ -0,0 +1,87 @@
+import os, sys
+sys.path.append(os.getcwd())
+import numpy as np
+from multiprocessing import Pool
+from tqdm import tqdm
+
+"""
+#--------------------------------------#
+-        Streaming heatmap build       -
+#--------------------------------------#
+    The annotation files are parsed, or the objects of the annotation index are rendered, in a process pool.
+    Each frame gives its labels and its heatmaps before the convolution of GaussianKernel. The heatmaps are collected in chunks of frames in the
+    order of the files, convolved per chunk and written into preallocated memory-mapped .npy files, thus only
+    a chunk of frames is in memory at once. A .npy file is renamed to its final path after it is complete.
+    An update of the heatmaps only parses the frames of `todo`, and copies the others from the previous build.
+"""
+def build_heatmaps(parse, sources, outputs, shape, workers=None, chunk=64, dtype=np.float32,
+                   previous=None, todo=None):
+    """
+        parse: picklable function of a source => (labels, {name: heatmap (H, W)}) of the frame
+        sources: the input of `parse` for every frame, e.g. the annotation paths or the ObjectBatch of every 
+                 frame of the annotation index, which is not parsed again
+        outputs: {name: (save_path, GaussianKernel or None)}, the heatmaps of `name` are convolved
+                 by the GaussianKernel and saved to save_path (N, H, W). {}: only parse the labels
+        shape: the shape (H, W) of heatmaps
+        workers: the number of processes, None: the number of CPUs, 0 or 1: parse in this process
+        dtype: the dtype of the saved heatmaps
+        previous: {name: heatmaps (N', H, W)} of the previous build, whose frames not in `todo` are kept.
+                  [NOTICE] it is cleared after the copy, thus its memory maps of the files to replace are released
+        todo: the indices of sources to parse, e.g. the new or modified annotation files. None: all frames
+    Return the labels of the parsed frames in the order of `todo`
+    """
+    workers = os.cpu_count() if workers is None else workers
+    todo = list(range(len(sources))) if todo is None else list(todo)
+    temp_paths = {name: '{}.{}.tmp.npy'.format(os.path.splitext(path)[0], os.getpid())
+                  for name, (path, _) in outputs.items()}
+    heatmaps = {name: np.lib.format.open_memmap(temp_paths[name], mode='w+', dtype=dtype,
+                                                shape=(len(sources), *shape)) for name in outputs}
+    labels, buffers, start = list(), {name: list() for name in outputs}, 0
+    if previous is not None:
+        # keep the frames of the previous build which are not parsed again
+        for name in outputs:
+            keep = np.setdiff1d(np.arange(min(len(previous[name]), len(sources))), todo)
+            for begin in range(0, len(keep), chunk):
+                heatmaps[name][keep[begin:begin + chunk]] = previous[name][keep[begin:begin + chunk]]
+        # os.replace fails on a memory-mapped file on Windows
+        previous.clear()
+
+    def flush():
+        # convolve and write the buffered frames todo[start: start + len(buffer)]
+        for name, (_, kernel) in outputs.items():
+            frames = np.stack(buffers[name], axis=0)
+            heatmaps[name][todo[start:start + len(frames)]] = frames if kernel is None else kernel.convolve(frames)
+            buffers[name] = list()
+
+    inputs = [sources[i] for i in todo]
+    pool = Pool(workers) if workers > 1 and len(inputs) > 1 else None
+    results = map(parse, inputs) if pool is None else pool.imap(parse, inputs, chunksize=4)
+    try:
+        for frame_labels, frame_heatmaps in tqdm(results, total=len(inputs), mininterval=0.3):
+            labels.append(frame_labels)
+            for name in outputs:
+                buffers[name].append(frame_heatmaps[name])
+            if outputs and len(buffers[next(iter(outputs))]) == chunk:
+                flush()
+                start += chunk
+        if outputs and len(buffers[next(iter(outputs))]) > 0:
+            flush()
+    except BaseException:
+        # do not leave incomplete heatmaps behind
+        if pool is not None:
+            pool.terminate()
+        for name in outputs:
+            del heatmaps[name]
+            os.remove(temp_paths[name])
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for name, (path, _) in outputs.items():
+        heatmaps[name].flush()
+        del heatmaps[name]
+        os.replace(temp_paths[name], path)
+        print('{} has been save {}'.format(name, path))
+    return labels
@@ -0,0 +1,79 @@
+import os, sys
+sys.path.append(os.getcwd())
+import torch
+import numpy as np
+import torch.nn.functional as F
+from vfa.data.GK import GaussianKernel
+
+"""
+#--------------------------------------#
+-       Heatmap rendering in torch     -
+#--------------------------------------#
+    The heatmaps of a batch are drawn from the objects on the device of the grid, instead of loading the
+    heatmaps built by GaussianKernel or RotationGaussianKernel from files. Thus nothing is rebuilt when
+    `world_size` or `cube_LWH` changes.
+        GK: the occupancy maps convolved by the kernel of GaussianKernel, the same as the GK files.
+        RGK: the analytic rotated gaussian of every object with the same std as RotationGaussianKernel,
+             the overlapped kernels keep the maximum.
+             [NOTICE]: RotationGaussianKernel rotates a sampled kernel with bilinear interpolation, which
+                       blurs it and moves its peak by a fraction of cell, thus they differ slightly.
+    The cell of every object is set to 1 in both types.
+"""
+class HeatmapRenderer(object):
+    def __init__(self, kernel_type='GK', grid_reduce=4, alpha=0.01, GKRatio=8):
+        assert kernel_type in ['RGK', 'GK'], 'kernel_type error! Expect `GK` or `RGK`, got{}'.format(kernel_type)
+        self.kernel_type = kernel_type
+        self.alpha, self.GKRatio = alpha, GKRatio
+        self.map_kernel = GaussianKernel(save_dir=None, grid_reduce=grid_reduce).map_kernel
+
+    def __call__(self, frame, row, col, shape, box_l=None, box_w=None, angle=None):
+        """
+            frame, row, col: (n, ) the frame and the cell of every object
+            shape: (B, L, W) of the heatmaps, the dtype and device follow `box_l` or `row`
+            box_l, box_w: (n, ) the length (x axis) and width (y axis) of the boxes, angle: (n, ) in degree.
+                          Only for RGK
+        Return heatmaps (B, L, W)
+        """
+        batch, length, width = shape
+        dtype = box_l.dtype if box_l is not None else torch.float32
+        inside = (row >= 0) & (row < length) & (col >= 0) & (col < width)
+        frame, row, col = frame[inside], row[inside], col[inside]
+        center = (frame * length + row) * width + col
+        if self.kernel_type == 'GK':
+            heatmaps = self._render_gk(center, shape, dtype, row.device)
+        else:
+            heatmaps = self._render_rgk(frame, row, col, box_l[inside], box_w[inside], angle[inside], shape)
+        heatmaps.view(-1)[center] = 1.
+        return heatmaps
+
+    def _render_gk(self, center, shape, dtype, device):
+        occupancy = torch.zeros(shape, dtype=dtype, device=device)
+        occupancy.view(-1)[center] = 1.
+        kernel = self.map_kernel.to(device, dtype)
+        with torch.no_grad():
+            heatmaps = F.conv2d(occupancy[:, None], kernel, padding=(kernel.shape[-1] - 1) // 2)
+        return heatmaps[:, 0]
+
+    def _render_rgk(self, frame, row, col, box_l, box_w, angle, shape):
+        batch, length, width = shape
+        heatmaps = box_l.new_zeros(batch * length * width)
+        if len(frame) == 0:
+            return heatmaps.view(shape)
+        std_l, std_w = box_l * self.alpha, box_w * self.alpha
+        # the same kernel size as RotationGaussianKernel, every object draws in its own square window
+        radius = (torch.ceil(torch.maximum(std_l, std_w)) * self.GKRatio).long() // 2 # (n, )
+        steps = torch.arange(-int(radius.max()), int(radius.max()) + 1, device=row.device)
+        dy, dx = torch.meshgrid(steps, steps, indexing='ij') # (k, k)
+        within = (dy.abs()[None] <= radius[:, None, None]) & (dx.abs()[None] <= radius[:, None, None]) # (n, k, k)
+        # rotate the offsets of the cells into the frame of the box
+        theta = torch.deg2rad(angle)[:, None, None]
+        dx, dy = dx[None].to(box_l.dtype), dy[None].to(box_l.dtype)
+        u = torch.cos(theta) * dx + torch.sin(theta) * dy
+        v = -torch.sin(theta) * dx + torch.cos(theta) * dy
+        values = torch.exp(-u ** 2 / (2. * std_l[:, None, None] ** 2) - v ** 2 / (2. * std_w[:, None, None] ** 2))
+        # the cells of every window on the heatmaps, (n, k, k)
+        rows, cols = row[:, None, None] + dy.long(), col[:, None, None] + dx.long()
+        within &= (rows >= 0) & (rows < length) & (cols >= 0) & (cols < width)
+        cells = (frame[:, None, None] * length + rows) * width + cols
+        heatmaps.scatter_reduce_(0, cells[within], values[within], reduce='amax')
+        return heatmaps.view(shape)
@@ -0,0 +1,200 @@
+import os, sys, json
+sys.path.append(os.getcwd())
+import torch
+import numpy as np
+from vfa.utils import ObjectBatch
+from vfa.data.cache import atomic_save
+from vfa.data.heatmap_build import build_heatmaps
+
+"""
+#--------------------------------------#
+-       Binary annotation index        -
+#--------------------------------------#
+    The annotations, image paths and calibrations of a base dataset are compiled once into one binary
+    file of columnar arrays, which is memory-mapped on the next start instead of reading every json and
+    xml file. The objects of all frames are flat arrays, the objects of the i-th frame are in
+    [offsets[i], offsets[i+1]).
+        offsets (F+1, ), classname (n, ), location (n, 3), dimension (n, 3), rotation (n, ) (3D only)
+        image_cam (K, ), image_frame (K, ), image_path (K, ), image_mtime: the image table and the mtime of its folders
+        intrinsic (C, 3, 3), extrinsic (C, 3, 4), and the other calibrations of the dataset
+    The index of growing recordings is refreshed with the new or modified annotation files only, see `refresh_index`.
+    File format: MAGIC, the length of the json header (uint64), the json header {name: [dtype, shape, offset]},
+    and the arrays aligned to ALIGN bytes.
+"""
+MAGIC = b'VFAIDX01'
+ALIGN = 64
+
+def save_arrays(path, arrays):
+    arrays = {name: np.ascontiguousarray(value) for name, value in arrays.items()}
+    # the offsets of the arrays from the end of the header, which is padded to ALIGN
+    header, offset = dict(), 0
+    for name, value in arrays.items():
+        header[name] = [value.dtype.str, list(value.shape), offset]
+        offset += -(-value.nbytes // ALIGN) * ALIGN
+    header = json.dumps(header).encode()
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+    header = header.ljust(start - len(MAGIC) - 8)
+
+    def write(temp):
+        with open(temp, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for value in arrays.values():
+                data = value.tobytes()
+                f.write(data + b'\0' * (-len(data) % ALIGN))
+    atomic_save(path, write)
+
+def load_arrays(path):
+    """
+        The memory-mapped read-only arrays of `save_arrays`
+    """
+    with open(path, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC, '{} is not an annotation index'.format(path)
+        length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(length))
+    start = len(MAGIC) + 8 + length
+    arrays = dict()
+    for name, (dtype, shape, offset) in header.items():
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=start + offset, shape=tuple(shape))
+    return arrays
+
+OBJECT_COLUMNS = ['offsets', 'classname', 'location', 'dimension', 'rotation']
+IMAGE_COLUMNS = ['image_cam', 'image_frame', 'image_path', 'image_mtime']
+
+def object_columns(labels, three_d):
+    """
+        The columns of the objects of every frame, an ObjectBatch or a list of Obj3D or Obj2D per frame
+    """
+    frames = [frame if isinstance(frame, ObjectBatch) else ObjectBatch.from_objects(frame, three_d) for frame in labels]
+    objects = ObjectBatch.cat(frames)
+    columns = {'offsets': np.cumsum([0] + [len(frame) for frame in frames]).astype(np.int64),
+               'classname': objects.classname,
+               'location': objects.location.numpy().astype(np.float64).reshape(-1, 3)}
+    if three_d:
+        columns['dimension'] = objects.dimension.numpy().astype(np.float64).reshape(-1, 3)
+        columns['rotation'] = objects.rotation.numpy().astype(np.float64).reshape(-1)
+    return columns
+
+def image_columns(image_fpaths, image_mtime):
+    images = [(cam, frame, fpath) for cam, frames in image_fpaths.items() for frame, fpath in frames.items()]
+    return {'image_cam': np.array([cam for cam, _, _ in images], dtype=np.int64),
+            'image_frame': np.array([frame for _, frame, _ in images], dtype=np.int64),
+            'image_path': np.array([fpath for _, _, fpath in images], dtype=np.str_).reshape(-1),
+            'image_mtime': np.asarray(image_mtime, dtype=np.int64)}
+
+class AnnotationIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.arrays = load_arrays(path)
+
+    @staticmethod
+    def build(path, labels, image_fpaths, calibs, three_d, image_mtime=()):
+        """
+            labels: the objects of every frame, an ObjectBatch or a list of Obj3D or Obj2D per frame
+            image_fpaths: {cam: {frame: path}} of `get_image_fpaths`
+            calibs: {name: array} of the calibrations, e.g. intrinsic, extrinsic
+            three_d: the objects are Obj3D
+        """
+        arrays = object_columns(labels, three_d)
+        arrays.update(image_columns(image_fpaths, image_mtime))
+        arrays.update({name: np.asarray(value) for name, value in calibs.items()})
+        save_arrays(path, arrays)
+        return AnnotationIndex(path)
+
+    def update(self, frames, count, image_fpaths, image_mtime):
+        """
+            Rewrite the index with the objects of the parsed frames {index: objects} and the image table.
+            The index has `count` frames after the update. The new frames are appended to the columns, 
+            the columns are rebuilt from the labels if a frame of the index is modified.
+            Return the updated index, this one is released, see `release`.
+        """
+        three_d = 'dimension' in self.arrays
+        # the columns are copied out of the memory maps, which are released before the file is replaced
+        calibs = {name: np.array(value) for name, value in self.arrays.items() if name not in OBJECT_COLUMNS + IMAGE_COLUMNS}
+        previous = len(self)
+        if all(index >= previous for index in frames):
+            new = object_columns([frames[index] for index in range(previous, count)], three_d)
+            arrays = {name: np.concatenate([self.arrays[name], new[name]]) for name in new if name != 'offsets'}
+            arrays['offsets'] = np.concatenate([self.arrays['offsets'], self.arrays['offsets'][-1] + new['offsets'][1:]])
+        else:
+            labels = self.labels() + [None] * (count - previous)
+            for index, objects in frames.items():
+                labels[index] = objects
+            arrays = object_columns(labels, three_d)
+        arrays.update(image_columns(image_fpaths, image_mtime))
+        arrays.update(calibs)
+        self.release()
+        save_arrays(self.path, arrays)
+        return AnnotationIndex(self.path)
+
+    def release(self):
+        # drop the memory maps of the index file, os.replace fails on a mapped file on Windows
+        self.arrays = dict()
+
+    def __len__(self):
+        return len(self.arrays['offsets']) - 1
+
+    def objects(self, start=0, end=None):
+        """
+            The ObjectBatch of the frames [start, end), with dimension and rotation if the index has them
+        """
+        end = len(self) if end is None else end
+        offsets = self.arrays['offsets'][start:end + 1]
+        begin, stop = int(offsets[0]), int(offsets[-1])
+        def column(name):
+            return torch.from_numpy(np.array(self.arrays[name][begin:stop])) if name in self.arrays else None
+        frame = np.repeat(np.arange(end - start), np.diff(offsets))
+        return ObjectBatch(frame, np.array(self.arrays['classname'][begin:stop]), column('location'),
+                           column('dimension'), column('rotation'), num_frames=end - start)
+
+    def frame(self, index):
+        # the objects of the `index`-th frame
+        return self.objects(index, index + 1)
+
+    def labels(self):
+        """
+            The ObjectBatch of every frame, see `ObjectBatch.frames`
+        """
+        return self.objects().frames()
+
+    def image_fpaths(self, frame_range, num_cam):
+        """
+            {cam: {frame: path}} of the frames in frame_range, the same as `get_image_fpaths`
+        """
+        img_fpaths = {cam: {} for cam in range(1, num_cam + 1)}
+        for cam, frame, fpath in zip(self.arrays['image_cam'].tolist(), self.arrays['image_frame'].tolist(),
+                                     self.arrays['image_path'].tolist()):
+            if frame in frame_range:
+                img_fpaths[cam][frame] = fpath
+        return img_fpaths
+
+    def calib(self, name):
+        return np.array(self.arrays[name])
+
+def refresh_index(cache, path, ann_paths, parse, three_d, list_image_fpaths, image_folders, load_calibs):
+    """
+        The annotation index of ann_paths at `path`, which only parses the new or modified annotation files
+        since the last refresh, see `ArtifactCache.delta`.
+            parse: picklable function of an annotation path => (objects, heatmaps)
+            list_image_fpaths: function => {cam: {frame: path}} by listing the image folders
+            image_folders: the image table is listed again if the mtime of one of them changes
+            load_calibs: function => {name: array} by reading the calibration files, only for a new index
+    """
+    delta = cache.delta(path, ann_paths)
+    image_mtime = [os.stat(folder).st_mtime_ns for folder in image_folders]
+    if delta is None:
+        labels = build_heatmaps(parse, ann_paths, {}, None)
+        index = AnnotationIndex.build(path, labels, list_image_fpaths(), load_calibs(), three_d, image_mtime)
+    else:
+        index = AnnotationIndex(path)
+        todo = cache.changed(delta, len(ann_paths))
+        if not todo and index.arrays['image_mtime'].tolist() == image_mtime:
+            return index
+        labels = build_heatmaps(parse, ann_paths, {}, None, todo=todo)
+        index = index.update(dict(zip(todo, labels)), len(ann_paths), list_image_fpaths(), image_mtime)
+    cache.commit(path, ann_paths)
+    return index
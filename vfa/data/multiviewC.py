@@ -6,11 +6,15 @@ import json, os, sys, cv2
 from torchvision.datasets import VisionDataset
 from torchvision import transforms
 from tqdm import tqdm
+from functools import partial
 sys.path.append(os.getcwd())
 
 from vfa.data.GK import GaussianKernel, RotationGaussianKernel
 from vfa.data.ClsAvg import ClassAverage
-from vfa.utils import Obj3D
+from vfa.data.heatmap_build import build_heatmaps
+from vfa.data.cache import ArtifactCache
+from vfa.data.index import refresh_index
+from vfa.utils import Obj3D, ObjectBatch
 
 intrinsic_camera_matrix_filenames = ['intr_Camera1.xml', 'intr_Camera2.xml', 'intr_Camera3.xml', 'intr_Camera4.xml',
                                      'intr_Camera5.xml', 'intr_Camera6.xml', 'intr_Camera7.xml']
@@ -28,7 +32,10 @@ class MultiviewC(VisionDataset):
                        world_size= [3900, 3900],
                        img_shape = [720, 1280],
                        cube_LWH =  [25, 25, 32],
-                       reload_RGK=False
+                       reload_RGK=False,
+                       heatmap_dtype=np.float32, # np.float16: half the size of the memory-mapped heatmaps
+                       with_heatmaps=True, # False: the heatmaps are not built, but rendered by ObjectEncoder
+                       cache_root=r'vfa/data/cache' # the heatmaps and the class average, see `ArtifactCache`
                 ) -> None:
         super().__init__(root)
         """
@@ -63,21 +70,55 @@ class MultiviewC(VisionDataset):
         self.img_shape, self.world_size = img_shape, world_size # H, W, N_row, N_col
         self.cube_LWH = cube_LWH # the size of volume of 3D grid, length, width and height
         self.reduced_grid_size = (np.array(self.world_size) // np.array(self.cube_LWH[:2])).astype(np.int32).tolist()
-        self.num_cam, self.num_frame = 7, 560
+        self.num_cam = 7
         self.ann_root = os.path.join(root, ann_root)
         self.img_root = os.path.join(root, img_root)
         self.calib_root = os.path.join(root, calib_root)
         self.label_names = MULTIVIEWC_BBOX_LABEL_NAMES
-        self.intrinsic_matrices, self.extrinsic_matrices, self.R_z = zip(
-            *[self.get_intrinsic_extrinsic_matrix(cam, root=self.calib_root) for cam in range(self.num_cam)])
 
-        self.RGK = RotationGaussianKernel(save_dir=r'vfa/data/mc_RGK.npy')
-        self.GK = GaussianKernel(save_dir=r'vfa/data/mc_GK.npy')
+        # The derived artifacts are named by the fingerprint of their params, and updated with the annotation 
+        # files appended to the recording since the last start, see `ArtifactCache.delta`
+        self.ann_paths = [ os.path.join(self.ann_root, p) for p in sorted(os.listdir(self.ann_root)) ]
+        self.num_frame = len(self.ann_paths) # 560 frames of MultiviewC
+        self.cache = ArtifactCache(cache_root)
+        self.index = self.load_index()
+        self.intrinsic_matrices, self.extrinsic_matrices, self.R_z = \
+            tuple(self.index.calib('intrinsic')), tuple(self.index.calib('extrinsic')), tuple(self.index.calib('R_z'))
+        self.RGK = RotationGaussianKernel(save_dir=None, dtype=heatmap_dtype)
+        self.GK = GaussianKernel(save_dir=None, dtype=heatmap_dtype)
+        heatmap_fingerprint = self.cache.fingerprint(root, [], world_size=self.world_size, 
+                                                     reduced_grid_size=self.reduced_grid_size, alpha=self.RGK.alpha, 
+                                                     GKRatio=self.RGK.GKRatio, grid_reduce=self.GK.grid_reduce, 
+                                                     dtype=self.GK.dtype)
+        self.RGK.save_dir = self.cache.path('mc_RGK', heatmap_fingerprint, '.npy')
+        self.GK.save_dir = self.cache.path('mc_GK', heatmap_fingerprint, '.npy')
         self.reload_RGK=reload_RGK
-        self.classAverage = ClassAverage(classes=['Cow'])
+        self.with_heatmaps = with_heatmaps
+        self.classAverage = ClassAverage(classes=['Cow'], 
+                                         save_path=self.cache.path('ClsAvg', self.cache.fingerprint(root, []), '.json'))
         self.labels, self.heatmaps = self.download()
 
+    def load_index(self):
+        """
+            The annotation index of the labels, image paths and calibrations, compiled on the first start and 
+            refreshed with the new or modified annotation files on the next starts
+        """
+        calib_paths = [os.path.join(folder, fname) for folder, _, fnames in os.walk(self.calib_root) for fname in fnames]
+        img_folders = [os.path.join(self.img_root, 'C{}'.format(cam)) for cam in range(1, 1 + self.num_cam)]
+        path = self.cache.path('mc_index', self.cache.fingerprint(self.root, [], 
+                               calibrations=self.cache.annotation_stats(calib_paths)), '.idx')
+
+        def load_calibs():
+            intrinsic, extrinsic, R_z = zip(
+                *[self.get_intrinsic_extrinsic_matrix(cam, root=self.calib_root) for cam in range(self.num_cam)])
+            return {'intrinsic': np.stack(intrinsic), 'extrinsic': np.stack(extrinsic), 'R_z': np.array(R_z)}
+        return refresh_index(self.cache, path, self.ann_paths, parse_annotation, True, 
+                             lambda: self.list_image_fpaths(range(self.num_frame)), img_folders, load_calibs)
+
     def get_image_fpaths(self, frame_range):
+        return self.index.image_fpaths(frame_range, self.num_cam)
+
+    def list_image_fpaths(self, frame_range):
         img_fpaths = {cam: {} for cam in range(1, 1 + self.num_cam)}
         for cam in range(1, 1+self.num_cam):
             img_folder = os.path.join(self.img_root, 'C{}'.format(cam))
@@ -110,55 +151,83 @@ class MultiviewC(VisionDataset):
         return intrinsic_matrix, extrinsic_matrix, R_z
 
     def download(self):
-        ann_paths = [ os.path.join(self.ann_root, p) for p in sorted(os.listdir(self.ann_root)) ]
-        labels = list()
-        # if cls avg not exist (true), calculate the property of dataset, including mean, number and sum of dimension
-        BuildClsAvg = not os.path.exists(self.classAverage.save_path) 
-        # if RGK not exist (true), build RGK; else, load RGK from file
-        BuildRGK_GK = self.reload_RGK or not self.RGK.RGKExist() or not self.GK.GKExist()
-        with tqdm(total=len(ann_paths), postfix=dict, mininterval=0.3) as pbar:
-            for i, ann_path in enumerate(ann_paths):
-                with open(ann_path, 'r') as f:
-                    annotations = json.load(f)
-                cow_infos = list()
-                rgk_heatmap = np.zeros(self.reduced_grid_size, dtype=np.float32)
-                gk_heatmap = np.zeros(self.reduced_grid_size, dtype=np.float32)
-                for cows in annotations['C1']:
-                    location = cows['location']
-                    dimension = cows['dimension']
-                    rotation = np.deg2rad(cows['rotation']) # -180~180 => -pi~pi 
-                    cow_infos.append(Obj3D(classname='Cow', dimension=dimension, 
-                                        location=location, rotation=rotation, conf=None))
-                    if BuildRGK_GK:
-                        x, y, _ = location
-                        _, w, l = dimension
-                        box_cx = x * self.reduced_grid_size[0] / self.world_size[0]
-                        box_cy = y * self.reduced_grid_size[1] / self.world_size[1]
-                        rgk_heatmap = self.RGK.gaussian_kernel_heatmap(rgk_heatmap, box_cx, box_cy, l, w, cows['rotation'])
-                        gk_heatmap = self.GK.gaussian_kernel_heatmap(gk_heatmap, box_cx, box_cy)
-                    if BuildClsAvg:
-                        self.classAverage.add_item('Cow', dimension)
-                if BuildRGK_GK:
-                    self.RGK.add_item(rgk_heatmap)
-                    self.GK.add_item(gk_heatmap)
-                labels.append(cow_infos)
-                pbar.set_postfix(**{ 'Process' : ' {} / {}'.format(i, len(ann_paths)),
-                                     'Fname' : ' {}'.format(os.path.basename(ann_path)) })
-                pbar.update(1)
-
-        if BuildClsAvg:
-            self.classAverage.dump_to_file()
-        else:
+        ann_paths = self.ann_paths
+        labels = self.index.labels()
+        # the frames to add to the cls avg, all frames if it does not exist or an annotation file is modified;
+        # the totals and counts of the new frames are added to the saved ones
+        delta = self.cache.delta(self.classAverage.save_path, ann_paths)
+        BuildClsAvg = delta is None or len(delta[0]) > 0
+        if not BuildClsAvg:
             self.classAverage.load_from_file()
-        if BuildRGK_GK:
-            # dump RGK to file
-            rgk_heatmaps = self.RGK.dump_to_file()
-            gk_heatmaps = self.GK.dump_to_file()
-        else:
-            rgk_heatmaps = self.RGK.load_from_file()
-            gk_heatmaps = self.GK.load_from_file()
+        new_frames = range(len(labels)) if BuildClsAvg else range(delta[1], len(labels))
+        if len(new_frames) > 0:
+            cows = ObjectBatch.cat([labels[frame] for frame in new_frames]).select(['Cow'])
+            self.classAverage.add_items('Cow', cows.dimension.numpy())
+            self.classAverage.dump_to_file()
+            self.cache.commit(self.classAverage.save_path, ann_paths)
+
+        if self.with_heatmaps:
+            self.update_heatmaps(labels)
             
+        if not self.with_heatmaps:
+            return labels, None
         if self.heatmap_type == 'RGK':
-            return labels, rgk_heatmaps
+            return labels, self.RGK.load_from_file()
         else:
-            return labels, gk_heatmaps
\ No newline at end of file
+            return labels, self.GK.load_from_file()
+
+    def update_heatmaps(self, labels):
+        """
+            Build RGK and GK of the new or modified frames, the other frames are copied from the previous files.
+            All frames are built if RGK or GK does not exist, or reload_RGK
+                labels: the ObjectBatch of every frame of the index, which the heatmaps are rendered from
+        """
+        ann_paths = self.ann_paths
+        delta = self.cache.delta(self.RGK.save_dir, ann_paths)
+        if self.reload_RGK or not self.RGK.RGKExist() or not self.GK.GKExist() or \
+           delta != self.cache.delta(self.GK.save_dir, ann_paths):
+            delta = None
+        todo = self.cache.changed(delta, len(ann_paths))
+        if delta is not None and len(todo) == 0:
+            return
+        # release the memory map of the loaded heatmaps, the files are replaced below
+        self.heatmaps = None
+        render = partial(render_heatmaps, reduced_grid_size=self.reduced_grid_size, world_size=self.world_size,
+                         RGK=self.RGK, GK=self.GK)
+        outputs = {'RGK': (self.RGK.save_dir, None), 'GK': (self.GK.save_dir, self.GK)}
+        previous = None if delta is None else \
+            {'RGK': self.RGK.load_from_file(mmap_mode='r'), 'GK': self.GK.load_from_file(mmap_mode='r')}
+        build_heatmaps(render, labels, outputs, self.reduced_grid_size, dtype=self.GK.dtype,
+                       previous=previous, todo=todo)
+        self.cache.commit(self.RGK.save_dir, ann_paths)
+        self.cache.commit(self.GK.save_dir, ann_paths)
+
+def parse_annotation(ann_path):
+    """
+        The cows of an annotation file, for `refresh_index`. It runs in the processes of `build_heatmaps`.
+    """
+    with open(ann_path, 'r') as f:
+        annotations = json.load(f)
+    cow_infos = list()
+    for cows in annotations['C1']:
+        location = cows['location']
+        dimension = cows['dimension']
+        rotation = np.deg2rad(cows['rotation']) # -180~180 => -pi~pi 
+        cow_infos.append(Obj3D(classname='Cow', dimension=dimension, 
+                            location=location, rotation=rotation, conf=None))
+    return cow_infos, dict()
+
+def render_heatmaps(objects, reduced_grid_size, world_size, RGK, GK):
+    """
+        The RGK heatmap and the GK occupancy map of the cows `objects` (ObjectBatch of a frame of the index),
+        thus the annotation files are not parsed again. It runs in the processes of `build_heatmaps`.
+    """
+    rgk_heatmap = np.zeros(reduced_grid_size, dtype=np.float32)
+    gk_heatmap = np.zeros(reduced_grid_size, dtype=np.float32)
+    for (x, y, _), (_, w, l), rotation in zip(objects.location.tolist(), objects.dimension.tolist(), 
+                                              objects.rotation.tolist()):
+        box_cx = x * reduced_grid_size[0] / world_size[0]
+        box_cy = y * reduced_grid_size[1] / world_size[1]
+        rgk_heatmap = RGK.gaussian_kernel_heatmap(rgk_heatmap, box_cx, box_cy, l, w, np.rad2deg(rotation))
+        gk_heatmap = GK.gaussian_kernel_heatmap(gk_heatmap, box_cx, box_cy)
+    return objects, {'RGK': rgk_heatmap, 'GK': gk_heatmap}
@@ -1,4 +1,5 @@
-import os, json, re, sys
+import os, json, re, sys, shutil
+from functools import partial
 sys.path.append(os.getcwd())
 import numpy as np
 import cv2
@@ -7,6 +8,9 @@ from torchvision.datasets import VisionDataset
 from scipy.sparse import coo_matrix
 from vfa.utils import Obj2D 
 from vfa.data.GK import GaussianKernel
+from vfa.data.heatmap_build import build_heatmaps
+from vfa.data.cache import ArtifactCache, atomic_save
+from vfa.data.index import refresh_index
 
 intrinsic_camera_matrix_filenames = ['intr_Camera1.xml', 'intr_Camera2.xml', 'intr_Camera3.xml', 'intr_Camera4.xml',
                                      'intr_Camera5.xml', 'intr_Camera6.xml']
@@ -23,7 +27,10 @@ class MultiviewX(VisionDataset):
                        img_size = [1080, 1920],
                        cube_LWH = [4, 4, 36], # need to scaled!
                        force_download=False, 
-                       reload_GK=False):
+                       heatmap_dtype=np.float32, # np.float16: half the size of the memory-mapped heatmaps
+                       with_heatmaps=True, # False: the heatmaps are not built, but rendered by ObjectEncoder
+                       reload_GK=False,
+                       cache_root=r'vfa/data/cache'): # the heatmaps and gt.txt, see `ArtifactCache`
         super().__init__(root)
         # MultiviewX has xy-indexing: H*W=640*1000, thus x is \in [0,1000), y \in [0,640)
         # MultiviewX has consistent unit: meter (m) for calibration & pos annotation
@@ -33,22 +40,55 @@ class MultiviewX(VisionDataset):
         self.grid_reduce, self.img_reduce = MultiviewX.grid_reduce, MultiviewX.img_reduce 
         self.reduced_grid_size = list(map(lambda x: int(x / self.grid_reduce), self.world_size)) # 160, 250
         self.reload_GK = reload_GK
+        self.with_heatmaps = with_heatmaps
         self.label_names = MULTIVIEWX_BBOX_LABEL_NAMES
-        self.intrinsic_matrices, self.extrinsic_matrices = zip(
-            *[self.get_intrinsic_extrinsic_matrix(cam) for cam in range(self.num_cam)])
 
-        self.GK = GaussianKernel(save_dir=r'vfa/data/mx_GK.npy')
+        # The derived artifacts are named by the fingerprint of their params, and updated with the annotation 
+        # files appended since the last start, see `ArtifactCache.delta`
+        self.ann_paths = [os.path.join(self.root, 'annotations_positions', fname) 
+                          for fname in sorted(os.listdir(os.path.join(self.root, 'annotations_positions')))]
+        self.cache = ArtifactCache(cache_root)
+        self.index = self.load_index()
+        self.intrinsic_matrices, self.extrinsic_matrices = tuple(self.index.calib('intrinsic')), tuple(self.index.calib('extrinsic'))
+        self.GK = GaussianKernel(save_dir=None, dtype=heatmap_dtype)
+        self.GK.save_dir = self.cache.path('mx_GK', self.cache.fingerprint(root, [], 
+                                           reduced_grid_size=self.reduced_grid_size, grid_reduce=self.grid_reduce, 
+                                           kernel_grid_reduce=self.GK.grid_reduce, dtype=self.GK.dtype), '.npy')
         # different from 3D detection task, we only focus on the location detection on MultiviewX 
         # # different from 3D detection task. Thus, `classAverage` is None by default.
         self.classAverage = None 
         self.labels, self.heatmaps = self.download()
 
         # Create gt.txt file to evaluate MODA, MODP, prec, rcll metrics
-        self.gt_fpath = os.path.join(self.root, 'gt.txt')
-        if not os.path.exists(self.gt_fpath) or force_download:
+        self.gt_fpath = self.cache.path('mx_gt', self.cache.fingerprint(root, [], num_cam=self.num_cam), '.txt')
+        delta = None if force_download else self.cache.delta(self.gt_fpath, self.ann_paths)
+        if delta is None or len(delta[0]) > 0:
             self.prepare_gt()
+        elif delta[1] < len(self.ann_paths):
+            self.prepare_gt(start=delta[1])
+
+    def load_index(self):
+        """
+            The annotation index of the labels, image paths and calibrations, compiled on the first start and 
+            refreshed with the new or modified annotation files on the next starts
+        """
+        calib_root = os.path.join(self.root, 'calibrations')
+        calib_paths = [os.path.join(folder, fname) for folder, _, fnames in os.walk(calib_root) for fname in fnames]
+        img_root = os.path.join(self.root, 'Image_subsets')
+        img_folders = [img_root] + [os.path.join(img_root, folder) for folder in sorted(os.listdir(img_root))]
+        path = self.cache.path('mx_index', self.cache.fingerprint(self.root, [], 
+                               calibrations=self.cache.annotation_stats(calib_paths)), '.idx')
+
+        def load_calibs():
+            intrinsic, extrinsic = zip(*[self.get_intrinsic_extrinsic_matrix(cam) for cam in range(self.num_cam)])
+            return {'intrinsic': np.stack(intrinsic), 'extrinsic': np.stack(extrinsic)}
+        return refresh_index(self.cache, path, self.ann_paths, parse_annotation, False, 
+                             lambda: self.list_image_fpaths(range(self.num_frame)), img_folders, load_calibs)
 
     def get_image_fpaths(self, frame_range):
+        return self.index.image_fpaths(frame_range, self.num_cam)
+
+    def list_image_fpaths(self, frame_range):
         img_fpaths = {cam: {} for cam in range(1, self.num_cam+1)}
         for camera_folder in sorted(os.listdir(os.path.join(self.root, 'Image_subsets'))):
             cam = int(camera_folder[-1]) 
@@ -135,11 +175,14 @@ class MultiviewX(VisionDataset):
                                                      min(right, 1920 - 1), min(bottom, 1080 - 1)]
         return bbox_by_pos_cam
 
-    def prepare_gt(self):
+    def prepare_gt(self, start=0):
+        """
+            start: the rows of the annotation files from `start` on are appended to gt.txt. 0: write all rows
+        """
         og_gt = []
-        for fname in sorted(os.listdir(os.path.join(self.root, 'annotations_positions'))):
-            frame = int(fname.split('.')[0])
-            with open(os.path.join(self.root, 'annotations_positions', fname)) as json_file:
+        for ann_path in self.ann_paths[start:]:
+            frame = int(os.path.basename(ann_path).split('.')[0])
+            with open(ann_path) as json_file:
                 all_pedestrians = json.load(json_file)
             for single_pedestrian in all_pedestrians:
                 def is_in_cam(cam):
@@ -151,47 +194,62 @@ class MultiviewX(VisionDataset):
                 in_cam_range = sum(is_in_cam(cam) for cam in range(self.num_cam))
                 if not in_cam_range:
                     continue
-                grid_x, grid_y = self.base.get_worldgrid_from_pos(single_pedestrian['positionID'])
+                grid_x, grid_y = self.get_worldgrid_from_pos(single_pedestrian['positionID'])
                 og_gt.append(np.array([frame, grid_x, grid_y]))
-        og_gt = np.stack(og_gt, axis=0)
+        og_gt = np.stack(og_gt, axis=0) if len(og_gt) > 0 else np.zeros((0, 3), dtype=int)
         os.makedirs(os.path.dirname(self.gt_fpath), exist_ok=True)
-        np.savetxt(self.gt_fpath, og_gt, '%d')
+
+        def save(path):
+            with open(path, 'wb') as f:
+                if start > 0:
+                    with open(self.gt_fpath, 'rb') as gt:
+                        shutil.copyfileobj(gt, f)
+                np.savetxt(f, og_gt, '%d')
+        atomic_save(self.gt_fpath, save)
+        self.cache.commit(self.gt_fpath, self.ann_paths)
 
     # TODO: check: xy ? yx? Done, yx
     def download(self):
-
-        labels = list()
-        # if GK not exist (true), build GK; else, load GK from file. (GK: gaussian kernel heatmap)
-        BuildGK = self.reload_GK or not self.GK.GKExist() 
-        for fname in sorted(os.listdir(os.path.join(self.root, 'annotations_positions'))):
-            # frame = int(fname.split('.')[0])
-            with open(os.path.join(self.root, 'annotations_positions', fname)) as json_file:
-                all_pedestrians = json.load(json_file)
-            i_s, j_s, v_s = [], [], []
-            man_infos = list()
-            
-            for single_pedestrian in all_pedestrians:
-                x, y = self.get_worldgrid_from_pos(single_pedestrian['positionID'])
-                location = np.array([x, y, np.zeros_like(x, dtype=x.dtype)])
-                man_infos.append(Obj2D(classname='Person', location=location, conf=None))
-
-                if BuildGK:
-                    i_s.append(int(y / self.grid_reduce))
-                    j_s.append(int(x / self.grid_reduce))
-                    v_s.append(1)
-            if BuildGK:
-                occupancy_map = coo_matrix((v_s, (i_s, j_s)), shape=self.reduced_grid_size)
-                self.GK.add_item(occupancy_map.toarray())
-
-            labels.append(man_infos)
-            
-        if BuildGK:
-            # dump RGK to file
-            heatmaps = self.GK.dump_to_file()
-        else:
-            heatmaps = self.GK.load_from_file()
+        ann_paths = self.ann_paths
+        labels = self.index.labels()
+        # if GK not exist (true), build GK; else, build GK of the new or modified frames. (GK: gaussian kernel heatmap)
+        delta = None if self.reload_GK or not self.GK.GKExist() else self.cache.delta(self.GK.save_dir, ann_paths)
+        todo = self.cache.changed(delta, len(ann_paths))
+        if self.with_heatmaps and (delta is None or len(todo) > 0):
+            # release the memory map of the loaded heatmaps, the file is replaced below
+            self.heatmaps = None
+            # rendered from the labels of the index, thus the annotation files are not parsed again
+            render = partial(render_heatmaps, reduced_grid_size=self.reduced_grid_size, grid_reduce=self.grid_reduce)
+            outputs = {'GK': (self.GK.save_dir, self.GK)}
+            previous = None if delta is None else {'GK': self.GK.load_from_file(mmap_mode='r')}
+            build_heatmaps(render, labels, outputs, self.reduced_grid_size, dtype=self.GK.dtype,
+                           previous=previous, todo=todo)
+            self.cache.commit(self.GK.save_dir, ann_paths)
+        heatmaps = self.GK.load_from_file() if self.with_heatmaps else None
         
         return labels, heatmaps
-                
-    
-    
\ No newline at end of file
+
+def parse_annotation(ann_path):
+    """
+        The pedestrians of an annotation file, for `refresh_index`. It runs in the processes of `build_heatmaps`.
+    """
+    with open(ann_path) as json_file:
+        all_pedestrians = json.load(json_file)
+    man_infos = list()
+    for single_pedestrian in all_pedestrians:
+        x, y = MultiviewX.get_worldgrid_from_pos(single_pedestrian['positionID'])
+        location = np.array([x, y, np.zeros_like(x, dtype=x.dtype)])
+        man_infos.append(Obj2D(classname='Person', location=location, conf=None))
+    return man_infos, dict()
+
+def render_heatmaps(objects, reduced_grid_size, grid_reduce=4):
+    """
+        The occupancy map of the pedestrians `objects` (ObjectBatch of a frame of the index), thus the 
+        annotation files are not parsed again. It runs in the processes of `build_heatmaps`.
+    """
+    i_s, j_s = [], []
+    for x, y, _ in objects.location.tolist():
+        i_s.append(int(y / grid_reduce))
+        j_s.append(int(x / grid_reduce))
+    occupancy_map = coo_matrix(([1] * len(i_s), (i_s, j_s)), shape=reduced_grid_size)
+    return objects, {'GK': occupancy_map.toarray()}
@@ -34,6 +34,18 @@ def triangle_label(label, num_class, raduius=4):
 
     return np.concatenate([y_sig[-label:], y_sig[:-label]], axis=0)
 
+def bin_residual_label(label, num_bins):
+    """
+        The angles `label` (degree, array of any shape) as their bins out of `num_bins` equal bins over
+        360 degrees and the residuals (radian) to the centers of the bins. 
+        Return [bin, sin(residual), cos(residual)] in the last axis
+    """
+    bin_width = 360. / num_bins
+    label = np.mod(label, 360.)
+    index = np.minimum(np.floor(label / bin_width), num_bins - 1)
+    residual = np.deg2rad(label - (index + 0.5) * bin_width)
+    return np.stack([index, np.sin(residual), np.cos(residual)], axis=-1)
+
 if __name__ == '__main__':
     cls_label = gaussian_label(30, 360)
     print(cls_label.shape)
\ No newline at end of file
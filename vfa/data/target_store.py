@@ -0,0 +1,78 @@
+import os, sys, shutil, hashlib, pickle
+sys.path.append(os.getcwd())
+import torch
+import numpy as np
+from tqdm import tqdm
+
+"""
+#--------------------------------------#
+-        Store of encoded targets      -
+#--------------------------------------#
+    The regression targets of the positive cells (see `ObjectEncoder.encode_positives`) only depend on the
+    annotations of a split and the config of the encoder. TargetStore encodes all frames once and saves the
+    targets of all frames as flat arrays in `root/<config hash>`, which every DataLoader worker memory-maps.
+    Another config or other annotations make another hash, thus a store is never read for the wrong targets.
+"""
+class TargetStore(object):
+    def __init__(self, root, encoder, dataset, chunk=256):
+        self.path = os.path.join(root, self.config_hash(encoder, dataset))
+        if not os.path.exists(os.path.join(self.path, 'offsets.npy')):
+            self.build(encoder, dataset, chunk)
+        # memory-mapped on the first read of every process
+        self.arrays = None
+
+    @staticmethod
+    def config_hash(encoder, dataset):
+        config = [dataset.base.__name__, tuple(dataset.world_size), np.asarray(dataset.cube_LWH).tolist(),
+                  tuple(dataset.grid.shape), dataset.frame_range, encoder.classname, encoder.angle_range,
+                  encoder.angle_radius, encoder.angle_mode, encoder.angle_bins]
+        if encoder.three_d:
+            config.append(np.asarray(dataset.classAverage.get_mean(encoder.classname[0])).tolist())
+        digest = hashlib.sha1(repr(config).encode())
+        digest.update(pickle.dumps(dataset.labels))
+        return digest.hexdigest()[:16]
+
+    def build(self, encoder, dataset, chunk):
+        grid = dataset.grid[None]
+        arrays, counts = dict(), list()
+        for start in tqdm(range(0, len(dataset.labels), chunk), desc='Encode targets'):
+            labels = dataset.labels[start:start + chunk]
+            positives = encoder.encode_positives(labels, grid.expand(len(labels), *grid.shape[1:]))
+            # the positives are in the order of frames, the frame of every cell is kept by `offsets`
+            counts.append(torch.bincount(positives['index'][:, 0], minlength=len(labels)))
+            positives['index'] = positives['index'][:, 1]
+            for key, value in positives.items():
+                arrays.setdefault(key, list()).append(value.numpy())
+        arrays = {key: np.concatenate(value) for key, value in arrays.items()}
+        arrays['offsets'] = np.concatenate([[0], np.cumsum(torch.cat(counts).numpy())])
+
+        # Write into a temporary directory and rename it, thus the store is either complete or missing
+        temp = '{}.{}.tmp'.format(self.path, os.getpid())
+        os.makedirs(temp, exist_ok=True)
+        for key, value in arrays.items():
+            np.save(os.path.join(temp, key + '.npy'), value)
+        try:
+            os.replace(temp, self.path)
+        except OSError:
+            # another process has built the same store
+            shutil.rmtree(temp, ignore_errors=True)
+
+    def __getstate__(self):
+        # the workers map the arrays by themselves
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def __getitem__(self, index):
+        """
+            The positives of the `index`-th frame as a batch of one, see `ObjectEncoder.encode_positives`
+        """
+        if self.arrays is None:
+            self.arrays = {os.path.splitext(name)[0]: np.load(os.path.join(self.path, name), mmap_mode='r')
+                           for name in os.listdir(self.path)}
+        start, end = self.arrays['offsets'][index], self.arrays['offsets'][index + 1]
+        positives = {key: torch.from_numpy(np.array(value[start:end]))
+                     for key, value in self.arrays.items() if key != 'offsets'}
+        cell = positives.pop('index')
+        positives['index'] = torch.stack([torch.zeros_like(cell), cell], dim=-1)
+        return positives
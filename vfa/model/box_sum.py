@@ -0,0 +1,221 @@
+import os
+import warnings
+import torch
+import torch.nn.functional as F
+
+"""
+#--------------------------------------#
+-    Box sum through integral image    -
+#--------------------------------------#
+    The feature of a voxel in VFA is the sum of feature inside its projected box, which is read from
+    the integral image at the four box corners. `box_sum` is the autograd Function `BoxSum` with a
+    hand-written backward, so autograd does not keep the integral image and the sampled corners.
+    On CPU, its forward and backward call the ops `vfa::box_sum` and `vfa::box_sum_backward` of the native
+    kernel (csrc/box_sum.cpp), which is compiled on first use. If it can not be compiled or the tensors
+    are not on CPU, BoxSum computes the same sums in PyTorch instead, which is a plain Python function
+    rather than a registered op.
+    `box_sum_gather` reads the integral image at the corners rounded to whole pixels instead, which is
+    cheaper but approximate, see `corner_index` and the parity check at the bottom of this file.
+"""
+# format of box corners: Left, Top, Right, Bottom
+# sum = left_top + right_btm - right_top - left_btm
+CORNERS = [(0, 1), (2, 3), (2, 1), (0, 3)]
+CORNER_SIGNS = [1., 1., -1., -1.]
+
+_native = None # None: not loaded yet, False: unavailable
+
+def load_native():
+    global _native
+    if _native is None:
+        try:
+            from torch.utils.cpp_extension import load
+            load(name='vfa_box_sum',
+                 sources=[os.path.join(os.path.dirname(os.path.abspath(__file__)), 'csrc', 'box_sum.cpp')],
+                 extra_cflags=['-O3'], is_python_module=False, verbose=False)
+            _native = True
+        except Exception as e:
+            warnings.warn('Native box sum is unavailable, fall back to PyTorch. {}'.format(e))
+            _native = False
+    return _native
+
+def integral_image(features):
+    return torch.cumsum(torch.cumsum(features, dim=-1), dim=-2)
+
+def reverse_cumsum(tensor, dim):
+    return torch.flip(torch.cumsum(torch.flip(tensor, [dim]), dim), [dim])
+
+def bilinear_taps(gx, gy, height, width):
+    """
+        The four taps of F.grid_sample(mode='bilinear', padding_mode='zeros', align_corners=False)
+            gx, gy: normalized coordinates in [-1, 1]
+        Return a list of (index, weight) where index is the flat index into the (height * width) image.
+        The taps outside of the image have zero weight.
+    """
+    x = ((gx + 1) * width - 1) / 2
+    y = ((gy + 1) * height - 1) / 2
+    x0, y0 = torch.floor(x), torch.floor(y)
+    x1, y1 = x0 + 1, y0 + 1
+    taps = list()
+    for xi, yi, weight in [(x0, y0, (x1 - x) * (y1 - y)), (x1, y0, (x - x0) * (y1 - y)),
+                           (x0, y1, (x1 - x) * (y - y0)), (x1, y1, (x - x0) * (y - y0))]:
+        inside = (xi >= 0) & (xi < width) & (yi >= 0) & (yi < height)
+        index = (yi.clamp(0, height - 1) * width + xi.clamp(0, width - 1)).long()
+        taps.append((index, weight * inside))
+    return taps
+
+def box_sum_torch(feature, box_corners):
+    # feature: (B, C, H, W), box_corners: (B, nl, K, 4) => (B, C, nl, K)
+    intergral_img = integral_image(feature)
+    box_features = F.grid_sample(intergral_img, box_corners[..., [0, 1]], align_corners=False)
+    box_features += F.grid_sample(intergral_img, box_corners[..., [2, 3]], align_corners=False)
+    box_features -= F.grid_sample(intergral_img, box_corners[..., [2, 1]], align_corners=False)
+    box_features -= F.grid_sample(intergral_img, box_corners[..., [0, 3]], align_corners=False)
+    return box_features
+
+def box_sum_backward_torch(grad_output, box_corners, height, width):
+    # grad_output: (B, C, nl, K), box_corners: (B, nl, K, 4) => (B, C, H, W)
+    batch, channel = grad_output.shape[:2]
+    grad_output = grad_output.flatten(2) # (B, C, nl*K)
+    box_corners = box_corners.flatten(1, 2) # (B, nl*K, 4)
+    grad_integral = grad_output.new_zeros(batch, channel, height * width)
+    # Spread the gradient of every box to the bilinear taps of its four corners
+    for (ix, iy), sign in zip(CORNERS, CORNER_SIGNS):
+        for index, weight in bilinear_taps(box_corners[..., ix], box_corners[..., iy], height, width):
+            grad_integral.scatter_add_(2, index[:, None, :].expand(-1, channel, -1),
+                                       grad_output * (sign * weight[:, None, :]))
+    grad_integral = grad_integral.view(batch, channel, height, width)
+    # The transpose of the integral image is the reversed cumulative sum on both axes
+    return reverse_cumsum(reverse_cumsum(grad_integral, -2), -1)
+
+def corner_index(box_corners, height, width):
+    """
+        Flat indices of the four box corners into the zero-padded integral image of size (height+1, width+1).
+            box_corners: (B, nl, K, 4) normalized to [-1, 1], format: Left, Top, Right, Bottom
+        The corners are rounded to the nearest pixel, and every box keeps at least one pixel.
+        Return the indices (B, 4, nl*K) in the order of `CORNERS` and the pixels of the rounded boxes 
+        (B, 1, nl, K), which average the box sums instead of the area of the exact boxes. Otherwise,
+        the boxes smaller than a pixel would be rounded to an empty or a whole pixel and then divided 
+        by their sub-pixel area.
+    """
+    batch, num_layer = box_corners.shape[:2]
+    box_corners = box_corners.flatten(1, 2) # (B, nl*K, 4)
+    # +1 for the zero row and column in front of the integral image
+    x = (torch.floor(((box_corners[..., [0, 2]] + 1) * width - 1) / 2 + 0.5) + 1).clamp(0, width).long()
+    y = (torch.floor(((box_corners[..., [1, 3]] + 1) * height - 1) / 2 + 0.5) + 1).clamp(0, height).long()
+    x0 = x[..., 0].clamp(max=width - 1)
+    y0 = y[..., 0].clamp(max=height - 1)
+    x = torch.stack([x0, torch.max(x[..., 1], x0 + 1)], dim=-1)
+    y = torch.stack([y0, torch.max(y[..., 1], y0 + 1)], dim=-1)
+    index = [y[..., iy // 2] * (width + 1) + x[..., ix // 2] for ix, iy in CORNERS]
+    pixels = ((x[..., 1] - x[..., 0]) * (y[..., 1] - y[..., 0])).view(batch, 1, num_layer, -1)
+    return torch.stack(index, dim=1), pixels
+
+def box_sum_gather(feature, corner_index, num_layer):
+    """
+        Sum `feature` inside the boxes by gathering the integral image at integer corners.
+            feature: (B, C, H, W)
+            corner_index: (B, 4, nl*K) the indices from `corner_index`
+        Return box features (B, C, nl, K)
+    """
+    batch, channel = feature.shape[:2]
+    intergral_img = F.pad(integral_image(feature), [1, 0, 1, 0]).flatten(2) # (B, C, (H+1)*(W+1))
+    def read(corner):
+        return torch.gather(intergral_img, 2, corner_index[:, None, corner].expand(-1, channel, -1))
+    # the corners are accumulated in place, since gather does not need its output for backward 
+    box_features = read(0)
+    box_features += read(1)
+    box_features -= read(2)
+    box_features -= read(3)
+    return box_features.view(batch, channel, num_layer, -1)
+
+class BoxSum(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, feature, box_corners, native):
+        box_corners = box_corners.to(feature.dtype).contiguous()
+        ctx.save_for_backward(box_corners)
+        ctx.feature_size, ctx.native = feature.shape[-2:], native
+        if native:
+            return torch.ops.vfa.box_sum(feature, box_corners)
+        with torch.no_grad():
+            return box_sum_torch(feature, box_corners)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        box_corners, = ctx.saved_tensors
+        height, width = ctx.feature_size
+        if ctx.native:
+            grad_feature = torch.ops.vfa.box_sum_backward(grad_output.contiguous(), box_corners, height, width)
+        else:
+            grad_feature = box_sum_backward_torch(grad_output, box_corners, height, width)
+        # the box corners are projected from the calibration, which is not learnable
+        return grad_feature, None, None
+
+def box_sum(feature, box_corners, native=True):
+    """
+        Sum `feature` inside the boxes through the integral image.
+            feature: (B, C, H, W)
+            box_corners: (B, nl, K, 4) normalized to [-1, 1], format: Left, Top, Right, Bottom
+            native: use the native CPU kernel if it is available
+        Return box features (B, C, nl, K)
+    """
+    native = native and feature.device.type == 'cpu' and load_native()
+    return BoxSum.apply(feature, box_corners, native)
+
+if __name__ == '__main__':
+    # Parity of the samplers of VFA.aggregate and of their gradients against `grid_sample` on the geometry of
+    # a ring of 7 cameras around the MultiviewC field, run from the root of the repository
+    import sys, math, types
+    sys.path.append(os.getcwd())
+    from vfa.model.vfa_op import VFA
+    from vfa.utils import make_grid
+    torch.manual_seed(0)
+    image_height, image_width = 720, 1280
+    intrinsic = torch.tensor([[900., 0, image_width / 2], [0, 900., image_height / 2], [0, 0, 1]], dtype=torch.float64)
+    calibs = list()
+    for cam in range(7):
+        angle = 2 * math.pi * cam / 7
+        center = torch.tensor([1950 + 2600 * math.cos(angle), 1950 + 2600 * math.sin(angle), 900 + 100 * cam], dtype=torch.float64)
+        # look at the center of the field, x: right, y: down, z: forward
+        forward = F.normalize(torch.tensor([1950., 1950., 0.], dtype=torch.float64) - center, dim=0)
+        right = F.normalize(torch.linalg.cross(forward, forward.new_tensor([0., 0., 1.])), dim=0)
+        rotation = torch.stack([right, torch.linalg.cross(forward, right), forward])
+        calibs.append(intrinsic @ torch.cat([rotation, -rotation @ center[:, None]], dim=1))
+    calibs = torch.stack(calibs)
+    grid = make_grid(world_size=(3900, 3900), cube_LW=[25, 25], dataset='MultiviewC')[None, ::2, ::2].double()
+    args = types.SimpleNamespace(data='MultiviewC', image_size=(image_height, image_width))
+
+    for feat_scale in [1 / 8., 1 / 16., 1 / 32.]:
+        vfa = VFA(channel=32, feat_scale=feat_scale, args=args).double()
+        geometry = vfa.geometry(calibs, grid)
+        height, width = math.ceil(image_height * feat_scale), math.ceil(image_width * feat_scale)
+        # the features of the backbone are smooth, thus upsampled noise rather than noise per pixel
+        feature = F.interpolate(torch.rand(7, 32, height // 4, width // 4, dtype=torch.float64), (height, width), mode='bilinear')
+        area = geometry.box_area * height * width + 1e-6
+        weight = torch.rand(1, 32, *geometry.box_area.shape[2:], dtype=torch.float64)
+        outputs, grads = dict(), dict()
+        for sampler in ['grid_sample', 'native', 'torch', 'gather']:
+            vfa.sampler = sampler
+            with torch.no_grad():
+                outputs[sampler] = vfa.aggregate(feature, geometry)
+            # the gradient of the features through the box features of the sampler
+            leaf = feature.clone().requires_grad_()
+            (vfa.box_features(leaf, geometry.box_corners, area.clone(), geometry.visible, geometry) * weight).sum().backward()
+            grads[sampler] = leaf.grad
+        reference, grad_reference = outputs['grid_sample'], grads['grid_sample']
+        for sampler in ['native', 'torch']:
+            # the same box sum up to the rounding of float64
+            assert torch.allclose(outputs[sampler], reference, atol=1e-8, rtol=1e-6), sampler
+            assert torch.allclose(grads[sampler], grad_reference, atol=1e-8 * grad_reference.abs().max().item(), rtol=1e-6), sampler
+
+        # gather rounds the corners to whole pixels, thus it is approximate
+        scale = reference.abs().max()
+        error = (outputs['gather'] - reference).abs()
+        # the gradient of every box is spread over the rounded box instead of the bilinear taps of the exact
+        # box, thus it moves to the neighbour pixels, but the total of each camera and channel is kept
+        grad_error = (grads['gather'] - grad_reference).abs().sum() / grad_reference.abs().sum()
+        totals = grads['gather'].sum(dim=(2, 3)) / grad_reference.sum(dim=(2, 3))
+        print('gather 1/{:d}: max error {:.4f}, mean error {:.5f} of max feature {:.4f}, gradient error {:.4f}'.format(
+              round(1 / feat_scale), error.max().item(), error.mean().item(), scale.item(), grad_error.item()))
+        assert error.max() < 0.2 * scale and error.mean() < 0.01 * scale, 'gather'
+        assert grad_error < 0.25 and torch.allclose(totals, torch.ones_like(totals), atol=1e-4), 'gather gradient'
+    print('passed')
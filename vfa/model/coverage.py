@@ -0,0 +1,55 @@
+import os, sys
+sys.path.append(os.getcwd())
+import torch
+import numpy as np
+from matplotlib.path import Path
+from vfa.model.vfa_op import ProjectionCache
+
+"""
+#--------------------------------------#
+-        Coverage mask of a rig        -
+#--------------------------------------#
+    A cell of the grid is covered if at least one camera sees one of its voxels, which is the `visible`
+    mask of the VFA projection, and it lies inside the optional field polygon. The mask is computed once
+    for each rig and grid. VFA does not sample the voxels outside of the field, VFANet only runs VFA and
+    the heads around the covered cells, and ObjectEncoder does not decode the uncovered cells.
+"""
+class CoverageMask(object):
+    def __init__(self, polygon=None, max_entries=8):
+        """
+            polygon: (N, 2) vertices of the field in the coordinates of the grid from `make_grid`
+                     (before converting to the world coordinates), None: the whole grid is in the field
+        """
+        self.polygon = None if polygon is None else Path(np.asarray(polygon, dtype=np.float64))
+        # the vertices identify the mask, e.g. in the key of CompiledVFA
+        self.key = None if polygon is None else tuple(map(tuple, np.asarray(polygon, dtype=np.float64).tolist()))
+        self.cache = ProjectionCache(max_entries)
+
+    def field(self, grid):
+        """
+            The cells of grid (1, L, W, 3) inside the field polygon (L, W)
+        """
+        if self.polygon is None:
+            return torch.ones(grid.shape[1:3], dtype=torch.bool, device=grid.device)
+        key = ('field', self.cache.digests(grid))
+        inside = self.cache.get(key)
+        if inside is None:
+            points = grid[0, ..., :2].detach().cpu().double().numpy().reshape(-1, 2)
+            inside = torch.from_numpy(self.polygon.contains_points(points)).view(grid.shape[1:3]).to(grid.device)
+            self.cache.put(key, inside)
+        return inside
+
+    @torch.no_grad()
+    def __call__(self, vfa, calib, grid, crange=(-1, 0.95)):
+        """
+            The cells of grid (1, L, W, 3) covered by the cameras `calib` (N, 3, 4) and the field (L, W)
+        """
+        key = vfa.cache.make_key(calib, grid, vfa.cube_size, vfa.grid_height,
+                                 vfa.args.image_size, crange, vfa.args.data)
+        covered = self.cache.get(key)
+        if covered is None:
+            geometry = vfa.geometry(calib, grid, crange)
+            seen = geometry.visible[:, 0].any(dim=1).any(dim=0) # (L*W)
+            covered = seen.view(geometry.length, geometry.width) & self.field(grid)
+            self.cache.put(key, covered)
+        return covered
@@ -0,0 +1,171 @@
+// Box sum of feature maps through the integral image, on CPU.
+// The integral image is sampled at the four box corners with the semantics of
+// F.grid_sample(mode='bilinear', padding_mode='zeros', align_corners=False).
+#include <torch/library.h>
+#include <ATen/ATen.h>
+#include <ATen/Dispatch.h>
+#include <ATen/Parallel.h>
+#include <cmath>
+#include <vector>
+
+// corner format: (x, y) index pairs of Left, Top, Right, Bottom
+// sum = left_top + right_btm - right_top - left_btm
+static const int CORNER_X[4] = {0, 2, 2, 0};
+static const int CORNER_Y[4] = {1, 3, 1, 3};
+static const int CORNER_SIGN[4] = {1, 1, -1, -1};
+
+template <typename scalar_t>
+static void box_taps(const scalar_t* boxes, int64_t num_voxel, int64_t height, int64_t width,
+                     std::vector<int64_t>& index, std::vector<scalar_t>& weight) {
+    // The 16 bilinear taps (4 corners x 4 neighbours) of every box with the corner sign folded into the weight.
+    // The taps are shared by all channels.
+    index.resize(num_voxel * 16);
+    weight.resize(num_voxel * 16);
+    for (int64_t m = 0; m < num_voxel; ++m) {
+        const scalar_t* box = boxes + m * 4;
+        for (int c = 0; c < 4; ++c) {
+            // unnormalize the grid coordinates, align_corners=False
+            scalar_t x = ((box[CORNER_X[c]] + 1) * width - 1) / 2;
+            scalar_t y = ((box[CORNER_Y[c]] + 1) * height - 1) / 2;
+            int64_t x0 = static_cast<int64_t>(std::floor(x));
+            int64_t y0 = static_cast<int64_t>(std::floor(y));
+            int64_t x1 = x0 + 1, y1 = y0 + 1;
+            const int64_t xs[4] = {x0, x1, x0, x1};
+            const int64_t ys[4] = {y0, y0, y1, y1};
+            const scalar_t ws[4] = {(x1 - x) * (y1 - y), (x - x0) * (y1 - y),
+                                    (x1 - x) * (y - y0), (x - x0) * (y - y0)};
+            for (int t = 0; t < 4; ++t) {
+                bool inside = xs[t] >= 0 && xs[t] < width && ys[t] >= 0 && ys[t] < height;
+                // zeros padding: the taps outside of the image do not contribute
+                index[m * 16 + c * 4 + t] = inside ? ys[t] * width + xs[t] : 0;
+                weight[m * 16 + c * 4 + t] = inside ? CORNER_SIGN[c] * ws[t] : scalar_t(0);
+            }
+        }
+    }
+}
+
+template <typename scalar_t>
+static void integral_image(const scalar_t* feature, scalar_t* integral, int64_t height, int64_t width) {
+    // Same order as torch.cumsum(torch.cumsum(feature, dim=-1), dim=-2)
+    for (int64_t y = 0; y < height; ++y) {
+        double acc = 0;
+        for (int64_t x = 0; x < width; ++x) {
+            acc += feature[y * width + x];
+            integral[y * width + x] = static_cast<scalar_t>(acc);
+        }
+    }
+    for (int64_t x = 0; x < width; ++x) {
+        double acc = 0;
+        for (int64_t y = 0; y < height; ++y) {
+            acc += integral[y * width + x];
+            integral[y * width + x] = static_cast<scalar_t>(acc);
+        }
+    }
+}
+
+at::Tensor box_sum_forward(const at::Tensor& feature_, const at::Tensor& boxes_) {
+    // feature: (B, C, H, W), boxes: (B, nl, K, 4) => output: (B, C, nl, K)
+    TORCH_CHECK(feature_.dim() == 4, "feature must be (B, C, H, W)");
+    TORCH_CHECK(boxes_.dim() == 4 && boxes_.size(3) == 4, "boxes must be (B, nl, K, 4)");
+    TORCH_CHECK(feature_.size(0) == boxes_.size(0), "feature and boxes must have the same batch size");
+    at::Tensor feature = feature_.contiguous();
+    at::Tensor boxes = boxes_.to(feature.scalar_type()).contiguous();
+
+    const int64_t batch = feature.size(0), channel = feature.size(1);
+    const int64_t height = feature.size(2), width = feature.size(3);
+    const int64_t num_layer = boxes.size(1), num_box = boxes.size(2);
+    const int64_t num_voxel = num_layer * num_box;
+    at::Tensor output = at::empty({batch, channel, num_layer, num_box}, feature.options());
+
+    AT_DISPATCH_FLOATING_TYPES(feature.scalar_type(), "box_sum_forward", [&] {
+        const scalar_t* feature_ptr = feature.data_ptr<scalar_t>();
+        const scalar_t* boxes_ptr = boxes.data_ptr<scalar_t>();
+        scalar_t* output_ptr = output.data_ptr<scalar_t>();
+        std::vector<int64_t> index;
+        std::vector<scalar_t> weight;
+        for (int64_t b = 0; b < batch; ++b) {
+            box_taps(boxes_ptr + b * num_voxel * 4, num_voxel, height, width, index, weight);
+            at::parallel_for(0, channel, 1, [&](int64_t begin, int64_t end) {
+                std::vector<scalar_t> integral(height * width);
+                for (int64_t c = begin; c < end; ++c) {
+                    const int64_t plane = b * channel + c;
+                    integral_image(feature_ptr + plane * height * width, integral.data(), height, width);
+                    scalar_t* out = output_ptr + plane * num_voxel;
+                    for (int64_t m = 0; m < num_voxel; ++m) {
+                        scalar_t value = 0;
+                        for (int64_t j = m * 16; j < m * 16 + 16; ++j) {
+                            value += integral[index[j]] * weight[j];
+                        }
+                        out[m] = value;
+                    }
+                }
+            });
+        }
+    });
+    return output;
+}
+
+at::Tensor box_sum_backward(const at::Tensor& grad_, const at::Tensor& boxes_, int64_t height, int64_t width) {
+    // grad: (B, C, nl, K), boxes: (B, nl, K, 4) => grad of feature: (B, C, H, W)
+    at::Tensor grad = grad_.contiguous();
+    at::Tensor boxes = boxes_.to(grad.scalar_type()).contiguous();
+
+    const int64_t batch = grad.size(0), channel = grad.size(1);
+    const int64_t num_voxel = grad.size(2) * grad.size(3);
+    at::Tensor grad_feature = at::empty({batch, channel, height, width}, grad.options());
+
+    AT_DISPATCH_FLOATING_TYPES(grad.scalar_type(), "box_sum_backward", [&] {
+        const scalar_t* grad_ptr = grad.data_ptr<scalar_t>();
+        const scalar_t* boxes_ptr = boxes.data_ptr<scalar_t>();
+        scalar_t* grad_feature_ptr = grad_feature.data_ptr<scalar_t>();
+        std::vector<int64_t> index;
+        std::vector<scalar_t> weight;
+        for (int64_t b = 0; b < batch; ++b) {
+            box_taps(boxes_ptr + b * num_voxel * 4, num_voxel, height, width, index, weight);
+            at::parallel_for(0, channel, 1, [&](int64_t begin, int64_t end) {
+                std::vector<double> grad_integral(height * width);
+                for (int64_t c = begin; c < end; ++c) {
+                    const int64_t plane = b * channel + c;
+                    std::fill(grad_integral.begin(), grad_integral.end(), 0.);
+                    // Spread the gradient of every box to the bilinear taps of its four corners
+                    const scalar_t* g = grad_ptr + plane * num_voxel;
+                    for (int64_t m = 0; m < num_voxel; ++m) {
+                        if (g[m] == 0) {
+                            continue;
+                        }
+                        for (int64_t j = m * 16; j < m * 16 + 16; ++j) {
+                            grad_integral[index[j]] += g[m] * weight[j];
+                        }
+                    }
+                    // The transpose of the integral image is the reversed cumulative sum on both axes
+                    scalar_t* out = grad_feature_ptr + plane * height * width;
+                    for (int64_t y = height - 1; y >= 0; --y) {
+                        double acc = 0;
+                        for (int64_t x = width - 1; x >= 0; --x) {
+                            acc += grad_integral[y * width + x];
+                            grad_integral[y * width + x] = acc;
+                        }
+                    }
+                    for (int64_t x = 0; x < width; ++x) {
+                        double acc = 0;
+                        for (int64_t y = height - 1; y >= 0; --y) {
+                            acc += grad_integral[y * width + x];
+                            out[y * width + x] = static_cast<scalar_t>(acc);
+                        }
+                    }
+                }
+            });
+        }
+    });
+    return grad_feature;
+}
+
+TORCH_LIBRARY(vfa, m) {
+    m.def("box_sum(Tensor feature, Tensor boxes) -> Tensor");
+    m.def("box_sum_backward(Tensor grad, Tensor boxes, int height, int width) -> Tensor");
+}
+
+TORCH_LIBRARY_IMPL(vfa, CPU, m) {
+    m.impl("box_sum", &box_sum_forward);
+    m.impl("box_sum_backward", &box_sum_backward);
+}
@@ -30,32 +30,64 @@ def focal_loss(pred_heatmap, gt_heatmap, alpha=2., beta=4., eps=1e-5, reduction=
     else:
         return negative_loss + positive_loss
 
-def csl_angle_focal_loss(pred, gt, foreground, alpha=2., beta=4., eps=1e-5, reduction='mean'):
+def positives(batch_pred, batch_gt, key):
+    """
+        The prediction and the target of `key` at the positive cells, (M, C) each.
+        Sparse targets (see `ObjectEncoder`) are already at the positive cells, thus the prediction is
+        gathered at their `index`. Dense targets are masked by `mask`.
+    """
+    if 'index' in batch_gt:
+        index = batch_gt['index']
+        return batch_pred[key].flatten(1, 2)[index[:, 0], index[:, 1]], batch_gt[key]
+    mask = (batch_gt['mask'].squeeze(1) == 1.) # mask size: (B, 1, L, W)
+    return batch_pred[key][mask], batch_gt[key][mask]
+
+def csl_angle_focal_loss(pred, gt, alpha=2., beta=4., eps=1e-5, reduction='mean'):
     """
         Focal loss function for CSL angle prediction
+            pred, gt: (M, 360) of the positive samples
     """
     # Only focus on the positive samples' angle prediction
-    mask = (foreground.squeeze(0) == 1.) # foreground size: (1, 1, L, W)
-    pred = pred[mask]
-    gt = gt[mask]
-
+    if len(gt) == 0:
+        return pred.sum() * 0.
     return focal_loss(pred, gt, alpha, beta, eps, reduction)
 
+def bin_angle_loss(pred, gt, num_bins):
+    """
+        Cross entropy of the angle bin and smooth L1 of the sin/cos residual to the bin center
+            pred: (M, num_bins + 2), gt: (M, 3) [bin, sin(residual), cos(residual)] of the positive samples
+    """
+    # Only focus on the positive samples' angle prediction
+    if len(gt) == 0:
+        return pred.sum() * 0.
+
+    loss_bin = F.cross_entropy(pred[:, :num_bins], gt[:, 0].long())
+    loss_residual = F.smooth_l1_loss(pred[:, num_bins:], gt[:, 1:], reduction='sum') / len(gt)
+    return loss_bin + loss_residual
+
 
-def compute_loss3d(batch_pred, batch_gt, loss_weight=[1., 1., 1., 1.]):
+def compute_loss3d(batch_pred, batch_gt, loss_weight=[1., 1., 1., 1.], angle_mode='csl'):
     hm_weight, pos_weight, dim_weight, ang_weight = loss_weight
 
     loss_offset_yx_function = nn.SmoothL1Loss(reduction='none')
     loss_offset_hwl_function = nn.SmoothL1Loss(reduction='none')
     
-    batch_loss_offset_yx = loss_offset_yx_function(torch.sigmoid(batch_pred['loc_offset']), batch_gt['loc_offset']) * batch_gt['mask'].squeeze(0).unsqueeze(-1)
+    # The regressions and the angle are only supervised at the positive samples
+    pred_yx, gt_yx = positives(batch_pred, batch_gt, 'loc_offset')
+    pred_hwl, gt_hwl = positives(batch_pred, batch_gt, 'dim_offset')
+    pred_angle, gt_angle = positives(batch_pred, batch_gt, 'rotation')
+    batch_loss_offset_yx = loss_offset_yx_function(torch.sigmoid(pred_yx), gt_yx)
 
-    batch_loss_offset_hwl = loss_offset_hwl_function(batch_pred['dim_offset'], batch_gt['dim_offset']) * batch_gt['mask'].squeeze(0).unsqueeze(-1)
+    batch_loss_offset_hwl = loss_offset_hwl_function(pred_hwl, gt_hwl)
 
     batch_loss_heatmap = focal_loss(batch_pred['heatmap'], batch_gt['heatmap'], reduction='mean')
-    batch_loss_angle = csl_angle_focal_loss(batch_pred['rotation'], batch_gt['rotation'], batch_gt['mask'], reduction='mean')
+    if angle_mode == 'csl':
+        batch_loss_angle = csl_angle_focal_loss(pred_angle, gt_angle, reduction='mean')
+    else:
+        # the bin logits are followed by the sin/cos residual
+        batch_loss_angle = bin_angle_loss(pred_angle, gt_angle, pred_angle.shape[-1] - 2)
 
-    batch_num_positive_samples = batch_gt['mask'].sum()
+    batch_num_positive_samples = gt_yx.new_tensor(len(gt_yx))
     batch_num_positive_samples = torch.maximum(batch_num_positive_samples, torch.ones_like(batch_num_positive_samples))
 
     batch_loss_offset_yx /= batch_num_positive_samples
@@ -79,13 +111,15 @@ def compute_loss2d(batch_pred, batch_gt, loss_weight=[1., 1.]):
 
     loss_offset_yx_function = nn.SmoothL1Loss(reduction='none')  
     
-    batch_loss_offset_yx = loss_offset_yx_function(torch.sigmoid(batch_pred['loc_offset']), batch_gt['loc_offset']) * batch_gt['mask'].squeeze(0).unsqueeze(-1)
+    # The location offset is only supervised at the positive samples
+    pred_yx, gt_yx = positives(batch_pred, batch_gt, 'loc_offset')
+    batch_loss_offset_yx = loss_offset_yx_function(torch.sigmoid(pred_yx), gt_yx)
 
     batch_loss_heatmap = focal_loss(batch_pred['heatmap'], batch_gt['heatmap'], reduction='mean')
     # batch_loss_heatmap = F.mse_loss(batch_pred['heatmap'], batch_gt['heatmap'])
 
 
-    batch_num_positive_samples = batch_gt['mask'].sum()
+    batch_num_positive_samples = gt_yx.new_tensor(len(gt_yx))
     batch_num_positive_samples = torch.maximum(batch_num_positive_samples, torch.ones_like(batch_num_positive_samples))
 
     batch_loss_offset_yx /= batch_num_positive_samples
@@ -99,4 +133,4 @@ def compute_loss2d(batch_pred, batch_gt, loss_weight=[1., 1.]):
             'loss_heatmap' : batch_loss_heatmap.item() * hm_weight,
             'loss_pos' : batch_loss_offset_yx.item() * pos_weight,
     }
-    return loss, loss_dict
\ No newline at end of file
+    return loss, loss_dict
@@ -1,5 +1,6 @@
-import os, sys
+import os, sys, math, hashlib, weakref
 sys.path.append(os.getcwd())
+from collections import OrderedDict, namedtuple
 import torch
 import numpy as np
 import torch.nn as nn
@@ -10,9 +11,32 @@ from vfa.data.wildtrack import Wildtrack
 from vfa.data.multiviewX import MultiviewX
 from vfa.data.multiviewC import MultiviewC
 from vfa.utils import project
+from vfa.model.box_sum import box_sum, box_sum_gather, corner_index, bilinear_taps, CORNERS, CORNER_SIGNS
 
 EPSILON = 1e-6
 MAXIMUM_AREA_RATIO = 0.3
+# A voxel is routed to the scales whose box area is within ROUTE_RADIUS levels (log4 of the area) of `route_target`
+ROUTE_RADIUS = 0.75
+# grid_sample: autograd through the integral image and F.grid_sample
+# native: `box_sum`, an autograd Function with a hand-written backward that calls the native CPU ops `vfa::box_sum`
+# torch: the same autograd Function with the forward and backward in PyTorch
+# gather: read the integral image at the corners rounded to the nearest pixel with torch.gather, which is
+#         approximate: the average over the rounded box, not over the exact box
+SAMPLERS = ['grid_sample', 'native', 'torch', 'gather']
+
+# box_corners: (B, nl, L*W, 4) normalized box of each voxel, format: Left, Top, Right, Bottom
+# box_area: (B, 1, nl, L*W) area of box_corners in normalized coordinates, independent of the feature scale
+# visible: (B, 1, nl, L*W) voxels whose boxes are neither empty nor too big
+# length, width: the length and width of grid
+# cell_index: (B, K) indices of the L*W cells that have at least one visible voxel, padded with unseen cells
+# derived: dict of the data derived from the geometry and cached with it, 
+#          e.g. the integer corners of the `gather` sampler and the geometry routed to each scale
+VoxelGeometry = namedtuple('VoxelGeometry',
+        ['box_corners', 'box_area', 'visible', 'length', 'width', 'cell_index', 'derived'])
+
+# The crop of the input images that VFA reads, in pixels of the input images
+# offset: ((x0, y0), ...) top left corner of each camera, size: (w, h) shared by all cameras, image_size: (W, H)
+ImageROI = namedtuple('ImageROI', ['offset', 'size', 'image_size'])
 
 """ 
 #--------------------------------------#
@@ -43,9 +67,220 @@ def convert(grid, args):
         coord = wt_convert(grid)
     return coord
 
+def compact_cells(visible):
+    # visible: (B, 1, nl, L*W) => (B, K) the cells seen by each camera first, padded with the unseen cells
+    cell_visible = visible[:, 0].any(dim=1) # (B, L*W)
+    num_cells = max(int(cell_visible.sum(dim=1).max()), 1)
+    _, cell_index = torch.sort(cell_visible.to(torch.uint8), dim=1, descending=True, stable=True)
+    return cell_index[:, :num_cells]
+
+def visible_bounds(geometry):
+    """
+        The normalized bounds (x0, y0, x1, y1) of the visible boxes of `geometry` in each image, 
+        None for the cameras that see no voxel. The bounds are cached with `geometry`.
+    """
+    key = 'visible_bounds'
+    if key not in geometry.derived:
+        visible = geometry.visible[:, 0] # (B, nl, L*W)
+        box_corners = geometry.box_corners
+        lower = torch.where(visible[..., None], box_corners[..., :2], box_corners.new_tensor(float('inf'))).flatten(1, 2).min(dim=1)[0]
+        upper = torch.where(visible[..., None], box_corners[..., 2:], box_corners.new_tensor(-float('inf'))).flatten(1, 2).max(dim=1)[0]
+        seen = visible.flatten(1).any(dim=1)
+        geometry.derived[key] = [(x0, y0, x1, y1) if camera_seen else None for (x0, y0), (x1, y1), camera_seen
+                                 in zip(lower.tolist(), upper.tolist(), seen.tolist())]
+    return geometry.derived[key]
+
+def feature_span(lower, upper, extent, stride):
+    """
+        The pixels [start, end) of an image axis of `extent` pixels whose features of `stride` hold every 
+        bilinear tap of the normalized box corners in [lower, upper]. The features of the whole image have 
+        ceil(extent / stride) pixels, and the taps out of them are zero padded in the crop as well.
+    """
+    cells = -(-extent // stride)
+    start = max(math.floor((lower + 1) / 2 * cells - 0.5), 0)
+    end = min(math.floor((upper + 1) / 2 * cells - 0.5) + 1, cells - 1) + 1
+    return start * stride, end * stride
+
+def image_roi(geometries, image_size, strides=(8, 16, 32)):
+    """
+        The crop of each image (iH, iW) whose features at every stride of `strides` hold all the bilinear taps
+        of the visible boxes of `geometries`, thus VFA on the features of the crop reads the same integral 
+        image values as on the features of the whole image.
+        geometries: a VoxelGeometry or a list of them of the same cameras, e.g. the fine and the coarse grid
+        The offsets are aligned to the coarsest stride, so that the feature pixels of the crop are the feature
+        pixels of the whole image, and the size is a multiple of it unless the crop spans the whole axis.
+        All cameras share the size of the biggest crop, so that they are still batched through the backbone.
+    """
+    geometries = [geometries] if isinstance(geometries, VoxelGeometry) else geometries
+    height, width = image_size
+    stride = max(strides)
+    spans = list() # ((x0, x1), (y0, y1)) of each camera, None for the cameras that see no voxel
+    for bounds in zip(*[visible_bounds(geometry) for geometry in geometries]):
+        bounds = [bound for bound in bounds if bound is not None]
+        if not bounds:
+            spans.append(None)
+            continue
+        camera_span = list()
+        for axis, extent in enumerate((width, height)):
+            lower, upper = min(bound[axis] for bound in bounds), max(bound[axis + 2] for bound in bounds)
+            start, end = zip(*[feature_span(lower, upper, extent, scale_stride) for scale_stride in strides])
+            camera_span.append((min(start) // stride * stride, min(-(-max(end) // stride) * stride, extent)))
+        spans.append(camera_span)
+
+    offset, size = list(), list()
+    for axis, extent in enumerate((width, height)):
+        axis_spans = [span[axis] for span in spans if span is not None]
+        length = -(-max([end - start for start, end in axis_spans] + [stride]) // stride) * stride
+        # the last aligned offset that keeps the crop inside of the image
+        last = (extent - length) // stride * stride
+        if length >= extent or any(min(start, last) + length < end for start, end in axis_spans):
+            # a span reaches into the last partial stride, thus the crop spans the whole axis
+            offset.append([0] * len(spans))
+            size.append(extent)
+        else:
+            offset.append([0 if span is None else min(span[axis][0], last) for span in spans])
+            size.append(length)
+    return ImageROI(tuple(zip(*offset)), tuple(size), (width, height))
+
+def crop_geometry(geometry, roi, feat_scale):
+    """
+        Shift the boxes of `geometry` to the image crop `roi` on the features of `feat_scale`. The features of
+        the whole image have F = ceil(image_size * feat_scale) pixels and the features of the crop are k of them
+        from c = offset * feat_scale on, thus the normalized coordinates of the crop are 
+        g' = a * g + b with a = F / k and b = a - 1 - 2 * c / k. The area is scaled by the same factor, 
+        so that the area in feature pixels is unchanged. The cropped geometry is cached.
+        [NOTICE] The offsets of `roi` must be aligned to the stride, see `image_roi`.
+    """
+    key = ('roi', roi, feat_scale)
+    if key not in geometry.derived:
+        stride = round(1 / feat_scale)
+        box_corners = geometry.box_corners
+        cells = box_corners.new_tensor([-(-extent // stride) for extent in roi.size])
+        scale = box_corners.new_tensor([-(-extent // stride) for extent in roi.image_size]) / cells
+        shift = scale - 1 - 2 * box_corners.new_tensor(roi.offset) / stride / cells # (B, 2)
+        box_corners = box_corners * scale.repeat(2) + shift.repeat(1, 2)[:, None, None, :]
+        geometry.derived[key] = VoxelGeometry(box_corners, geometry.box_area * scale.prod(), geometry.visible, 
+                                              geometry.length, geometry.width, geometry.cell_index, dict())
+    return geometry.derived[key]
+
+def crop_images(images, roi):
+    # images: (N, C, iH, iW) => (N, C, h, w)
+    width, height = roi.size
+    return torch.stack([image[:, y0:y0 + height, x0:x0 + width] for image, (x0, y0) in zip(images, roi.offset)])
+
+class TensorDigests(object):
+    """
+        The content digests of the calibrations and the grids in the keys of ProjectionCache. Copying a
+        tensor to the host and hashing it is slow, thus
+            - the digest of a tensor is memoized by its identity (memory, version counter, shape, strides, 
+              dtype and device) and evicted by a weakref finalizer when the tensor is freed, 
+              thus no tensor is kept alive and every in-place update bumps the version counter
+            - the new tensors of every batch of a fixed rig are compared on their device with the copies of
+              the latest `max_contents` tensors hashed before, and only hashed if they are new
+            - the digest of a view, e.g. a tile of the grid, is memoized by the digest of its base and its
+              place in the base, thus the tiles of a fixed rig are hashed once as well
+        [NOTICE]: writes through `.data` do not bump the version counter of the tensor
+    """
+    def __init__(self, max_contents=8, max_views=1024):
+        self.max_contents = max_contents
+        self.max_views = max_views
+        self.identities = dict()
+        # digest => a copy of the hashed tensor on its device
+        self.contents = OrderedDict()
+        # (digest of the base, offset, shape, strides) => digest of the view
+        self.views = OrderedDict()
+
+    @staticmethod
+    def identity(tensor):
+        # None for the inference tensors, which have no version counter
+        if tensor.is_inference():
+            return None
+        return (tensor.data_ptr(), tensor._version, tuple(tensor.shape), tensor.stride(), 
+                str(tensor.dtype), str(tensor.device))
+
+    def __call__(self, tensor):
+        identity = self.identity(tensor)
+        if identity is not None and identity in self.identities:
+            return self.identities[identity]
+        base = tensor._base
+        if base is not None:
+            view = (self(base), tensor.storage_offset() - base.storage_offset(), tuple(tensor.shape), tensor.stride())
+            if view not in self.views:
+                self.views[view] = self.hash(tensor)
+                while len(self.views) > self.max_views:
+                    self.views.popitem(last=False)
+            self.views.move_to_end(view)
+            digest = self.views[view]
+        else:
+            digest = self.content_digest(tensor)
+        if identity is not None:
+            self.identities[identity] = digest
+            weakref.finalize(tensor, self.identities.pop, identity, None)
+        return digest
+
+    def content_digest(self, tensor):
+        for digest, known in self.contents.items():
+            if known.shape == tensor.shape and known.dtype == tensor.dtype and known.device == tensor.device \
+               and torch.equal(known, tensor):
+                self.contents.move_to_end(digest)
+                return digest
+        digest = self.hash(tensor)
+        self.contents[digest] = tensor.detach().clone()
+        while len(self.contents) > self.max_contents:
+            self.contents.popitem(last=False)
+        return digest
+
+    @staticmethod
+    def hash(tensor):
+        content = tensor.detach().contiguous()
+        digest = hashlib.sha1(content.cpu().numpy().tobytes()).hexdigest()
+        return (tuple(content.shape), str(content.dtype), str(content.device), digest)
+
+    def clear(self):
+        self.contents.clear()
+        self.views.clear()
+
+class ProjectionCache(object):
+    """
+        Cache of the voxel geometry (VoxelGeometry) of fixed cameras.
+        The projection of the voxel grid only depends on the calibration, the grid, the cube size, 
+        the image size and the clamping range. Thus, the geometry is built on first use and reused
+        for every later frame. Call `clear` after changing any calibration in place.
+    """
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.digests = TensorDigests()
+
+    def make_key(self, calib, grid, cube_size, grid_height, image_size, crange, data):
+        return (self.digests(calib), self.digests(grid),
+                tuple(float(s) for s in cube_size), float(grid_height),
+                tuple(int(s) for s in image_size), tuple(float(c) for c in crange), data)
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, geometry):
+        self.entries[key] = geometry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.digests.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
 class VFA(nn.Module):
-    def __init__(self, channel, grid_height=160, cube_size=(25, 25, 32), feat_scale=1, args=None):
+    def __init__(self, channel, grid_height=160, cube_size=(25, 25, 32), feat_scale=1, args=None, cache=None, sparse=False, sampler='grid_sample', max_tile_bytes=None, route_target=None, collapse=None):
         super(VFA, self).__init__()
+        self.cube_size = tuple(float(s) for s in cube_size)
+        self.grid_height = grid_height
         self.cube_height = cube_size[2]
         z_corners = torch.arange(0, grid_height, cube_size[2])
         z_corners = F.pad(z_corners.view(-1, 1, 1, 1), [2, 0])
@@ -56,10 +291,42 @@ class VFA(nn.Module):
 
         self.feat_scale = feat_scale
         self.args = args
-        self.collapse = nn.Linear(channel * num_grid_layer, channel)
+        # the collapse layer of another VFA of the same channels and layers can be shared, e.g. by the coarse grid
+        self.collapse = nn.Linear(channel * num_grid_layer, channel) if collapse is None else collapse
+        # the geometry of fixed cameras is projected once and reused, see `ProjectionCache`
+        self.cache = ProjectionCache() if cache is None else cache
+        self.use_cache = True
+        # only sample the cells that the camera can see, see `aggregate_sparse`
+        self.sparse = sparse
+        assert sampler in SAMPLERS, 'sampler error, expect {}, got {}'.format(SAMPLERS, sampler)
+        self.sampler = sampler
+        # the memory budget of one tile of the grid in bytes, None: the whole grid at once, see `tile_size`
+        self.max_tile_bytes = max_tile_bytes
+        # the box area in pixels that this scale suits best, None: sample every voxel, see `route`
+        self.route_target = route_target
+        # CoverageMask of the rig, the voxels outside of its field are not sampled, see `cover`
+        self.coverage = None
 
-    def forward(self, feature, calib, grid, crange=(-1, 0.95), visualize=False):
-        # feature: (1, 512, 90, 160), calib: (3, 4), grid: (1, 156, 156, 3) z_corners: (8, 1, 1, 3)
+    def clear_cache(self):
+        self.cache.clear()
+
+    def geometry(self, calib, grid, crange=(-1, 0.95)):
+        """
+            Return the VoxelGeometry of grid seen by calib, from the projection cache if possible.
+        """
+        if not self.use_cache:
+            return self.project_grid(calib, grid, crange)
+        key = self.cache.make_key(calib, grid, self.cube_size, self.grid_height, 
+                                  self.args.image_size, crange, self.args.data)
+        geometry = self.cache.get(key)
+        if geometry is None:
+            geometry = self.project_grid(calib, grid, crange)
+            self.cache.put(key, geometry)
+        return geometry
+
+    @torch.no_grad()
+    def project_grid(self, calib, grid, crange=(-1, 0.95)):
+        # calib: (3, 4), grid: (1, 156, 156, 3) z_corners: (8, 1, 1, 3)
         # corners: (1, 5, 156, 156, 3) = grid: (1, 1, 156, 156, 3) + z_corners: (5, 1, 1, 3)
         corners = grid.unsqueeze(0) + self.z_corners.view(-1, 1, 1, 3)
         corners = corners.unsqueeze(-2) #(1, 5, 156, 156, 1, 3)
@@ -70,7 +337,6 @@ class VFA(nn.Module):
         calib = calib.view(-1, 1, 1, 1, 1, 3, 4)
         img_corners3d = project(corners3d, calib) #(1, 5, 156, 156, 8, 2)
         
-        feature_height, feature_width = feature.size()[2:]
         # img_size = corners.new([feature_width, feature_height]) / self.feat_scale
         img_size = corners.new(self.args.image_size[::-1])
         norm_corners3d = (2 * img_corners3d / img_size - 1).clamp(crange[0], crange[1]) #(1, 5, 156, 156, 8, 2)
@@ -84,10 +350,26 @@ class VFA(nn.Module):
             torch.max(norm_corners3d[..., 0], dim=-1, keepdim=True)[0],
             torch.max(norm_corners3d[..., 1], dim=-1, keepdim=True)[0],
         ], dim=-1)
-        batch, _, length, width, _ = box_corners.shape
+        _, _, length, width, _ = box_corners.shape
         box_corners = box_corners.flatten(2, 3) 
 
+        # The area is kept in normalized coordinates, so that it is shared by all feature scales.
+        # REMOVE the areas that are too small or too big
+        box_area = (box_corners[..., 2:] - box_corners[..., :2]).prod(dim=-1).unsqueeze(1)
+        visible = torch.logical_and(box_area > 0, box_area < MAXIMUM_AREA_RATIO)
+
+        # Compact the cells seen by each camera to the front, the rest pads the cameras that see fewer cells
+        cell_index = compact_cells(visible)
+        return VoxelGeometry(box_corners, box_area, visible, length, width, cell_index, dict())
+
+    def forward(self, feature, calib, grid, crange=(-1, 0.95), visualize=False):
+        # feature: (1, 512, 90, 160), calib: (3, 4), grid: (1, 156, 156, 3)
         if visualize:
+            geometry = self.geometry(calib, grid, crange)
+            box_corners = geometry.box_corners
+            corners = (grid.unsqueeze(0) + self.z_corners.view(-1, 1, 1, 3)).unsqueeze(-2)
+            calib = calib.view(-1, 1, 1, 1, 1, 3, 4)
+            img_size = corners.new(self.args.image_size[::-1])
             centers3d = corners.clone()
             centers3d[..., -1] += self.cube_height * 0.5
             # convert worldgrid to world coord
@@ -99,29 +381,145 @@ class VFA(nn.Module):
             # transform the box_corners range from [-1, 1] to [0, 1]
             viz_box_corners = ( box_corners + 1 ) / 2
             self.visualize_cube(feature, viz_box_corners, box_center)
-        
+            return self.aggregate(feature, geometry)
+
+        return multi_scale_vfa([self], [feature], calib, grid, crange)
+
+    def aggregate(self, feature, geometry):
+        """
+            Sample the voxel features of `feature` at the boxes of `geometry` and collapse them to 
+            the orthographic feature map (B, C, L, W).
+        """
+        if self.sparse:
+            return self.aggregate_sparse(feature, geometry)
+        box_corners, length, width = geometry.box_corners, geometry.length, geometry.width
+        batch = box_corners.shape[0]
+        feature_height, feature_width = feature.size()[2:]
+
         # Compute the area of each bounding box
-        area = (((box_corners[..., 2:] - box_corners[..., :2]).prod(dim=-1)) \
-                 * feature_height * feature_width + EPSILON).unsqueeze(1)
-        visible = torch.logical_and(area > EPSILON, area < (feature_height*feature_width*MAXIMUM_AREA_RATIO))
-        # visible = (area > EPSILON) # REMOVE the areas that are too small or too big
-
-        # Sample the integral image at bounding box locations
-        intergral_img = self.integral_image(feature)
-        # box_corners size: (B, C, L*W, 4) format: Left, Top, Right, Bottom
-        left_top = F.grid_sample(intergral_img, box_corners[..., [0, 1]])
-        right_btm = F.grid_sample(intergral_img, box_corners[..., [2, 3]])
-        right_top = F.grid_sample(intergral_img, box_corners[..., [2, 1]])
-        left_btm = F.grid_sample(intergral_img, box_corners[..., [0, 3]])
-
-        # Compute the voxel feature
-        vox_features = (left_top + right_btm - right_top - left_btm) / area # (B, C, nl, L*W)
-        vox_features = vox_features * visible
-        vox_features = vox_features.permute(0, 3, 1, 2).flatten(0,1).flatten(1,2) # (B*L*W, C*nl)
-
-        # Collapse to orthographic feature map 
-        ortho_features = self.collapse(vox_features).view(batch, length, width, -1) # (B, L, W, C)
-        ortho_features = F.relu(ortho_features.permute(0, 3, 1, 2), inplace=True)
+        area = geometry.box_area * feature_height * feature_width + EPSILON
+        visible = geometry.visible
+
+        vox_features = self.box_features(feature, box_corners, area, visible, geometry)
+        return self.collapse_voxels(vox_features, batch, length, width)
+
+    def aggregate_sparse(self, feature, geometry):
+        """
+            Same as `aggregate`, but only gathers the cells seen by each camera and scatters 
+            their collapsed features back into the orthographic feature map. The unseen cells 
+            have no voxel feature, thus they are filled with the bias of `collapse`.
+        """
+        box_corners, length, width = geometry.box_corners, geometry.length, geometry.width
+        batch, num_layer = box_corners.shape[:2]
+        feature_height, feature_width = feature.size()[2:]
+
+        cell_index = geometry.cell_index # (B, K)
+        voxel_index = cell_index[:, None, None, :].expand(-1, 1, num_layer, -1) # (B, 1, nl, K)
+        box_corners = torch.gather(box_corners, 2, voxel_index[:, 0, :, :, None].expand(-1, -1, -1, 4))
+        area = torch.gather(geometry.box_area, 3, voxel_index) * feature_height * feature_width + EPSILON
+        visible = torch.gather(geometry.visible, 3, voxel_index)
+
+        vox_features = self.box_features(feature, box_corners, area, visible, geometry) # (B, C, nl, K)
+        cell_features = torch.matmul(self.collapse.weight, vox_features.flatten(1, 2)) \
+                        + self.collapse.bias.view(-1, 1) # (B, C, K)
+        
+        ortho_features = self.collapse.bias.view(1, -1, 1).expand(batch, -1, length * width)
+        ortho_features = ortho_features.scatter(2, cell_index[:, None, :].expand_as(cell_features), cell_features)
+        ortho_features = F.relu(ortho_features.view(batch, -1, length, width), inplace=True)
+        return ortho_features
+
+    def box_features(self, feature, box_corners, area, visible, geometry):
+        """
+            Average `feature` inside the boxes through the integral image.
+                box_corners: (B, nl, K, 4) format: Left, Top, Right, Bottom
+                area, visible: (B, 1, nl, K)
+                geometry: the VoxelGeometry that box_corners comes from
+            Return voxel features (B, C, nl, K)
+        """
+        if self.sampler == 'grid_sample':
+            # Sample the integral image at bounding box locations
+            intergral_img = self.integral_image(feature)
+            # Compute the voxel feature: left_top + right_btm - right_top - left_btm
+            # The corners are accumulated in place, since grid_sample does not need its output for backward 
+            vox_features = F.grid_sample(intergral_img, box_corners[..., [0, 1]], align_corners=False)
+            vox_features += F.grid_sample(intergral_img, box_corners[..., [2, 3]], align_corners=False)
+            vox_features -= F.grid_sample(intergral_img, box_corners[..., [2, 1]], align_corners=False)
+            vox_features -= F.grid_sample(intergral_img, box_corners[..., [0, 3]], align_corners=False)
+        elif self.sampler == 'gather':
+            # The integer corners only depend on the geometry and the feature size, thus they are cached
+            key = ('corner_index', *feature.shape[-2:], self.sparse)
+            if key not in geometry.derived:
+                geometry.derived[key] = corner_index(box_corners, *feature.shape[-2:])
+            index, pixels = geometry.derived[key]
+            vox_features = box_sum_gather(feature, index, box_corners.shape[1])
+            # the average over the rounded boxes, see `corner_index`. `area` is in the normalized image 
+            # [-1, 1] x [-1, 1] times the feature size, i.e. 4 times the pixels of the box
+            vox_features /= 4 * pixels
+            vox_features *= visible
+            return vox_features
+        else:
+            vox_features = box_sum(feature, box_corners, native=(self.sampler == 'native'))
+        vox_features /= area
+        vox_features *= visible
+        return vox_features
+
+    def cover(self, geometry, grid):
+        """
+            Drop the voxels of `geometry` outside of the field of `coverage`. The cells seen by no camera 
+            are never visible already. The covered geometry is cached with `geometry`.
+        """
+        key = ('coverage', self.coverage)
+        if key not in geometry.derived:
+            visible = geometry.visible & self.coverage.field(grid).flatten()
+            geometry.derived[key] = VoxelGeometry(geometry.box_corners, geometry.box_area, visible, 
+                                                  geometry.length, geometry.width, compact_cells(visible), dict())
+        return geometry.derived[key]
+
+    def route(self, geometry, finest, coarsest):
+        """
+            Route the voxels of `geometry` to this scale if their boxes are close to `route_target` pixels.
+            The finest / coarsest scale of the pyramid also takes the smaller / bigger boxes. Since the 
+            scales are 4x apart in area, every voxel goes to one or two scales. The routed geometry is 
+            cached with `geometry`, and the sampling work only drops with `sparse`, which compacts the cells.
+        """
+        key = ('route', self.feat_scale, self.route_target, finest, coarsest)
+        if key not in geometry.derived:
+            image_height, image_width = self.args.image_size
+            # the box area in pixels of this scale, 4 is the area of the normalized image [-1, 1] x [-1, 1]
+            pixels = geometry.box_area * image_height * image_width * self.feat_scale ** 2 / 4
+            level = torch.log2(pixels / self.route_target + EPSILON) / 2
+            routed = level.abs() <= ROUTE_RADIUS
+            if finest:
+                routed |= level < 0
+            if coarsest:
+                routed |= level > 0
+            visible = geometry.visible & routed
+            geometry.derived[key] = VoxelGeometry(geometry.box_corners, geometry.box_area, visible, 
+                                                  geometry.length, geometry.width, compact_cells(visible), dict())
+        return geometry.derived[key]
+
+    def tile_size(self, batch, channel, length, width):
+        """
+            The (rows, columns) of a tile of the grid that fits in `max_tile_bytes`.
+                channel: the total channels of the features aggregated on the same geometry
+            The estimate per cell counts the projected corners with their intermediate copies and 
+            two voxel features per channel (the accumulated corners and the sample being added).
+        """
+        if self.max_tile_bytes is None:
+            return length, width
+        num_layer = len(self.z_corners)
+        cell_bytes = batch * num_layer * (8 * 4 * 6 + channel * 2) * self.corners_offset.element_size()
+        cells = max(int(self.max_tile_bytes // cell_bytes), 1)
+        if cells >= width:
+            return min(cells // width, length), width
+        return 1, cells
+
+    def collapse_voxels(self, vox_features, batch, length, width):
+        # Collapse to orthographic feature map, (B, C, nl, L*W) => (B, C, L, W)
+        # Equal to self.collapse over (B*L*W, C*nl) without permuting the voxel features
+        ortho_features = torch.matmul(self.collapse.weight, vox_features.flatten(1, 2)) \
+                         + self.collapse.bias.view(-1, 1)
+        ortho_features = F.relu(ortho_features.view(batch, -1, length, width), inplace=True)
         return ortho_features
 
     def generate_cube(self, cub_size):
@@ -172,5 +570,185 @@ class VFA(nn.Module):
     def integral_image(self, features):
         return torch.cumsum(torch.cumsum(features, dim=-1), dim=-2)
 
+def route_scales(vfas, geometry):
+    # The geometry of each scale, routed by the box area if `route_target` is set
+    feat_scales = [vfa.feat_scale for vfa in vfas]
+    return [geometry if vfa.route_target is None else 
+            vfa.route(geometry, vfa.feat_scale == max(feat_scales), vfa.feat_scale == min(feat_scales)) 
+            for vfa in vfas]
+
+def multi_scale_vfa(vfas, features, calib, grid, crange=(-1, 0.95), roi=None):
+    """
+        Aggregate a feature pyramid with the VFA modules of each scale and sum them up.
+        The boxes are normalized to [-1, 1], so the geometry is identical at every scale. 
+        It is computed once and only the sampling of the integral images differs.
+        If `max_tile_bytes` of the first module is set, the grid is aggregated tile by tile.
+        roi: the ImageROI that `features` are computed from, None: the whole images
+    """
+    base = vfas[0]
+    for vfa in vfas[1:]:
+        assert vfa.cube_size == base.cube_size and vfa.grid_height == base.grid_height, \
+            'VFA modules of a feature pyramid must share the cube size and the grid height'
+    def aggregate_scales(geometry, grid):
+        if base.coverage is not None:
+            geometry = base.cover(geometry, grid)
+        ortho_features = 0
+        for vfa, feature, scale_geometry in zip(vfas, features, route_scales(vfas, geometry)):
+            # the routing and the coverage work on the whole images, thus the crop comes last
+            if roi is not None:
+                scale_geometry = crop_geometry(scale_geometry, roi, vfa.feat_scale)
+            ortho_features = ortho_features + vfa.aggregate(feature, scale_geometry)
+        return ortho_features
+
+    batch = calib.view(-1, 3, 4).shape[0]
+    _, length, width, _ = grid.shape
+    rows, cols = base.tile_size(batch, sum(feature.shape[1] for feature in features), length, width)
+    if rows == length and cols == width:
+        return aggregate_scales(base.geometry(calib, grid, crange), grid)
+
+    # Tiled: every cell is collapsed on its own, so the tiles are written into the ortho map one by one 
+    # and the result is identical to the whole grid. Each tile has its own entry in the projection cache.
+    ortho_features = features[0].new_empty(batch, base.collapse.out_features, length, width)
+    for row in range(0, length, rows):
+        for col in range(0, width, cols):
+            tile = grid[:, row:row + rows, col:col + cols]
+            ortho_features[:, :, row:row + rows, col:col + cols] = aggregate_scales(base.geometry(calib, tile, crange), tile)
+    return ortho_features
+
      
             
+
+class CompiledVFA(object):
+    """
+        VFA of a fixed camera rig compiled into one sparse CSR matrix for each feature scale.
+        Sampling the integral image is linear, thus the voxel features of all cameras are 
+            vox_features = S @ integral_image(feature)
+        where each row of S holds the 16 bilinear taps (4 corners x 4 neighbours) of a voxel with the 
+        corner sign, the `visible` mask and 1 / area folded in. S is built on the integral image rather
+        than the feature pixels, since a box of the feature takes one entry per pixel, but only 16 taps
+        of the integral image. The cameras are block diagonal in S, and its rows are ordered by 
+        (camera, cell, layer), so that the product is already in the layout of the collapse layer.
+    """
+    def __init__(self, operators, feature_sizes, length, width, key):
+        self.operators = operators
+        self.feature_sizes = [tuple(size) for size in feature_sizes]
+        self.length = length
+        self.width = width
+        self.key = key
+
+    @classmethod
+    @torch.no_grad()
+    def build(cls, vfas, feature_sizes, calib, grid, crange=(-1, 0.95)):
+        """
+            Compile the VFA modules `vfas` of a feature pyramid, whose features are of `feature_sizes`
+            [(H, W), ...], for the cameras `calib` (N, 3, 4) and the grid (1, L, W, 3).
+        """
+        base = vfas[0]
+        geometry = base.project_grid(calib, grid, crange)
+        if base.coverage is not None:
+            geometry = base.cover(geometry, grid)
+        # (B, nl, L*W) => (B, L*W, nl)
+        box_corners = geometry.box_corners.transpose(1, 2)
+        box_area = geometry.box_area[:, 0].transpose(1, 2)
+        batch, num_cell, num_layer = box_area.shape
+        rows = torch.arange(batch * num_cell * num_layer, device=box_area.device).view(batch, num_cell, num_layer)
+
+        operators = list()
+        for (height, width), scale_geometry in zip(feature_sizes, route_scales(vfas, geometry)):
+            visible = scale_geometry.visible[:, 0].transpose(1, 2)
+            scale = visible / (box_area * height * width + EPSILON)
+            offset = torch.arange(batch, device=box_area.device).view(-1, 1, 1) * height * width
+            row_index, col_index, values = list(), list(), list()
+            for (ix, iy), sign in zip(CORNERS, CORNER_SIGNS):
+                for index, weight in bilinear_taps(box_corners[..., ix], box_corners[..., iy], height, width):
+                    row_index.append(rows)
+                    col_index.append(index + offset)
+                    values.append(sign * weight * scale)
+            values = torch.stack(values).flatten()
+            keep = values != 0
+            indices = torch.stack([torch.stack(row_index).flatten()[keep], torch.stack(col_index).flatten()[keep]])
+            operator = torch.sparse_coo_tensor(indices, values[keep], (rows.numel(), batch * height * width))
+            operators.append(operator.coalesce().to_sparse_csr())
+
+        return cls(operators, feature_sizes, geometry.length, geometry.width, cls.make_key(vfas, calib, grid, crange))
+
+    @staticmethod
+    def make_key(vfas, calib, grid, crange):
+        base = vfas[0]
+        return (base.cache.make_key(calib, grid, base.cube_size, base.grid_height, 
+                                    base.args.image_size, crange, base.args.data),
+                tuple(vfa.route_target for vfa in vfas), None if base.coverage is None else base.coverage.key)
+
+    def matches(self, vfas, features, calib, grid, crange=(-1, 0.95)):
+        """
+            Whether the operators are compiled for the cameras, the grid, the routing and the feature sizes.
+        """
+        feature_sizes = [tuple(feature.shape[-2:]) for feature in features]
+        return feature_sizes == self.feature_sizes and self.make_key(vfas, calib, grid, crange) == self.key
+
+    def aggregate(self, vfas, features):
+        """
+            Same as `multi_scale_vfa` with the `grid_sample` sampler: one SpMM for each scale.
+        """
+        ortho_features = 0
+        for vfa, feature, operator in zip(vfas, features, self.operators):
+            batch, channel, height, width = feature.shape
+            intergral_img = vfa.integral_image(feature).permute(0, 2, 3, 1).reshape(-1, channel)
+            vox_features = (operator @ intergral_img).view(batch, self.length * self.width, -1) # (B, L*W, nl*C)
+            # reorder the input of collapse from (C, nl) to (nl, C)
+            weight = vfa.collapse.weight.view(vfa.collapse.out_features, channel, -1).transpose(1, 2).flatten(1)
+            cell_features = F.linear(vox_features, weight, vfa.collapse.bias) # (B, L*W, C)
+            cell_features = cell_features.transpose(1, 2).reshape(batch, -1, self.length, self.width)
+            ortho_features = ortho_features + F.relu(cell_features, inplace=True)
+        return ortho_features
+
+    def save(self, path):
+        torch.save({'operators': self.operators, 'feature_sizes': self.feature_sizes, 
+                    'length': self.length, 'width': self.width, 'key': self.key}, path)
+
+    @classmethod
+    def load(cls, path, device='cpu'):
+        state = torch.load(path, map_location=device)
+        return cls(state['operators'], state['feature_sizes'], state['length'], state['width'], state['key'])
+
+if __name__ == '__main__':
+    # Parity of VFA on the features of the image crop against VFA on the same features of the whole images, 
+    # for windows of the MultiviewC grid seen by a ring of 7 cameras, run from the root of the repository
+    import types
+    sys.path.append(os.getcwd())
+    from vfa.utils import make_grid
+    torch.manual_seed(0)
+    image_height, image_width = 720, 1280
+    intrinsic = torch.tensor([[900., 0, image_width / 2], [0, 900., image_height / 2], [0, 0, 1]], dtype=torch.float64)
+    calibs = list()
+    for cam in range(7):
+        angle = 2 * math.pi * cam / 7
+        center = torch.tensor([1950 + 2600 * math.cos(angle), 1950 + 2600 * math.sin(angle), 900 + 100 * cam], dtype=torch.float64)
+        forward = F.normalize(torch.tensor([1950., 1950., 0.], dtype=torch.float64) - center, dim=0)
+        right = F.normalize(torch.linalg.cross(forward, forward.new_tensor([0., 0., 1.])), dim=0)
+        rotation = torch.stack([right, torch.linalg.cross(forward, right), forward])
+        calibs.append(intrinsic @ torch.cat([rotation, -rotation @ center[:, None]], dim=1))
+    calibs = torch.stack(calibs)
+    full_grid = make_grid(world_size=(3900, 3900), cube_LW=[25, 25], dataset='MultiviewC')[None].double()
+    args = types.SimpleNamespace(data='MultiviewC', image_size=(image_height, image_width))
+
+    for rows, cols in [(slice(40, 110), slice(40, 110)), (slice(70, 90), slice(10, 30)), (slice(0, 60), slice(0, 156))]:
+        grid = full_grid[:, rows, cols]
+        geometry = VFA(channel=8, feat_scale=1 / 8., args=args).double().geometry(calibs, grid)
+        roi = image_roi(geometry, (image_height, image_width))
+        print('grid [{}:{}, {}:{}]: crop {} of {}'.format(rows.start, rows.stop, cols.start, cols.stop, roi.size, roi.image_size))
+        for feat_scale in [1 / 8., 1 / 16., 1 / 32.]:
+            stride = round(1 / feat_scale)
+            feature = torch.rand(7, 8, math.ceil(image_height * feat_scale), math.ceil(image_width * feat_scale), dtype=torch.float64)
+            # the features of the crop are the feature pixels of the whole images from the aligned offset on
+            crop_height, crop_width = -(-roi.size[1] // stride), -(-roi.size[0] // stride)
+            crop = torch.stack([feat[:, y0 // stride:y0 // stride + crop_height, x0 // stride:x0 // stride + crop_width] 
+                                for feat, (x0, y0) in zip(feature, roi.offset)])
+            for sampler in ['grid_sample', 'torch', 'gather']:
+                vfa = VFA(channel=8, feat_scale=feat_scale, args=args, sampler=sampler).double()
+                with torch.no_grad():
+                    reference = vfa.aggregate(feature, geometry)
+                    output = vfa.aggregate(crop, crop_geometry(geometry, roi, feat_scale))
+                # the same box sums up to the rounding of float64
+                assert torch.allclose(output, reference, atol=1e-8, rtol=1e-6), (sampler, stride)
+    print('passed')
@@ -7,10 +7,30 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 import torch.nn.functional as F
 
-from vfa.model.vfa_op import VFA
+from vfa.model.vfa_op import VFA, ProjectionCache, CompiledVFA, multi_scale_vfa, image_roi, crop_images, SAMPLERS
 import vfa.model.resnet as resnet
 from vfa.data.multiviewX import MultiviewX
 
+# The receptive radius of the heads on the ortho map in cells: fuse (1 + 2) + map_classifier / orient_pred (4)
+REFINE_MARGIN = 7
+
+def conv2d_at(input, conv, index):
+    """
+        Evaluate the convolution `conv` (stride 1, same size output) of input (B, C, L, W) only at the
+        cells `index` (B, K) flattened over L*W. Return (B, K, O), equal to conv(input) gathered at index.
+    """
+    batch, channel, length, width = input.shape
+    (kernel_h, kernel_w), (dilation_h, dilation_w), (pad_h, pad_w) = conv.kernel_size, conv.dilation, conv.padding
+    padded_width = width + 2 * pad_w
+    padded = F.pad(input, [pad_w, pad_w, pad_h, pad_h]).flatten(2)
+    # the taps of every cell in the padded input: its top left tap + the offsets of the kernel
+    offsets = (torch.arange(kernel_h, device=index.device) * dilation_h * padded_width)[:, None] \
+            + (torch.arange(kernel_w, device=index.device) * dilation_w)[None, :]
+    taps = ((index // width) * padded_width + index % width)[..., None] + offsets.flatten() # (B, K, kh*kw)
+    patches = torch.gather(padded, 2, taps.flatten(1)[:, None].expand(-1, channel, -1))
+    patches = patches.view(batch, channel, -1, kernel_h * kernel_w).transpose(1, 2).flatten(2) # (B, K, C*kh*kw)
+    return F.linear(patches, conv.weight.flatten(1), conv.bias)
+
 class VFANet(nn.Module):
     def __init__(self, args,
                  base='resnet18',
@@ -18,18 +38,44 @@ class VFANet(nn.Module):
                  cube_size=(25, 25, 32),
                  angle_range=360,
                  mode='3D',
-                 pretrained=False):
+                 angle_mode='csl',
+                 angle_bins=8,
+                 pretrained=False,
+                 batch_cameras=True):
         super(VFANet, self).__init__()
         assert base in ['resnet18', 'resnet34'], 'Unrecognized model, expect `resnet18` or `resnet34`, got {}.'.format(base)
         assert mode in ['2D', '3D'], 'mode error, expect `2D` or `3D`, got{}'.format(mode)
+        assert angle_mode in ['csl', 'bin'], 'angle mode error, expect `csl` or `bin`, got {}'.format(angle_mode)
  
         self.mode = mode
+        # `csl`: 360-way circular smooth label, `bin`: `angle_bins` angle bins + sin/cos residual to the bin center
+        self.angle_mode = angle_mode
+        self.angle_bins = angle_bins
+        # aggregate all cameras at once instead of looping over them
+        self.batch_cameras = batch_cameras
         resnet_model = getattr(resnet, base)(pretrained=pretrained)
         self.base = resnet_model
 
-        self.vfa8 = VFA(channel=256, grid_height=grid_height, cube_size=cube_size, feat_scale= 1 / 8., args=args)
-        self.vfa16 = VFA(channel=256, grid_height=grid_height, cube_size=cube_size, feat_scale= 1 / 16., args=args)
-        self.vfa32 = VFA(channel=256, grid_height=grid_height, cube_size=cube_size, feat_scale= 1 / 32., args=args)
+        # The three scales project the same voxels, thus they share one projection cache
+        self.projection_cache = ProjectionCache()
+        self.vfa8 = VFA(channel=256, grid_height=grid_height, cube_size=cube_size, feat_scale= 1 / 8., args=args, cache=self.projection_cache)
+        self.vfa16 = VFA(channel=256, grid_height=grid_height, cube_size=cube_size, feat_scale= 1 / 16., args=args, cache=self.projection_cache)
+        self.vfa32 = VFA(channel=256, grid_height=grid_height, cube_size=cube_size, feat_scale= 1 / 32., args=args, cache=self.projection_cache)
+        # VFA of a fixed camera rig compiled into sparse matrices, see `compile_vfa`
+        self.compiled_vfa = None
+        # Two-stage inference on a coarse grid with `coarse_factor` times bigger cubes, see `coarse_to_fine`
+        self.coarse_factor = None
+        self.coarse_thresh = 0.1
+        self.coarse_tile = 32
+        # ((coarse_factor, device), VFA modules of the coarse grid), see `coarse_vfas`
+        self.coarse_cache = None
+        # CoverageMask of the rig, only the covered cells are predicted at inference, see `predict_covered`
+        self.coverage = None
+        # Crop the images to the region that VFA reads before the backbone, see `image_roi`
+        self.roi_crop = False
+        # Evaluate the regression heads only at the top k peaks at inference, see `predict_peaks`.
+        # It needs batch_cameras and excludes coverage and coarse_factor, see `forward`
+        self.head_topk = None
 
         self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]))
         self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]))
@@ -49,83 +95,362 @@ class VFANet(nn.Module):
         self.tytx_pred = nn.Sequential(nn.Conv2d(256, 256, kernel_size=3, padding=1), nn.GroupNorm(16, 256), nn.ReLU(True),
                                        nn.Conv2d(256, 2, kernel_size=3, padding=1, bias=False))
         if self.mode == '3D':
-            self.orient_pred = nn.Sequential( nn.Conv2d(256, angle_range, kernel_size=3, padding=4, dilation=4, bias=False) )
+            orient_channels = angle_range if angle_mode == 'csl' else angle_bins + 2
+            self.orient_pred = nn.Sequential( nn.Conv2d(256, orient_channels, kernel_size=3, padding=4, dilation=4, bias=False) )
             self.thtwtl_pred = nn.Sequential(nn.Conv2d(256, 256, kernel_size=3, padding=1), nn.GroupNorm(16, 256), nn.ReLU(True),
                                         nn.Conv2d(256, 3, kernel_size=3, padding=1, bias=False))
     
+    def configure_vfa(self, **options):
+        """
+            Set the options of the VFA modules of all scales, e.g. `model.configure_vfa(sparse=True)`
+        """
+        if 'sampler' in options:
+            assert options['sampler'] in SAMPLERS, 'sampler error, expect {}, got {}'.format(SAMPLERS, options['sampler'])
+        for vfa in [self.vfa8, self.vfa16, self.vfa32]:
+            for key, value in options.items():
+                assert hasattr(vfa, key), 'Unknown VFA option `{}`'.format(key)
+                setattr(vfa, key, value)
+
+    def set_coverage(self, coverage):
+        # CoverageMask of the rig or None, shared by VFA of all scales
+        self.coverage = coverage
+        self.configure_vfa(coverage=coverage)
+
+    def clear_projection_cache(self):
+        # Call it after changing the calibrations or the grid of the camera rig in place
+        self.projection_cache.clear()
+
+    @torch.no_grad()
+    def feature_sizes(self, image_size):
+        # The (H, W) of the features of the backbone for images of image_size (iH, iW)
+        feats = self.base(self.mean.new_zeros(1, 3, *image_size))
+        return [tuple(feat.shape[-2:]) for feat in feats]
+
+    @torch.no_grad()
+    def compile_vfa(self, calibs, grid, image_size):
+        """
+            Compile the VFA of the camera rig into sparse matrices, which replace the projection 
+            and the sampling of `aggregate_cameras` for these calibrations, grid and image size (iH, iW).
+            [NOTICE]: each scale takes 16 taps of 12 bytes for every voxel of every camera, e.g. 
+                      several hundred MB for the 7 cameras and the 156 x 156 grid of MultiviewC
+        """
+        self.compiled_vfa = CompiledVFA.build([self.vfa8, self.vfa16, self.vfa32], 
+                                              self.feature_sizes(image_size), calibs, grid, (-1, 0.95))
+
+    def compiled_vfa_matches(self, calibs, grid, image_size):
+        """
+            Whether `compiled_vfa` is compiled for these calibrations, grid and image size (iH, iW) and 
+            the current routing and coverage of VFA, e.g. a saved one may come from another rig
+        """
+        if self.compiled_vfa is None:
+            return False
+        vfas = [self.vfa8, self.vfa16, self.vfa32]
+        return self.compiled_vfa.feature_sizes == self.feature_sizes(image_size) and \
+               self.compiled_vfa.make_key(vfas, calibs, grid, (-1, 0.95)) == self.compiled_vfa.key
+
+    def save_compiled_vfa(self, path):
+        self.compiled_vfa.save(path)
+
+    def load_compiled_vfa(self, path):
+        self.compiled_vfa = CompiledVFA.load(path, device=self.mean.device)
+
+    def lateral(self, feats8, feats16, feats32):
+        # GroupNorm normalizes each camera separately, so batching does not change the result
+        lat8 = F.relu(self.bn8(self.lat8(feats8)))
+        lat16 = F.relu(self.bn16(self.lat16(feats16)))
+        lat32 = F.relu(self.bn32(self.lat32(feats32)))
+        return [lat8, lat16, lat32]
+
+    def image_roi(self, calibs, grid, image_size):
+        """
+            The crop of the images (iH, iW) whose features hold every visible voxel box of the grid at each
+            scale of the pyramid, aligned to the stride of the backbone. With `coarse_factor`, it also covers the bigger boxes of the coarse
+            grid that `coarse_to_fine` samples first. The bounds of the boxes are cached with the geometry.
+        """
+        geometry = self.vfa8.geometry(calibs, grid, (-1, 0.95))
+        if self.coverage is not None:
+            geometry = self.vfa8.cover(geometry, grid)
+        geometries = [geometry]
+        if self.coarse_factor is not None:
+            if self.coverage is not None:
+                # `predict_covered` runs on the window of the covered cells, whose coarse grid differs
+                window = self.covered_window(self.coverage(self.vfa8, calibs, grid, (-1, 0.95)))
+                grid = grid if window is None else grid[:, window[0]:window[1], window[2]:window[3]]
+            coarse_vfa, coarse_grid = self.coarse_vfas(self.coarse_factor)[0], self.coarse_grid(grid)
+            coarse_geometry = coarse_vfa.geometry(calibs, coarse_grid, (-1, 0.95))
+            if self.coverage is not None:
+                coarse_geometry = coarse_vfa.cover(coarse_geometry, coarse_grid)
+            geometries.append(coarse_geometry)
+        return image_roi(geometries, image_size, strides=[round(1 / vfa.feat_scale) for vfa in (self.vfa8, self.vfa16, self.vfa32)])
+
+    def aggregate_cameras(self, lats, calibs, grid, vfas=None, roi=None):
+        """
+            Run the integral images and the sampling of VFA over all cameras as one batch, 
+            and then reduce the orthographic features over the camera dimension.
+            roi: the ImageROI that the features are cropped from, None: the whole images
+        """
+        vfas = [self.vfa8, self.vfa16, self.vfa32] if vfas is None else vfas
+        # vfa_feats: (N, 256, L, W)
+        if roi is None and self.compiled_vfa is not None and self.compiled_vfa.matches(vfas, lats, calibs, grid, (-1, 0.95)):
+            vfa_feats = self.compiled_vfa.aggregate(vfas, lats)
+        else:
+            vfa_feats = multi_scale_vfa(vfas, lats, calibs, grid, (-1, 0.95), roi)
+        return vfa_feats.sum(dim=0, keepdim=True)
+
+    def coarse_vfas(self, factor):
+        """
+            VFA modules whose cubes are `factor` times bigger on the ground, they share the collapse layers.
+            They are built once for each factor and take the current options of the VFA of each scale.
+        """
+        fine_vfas = [self.vfa8, self.vfa16, self.vfa32]
+        key = (factor, self.vfa8.z_corners.device)
+        if self.coarse_cache is None or self.coarse_cache[0] != key:
+            vfas = list()
+            for vfa in fine_vfas:
+                l, w, h = vfa.cube_size
+                coarse = VFA(channel=vfa.collapse.out_features, grid_height=vfa.grid_height, cube_size=(l * factor, w * factor, h),
+                             feat_scale=vfa.feat_scale, args=vfa.args, cache=self.projection_cache, collapse=vfa.collapse)
+                vfas.append(coarse.to(key[1]))
+            self.coarse_cache = (key, vfas)
+        for vfa, coarse in zip(fine_vfas, self.coarse_cache[1]):
+            for option in ['use_cache', 'sparse', 'sampler', 'max_tile_bytes', 'route_target', 'coverage']:
+                setattr(coarse, option, getattr(vfa, option))
+        return self.coarse_cache[1]
+
+    def coarse_grid(self, grid):
+        # The coarse grid is the center of every coarse_factor x coarse_factor block of the grid
+        factor = self.coarse_factor
+        return F.avg_pool2d(grid.permute(0, 3, 1, 2), factor, ceil_mode=True).permute(0, 2, 3, 1)
+
+    def covered_window(self, covered):
+        # (row0, row1, col0, col1) the bounding box of the covered cells (L, W) with the margin of the heads
+        if not covered.any():
+            return None
+        length, width = covered.shape
+        rows, cols = covered.any(dim=1).nonzero()[:, 0], covered.any(dim=0).nonzero()[:, 0]
+        row0, row1 = max(int(rows[0]) - REFINE_MARGIN, 0), min(int(rows[-1]) + 1 + REFINE_MARGIN, length)
+        col0, col1 = max(int(cols[0]) - REFINE_MARGIN, 0), min(int(cols[-1]) + 1 + REFINE_MARGIN, width)
+        return row0, row1, col0, col1
+
+    def empty_pred(self, heatmap):
+        # The prediction of the map with `heatmap` (1, 1, L, W) and zero regressions
+        length, width = heatmap.shape[-2:]
+        encoded_pred = {'heatmap' : heatmap,
+                        'loc_offset' : heatmap.new_zeros(1, length, width, self.tytx_pred[-1].out_channels)}
+        if self.mode == '3D':
+            encoded_pred['dim_offset'] = heatmap.new_zeros(1, length, width, self.thtwtl_pred[-1].out_channels)
+            encoded_pred['rotation'] = heatmap.new_zeros(1, length, width, self.orient_pred[0].out_channels)
+        return encoded_pred
+
+    @torch.no_grad()
+    def predict_covered(self, lats, calibs, grid, roi=None):
+        """
+            Inference on the cells covered by `coverage` only. VFA and the heads run on the bounding box
+            of the covered cells with a margin of the receptive radius of the heads. The heatmap of the 
+            uncovered cells is masked out, and the mask is returned as `coverage` for the decoder.
+            [NOTICE] The GroupNorm of tytx_pred and thtwtl_pred normalizes over the bounding box 
+            instead of the whole map, thus the regressions are close to but not identical to `forward`.
+        """
+        covered = self.coverage(self.vfa8, calibs, grid, (-1, 0.95)) # (L, W)
+        _, length, width, _ = grid.shape
+        heatmap = lats[0].new_full((1, 1, length, width), torch.finfo(lats[0].dtype).min)
+        encoded_pred = self.empty_pred(heatmap)
+        encoded_pred['coverage'] = covered[None, None]
+        window = self.covered_window(covered)
+        if window is None:
+            return encoded_pred
+
+        row0, row1, col0, col1 = window
+        crop = grid[:, row0:row1, col0:col1]
+        if self.coarse_factor is not None:
+            crop_pred = self.coarse_to_fine(lats, calibs, crop, roi)
+        else:
+            crop_pred = self.predict(self.aggregate_cameras(lats, calibs, crop, roi=roi))
+        encoded_pred['heatmap'][..., row0:row1, col0:col1] = crop_pred['heatmap']
+        for key in crop_pred:
+            if key != 'heatmap':
+                encoded_pred[key][:, row0:row1, col0:col1] = crop_pred[key]
+        encoded_pred['heatmap'].masked_fill_(~covered, torch.finfo(heatmap.dtype).min)
+        return encoded_pred
+
+    @torch.no_grad()
+    def coarse_to_fine(self, lats, calibs, grid, roi=None):
+        """
+            Two-stage inference. VFA and the heatmap head first run on a coarse grid whose cubes are 
+            `coarse_factor` times bigger. Then VFA and all heads are recomputed at full resolution only
+            in the tiles (`coarse_tile` cells) around the coarse cells above `coarse_thresh`, each with 
+            a margin of the receptive radius of the heads. Elsewhere, the heatmap is the upsampled coarse
+            heatmap and the regressions are zero. 
+            [NOTICE] The GroupNorm of tytx_pred and thtwtl_pred normalizes over the refined tile 
+            instead of the whole map, thus the regressions are close to but not identical to `forward`.
+        """
+        factor, tile = self.coarse_factor, self.coarse_tile
+        _, length, width, _ = grid.shape
+        coarse = self.aggregate_cameras(lats, calibs, self.coarse_grid(grid), self.coarse_vfas(factor), roi)
+        coarse_heatmap = self.map_classifier(self.fuse(coarse))
+        heatmap = coarse_heatmap.repeat_interleave(factor, dim=2).repeat_interleave(factor, dim=3)[..., :length, :width]
+
+        # Select the tiles that contain a coarse peak or are within one coarse cell of it
+        peaks = (torch.sigmoid(heatmap) > self.coarse_thresh).float()
+        peaks = F.max_pool2d(peaks, 2 * factor + 1, stride=1, padding=factor)
+        tiles = F.max_pool2d(peaks, tile, ceil_mode=True)[0, 0].nonzero().tolist()
+
+        encoded_pred = self.empty_pred(heatmap.clone())
+        for row, col in tiles:
+            row0, col0 = row * tile, col * tile
+            row1, col1 = min(row0 + tile, length), min(col0 + tile, width)
+            crop_row0, crop_col0 = max(row0 - REFINE_MARGIN, 0), max(col0 - REFINE_MARGIN, 0)
+            crop_row1, crop_col1 = min(row1 + REFINE_MARGIN, length), min(col1 + REFINE_MARGIN, width)
+            ortho = self.aggregate_cameras(lats, calibs, grid[:, crop_row0:crop_row1, crop_col0:crop_col1], roi=roi)
+            crop_pred = self.predict(ortho)
+            rows = slice(row0 - crop_row0, row1 - crop_row0)
+            cols = slice(col0 - crop_col0, col1 - crop_col0)
+            encoded_pred['heatmap'][..., row0:row1, col0:col1] = crop_pred['heatmap'][..., rows, cols]
+            for key in encoded_pred:
+                if key != 'heatmap':
+                    encoded_pred[key][:, row0:row1, col0:col1] = crop_pred[key][:, rows, cols]
+        return encoded_pred
+
     def forward(self, images, calibs, grid, visualize=False, visualize_ortho=False):
+        """
+            The modes of VFA and the heads are exclusive, the first one that is set is taken:
+                1. coverage: `predict_covered`, which runs `coarse_to_fine` in the covered window if 
+                   coarse_factor is also set, at inference only
+                2. coarse_factor: `coarse_to_fine`, at inference only
+                3. batch_cameras: `aggregate_cameras` and the heads, or `predict_peaks` with head_topk at inference
+                4. the loop over the cameras, which also serves `visualize` and `visualize_ortho`
+            The modes 1 and 2 always aggregate the cameras as a batch, even if batch_cameras is False, 
+            and roi_crop applies to the modes 1 to 3. head_topk only applies to the mode 3, thus it is
+            rejected at inference with the other modes instead of falling back to the dense heads.
+        """
         # Normalize Image 
         # image size: (7, 3, iH, iW), calibs: (7, 3, 4), grid: (1, 156, 156, 3)
         images = (images - self.mean.view(3, 1, 1)) / self.std.view(3, 1, 1)
         N, C, iH, iW = images.shape
+        inference = not self.training and not (visualize or visualize_ortho)
+        covered = self.coverage is not None and inference
+        coarse = self.coarse_factor is not None and inference
+        batched = self.batch_cameras and not (visualize or visualize_ortho)
+        if self.head_topk is not None and inference:
+            assert batched and not (covered or coarse), \
+                '`head_topk` needs `batch_cameras` and excludes `coverage` and `coarse_factor`'
+        # Only the region read by VFA goes through the backbone, which needs the cameras to be batched
+        roi = None
+        if self.roi_crop and (covered or coarse or batched):
+            roi = self.image_roi(calibs, grid, (iH, iW))
+            images = crop_images(images, roi)
         # feature :(7, 512, 90, 160)
         feats8, feats16, feats32 = self.base(images)
         
-        ortho = 0
-        for cam in range(N):
+        if covered:
+            return self.predict_covered(self.lateral(feats8, feats16, feats32), calibs, grid, roi)
+
+        if coarse:
+            return self.coarse_to_fine(self.lateral(feats8, feats16, feats32), calibs, grid, roi)
+
+        if batched:
+            ortho = self.aggregate_cameras(self.lateral(feats8, feats16, feats32), calibs, grid, roi=roi)
+            if self.head_topk is not None and not self.training:
+                return self.predict_peaks(ortho)
+        else:
+            # Loop over cameras, which can visualize the features of each camera
+            ortho = 0
+            for cam in range(N):
          
-            calib = calibs[cam]
-            feat8 = feats8[[cam], ...]
-            feat16 = feats16[[cam], ...]
-            feat32 = feats32[[cam], ...]
-
-            lat8 = F.relu(self.bn8(self.lat8(feat8)))
-            lat16 = F.relu(self.bn16(self.lat16(feat16)))
-            lat32 = F.relu(self.bn32(self.lat32(feat32)))
-
-            vfa_feat8 = self.vfa8(lat8, calib, grid, (-1, 0.95), visualize_ortho)
-            vfa_feat16 = self.vfa16(lat16, calib, grid, (-1, 0.95),visualize_ortho)
-            vfa_feat32 = self.vfa32(lat32, calib, grid, (-1, 0.95), visualize_ortho)
-            vfa_feats = vfa_feat8 + vfa_feat16 + vfa_feat32
+                calib = calibs[cam]
+                feat8 = feats8[[cam], ...]
+                feat16 = feats16[[cam], ...]
+                feat32 = feats32[[cam], ...]
+
+                lat8 = F.relu(self.bn8(self.lat8(feat8)))
+                lat16 = F.relu(self.bn16(self.lat16(feat16)))
+                lat32 = F.relu(self.bn32(self.lat32(feat32)))
+
+                if visualize_ortho:
+                    vfa_feat8 = self.vfa8(lat8, calib, grid, (-1, 0.95), visualize_ortho)
+                    vfa_feat16 = self.vfa16(lat16, calib, grid, (-1, 0.95),visualize_ortho)
+                    vfa_feat32 = self.vfa32(lat32, calib, grid, (-1, 0.95), visualize_ortho)
+                    vfa_feats = vfa_feat8 + vfa_feat16 + vfa_feat32
+                else:
+                    # Project the voxels once and sample the three scales from the same geometry
+                    vfa_feats = multi_scale_vfa([self.vfa8, self.vfa16, self.vfa32], 
+                                                [lat8, lat16, lat32], calib, grid, (-1, 0.95))
         
-            # Sum all vfa_feats up
-            ortho += vfa_feats
-
-            if visualize:
-                fig = plt.figure(figsize=(15, 8))
-                gs = gridspec.GridSpec(1, 2)
-                gs00 = gridspec.GridSpecFromSubplotSpec(3, 1, subplot_spec=gs[0])
-                gs01 = gridspec.GridSpecFromSubplotSpec(1, 2, subplot_spec=gs[1])
-
-                fig.add_subplot(gs00[0])
-                viz_feature = torch.norm(feat8, dim=1)
-                viz_feature = (viz_feature).detach().cpu().numpy()[0]
-                plt.title('C%d Feat8 (90, 160)'%(cam+1))
-                plt.axis('off')
-                plt.imshow(viz_feature)
-
-                fig.add_subplot(gs00[1])
-                viz_feature = torch.norm(feat16, dim=1)
-                viz_feature = (viz_feature).detach().cpu().numpy()[0]
-                plt.title('C%d Feat16 (45, 80)'%(cam+1))
-                plt.axis('off')
-                plt.imshow(viz_feature)
-
-                fig.add_subplot(gs00[2])
-                viz_feature = torch.norm(feat32, dim=1)
-                viz_feature = (viz_feature).detach().cpu().numpy()[0]
-                plt.title('C%d Feat32 (23, 40)'%(cam+1))
-                plt.axis('off')
-                plt.imshow(viz_feature)
+                # Sum all vfa_feats up
+                ortho += vfa_feats
+
+                if visualize:
+                    fig = plt.figure(figsize=(15, 8))
+                    gs = gridspec.GridSpec(1, 2)
+                    gs00 = gridspec.GridSpecFromSubplotSpec(3, 1, subplot_spec=gs[0])
+                    gs01 = gridspec.GridSpecFromSubplotSpec(1, 2, subplot_spec=gs[1])
+
+                    fig.add_subplot(gs00[0])
+                    viz_feature = torch.norm(feat8, dim=1)
+                    viz_feature = (viz_feature).detach().cpu().numpy()[0]
+                    plt.title('C%d Feat8 (90, 160)'%(cam+1))
+                    plt.axis('off')
+                    plt.imshow(viz_feature)
+
+                    fig.add_subplot(gs00[1])
+                    viz_feature = torch.norm(feat16, dim=1)
+                    viz_feature = (viz_feature).detach().cpu().numpy()[0]
+                    plt.title('C%d Feat16 (45, 80)'%(cam+1))
+                    plt.axis('off')
+                    plt.imshow(viz_feature)
+
+                    fig.add_subplot(gs00[2])
+                    viz_feature = torch.norm(feat32, dim=1)
+                    viz_feature = (viz_feature).detach().cpu().numpy()[0]
+                    plt.title('C%d Feat32 (23, 40)'%(cam+1))
+                    plt.axis('off')
+                    plt.imshow(viz_feature)
            
-                fig.add_subplot(gs01[0])
-                viz_ortho = torch.norm(vfa_feats, dim=1)
-                viz_ortho = (viz_ortho).detach().cpu().numpy()[0]
-                plt.title('C%d ortho feature'%(cam+1))
-                plt.axis('off')
-                plt.imshow(grid_rot180(viz_ortho))
-                # plt.imshow(viz_ortho)
+                    fig.add_subplot(gs01[0])
+                    viz_ortho = torch.norm(vfa_feats, dim=1)
+                    viz_ortho = (viz_ortho).detach().cpu().numpy()[0]
+                    plt.title('C%d ortho feature'%(cam+1))
+                    plt.axis('off')
+                    plt.imshow(grid_rot180(viz_ortho))
+                    # plt.imshow(viz_ortho)
               
                 
-                fig.add_subplot(gs01[1])
-                viz_fuse_ortho = torch.norm(ortho, dim=1) 
-                viz_fuse_ortho = (viz_fuse_ortho).detach().cpu().numpy()[0]
-                plt.imshow(grid_rot180(viz_fuse_ortho))
-                # plt.imshow(viz_fuse_ortho)
-                plt.title('After fusing C%d ortho feature'%(cam+1))
-                plt.axis('off')
-                plt.show()
+                    fig.add_subplot(gs01[1])
+                    viz_fuse_ortho = torch.norm(ortho, dim=1) 
+                    viz_fuse_ortho = (viz_fuse_ortho).detach().cpu().numpy()[0]
+                    plt.imshow(grid_rot180(viz_fuse_ortho))
+                    # plt.imshow(viz_fuse_ortho)
+                    plt.title('After fusing C%d ortho feature'%(cam+1))
+                    plt.axis('off')
+                    plt.show()
+
+        return self.predict(ortho)
+
+    def predict_peaks(self, ortho):
+        """
+            Run fuse and map_classifier densely and evaluate the other heads only at the `head_topk` peaks 
+            of the heatmap after NMS. orient_pred and the last convolution of tytx_pred and thtwtl_pred
+            are computed at the peaks. The first convolution of tytx_pred and thtwtl_pred stays dense, 
+            since its GroupNorm takes the statistics of the whole map. The heads are (B, K, C) at
+            `peak_index` (B, K), which ObjectEncoder decodes directly.
+        """
+        topdown = ortho
+        fuse_feature = self.fuse(topdown)
+        heatmap = self.map_classifier(fuse_feature)
+        # NMS as ObjectEncoder.nms
+        scores = torch.sigmoid(heatmap)
+        scores = scores * torch.eq(F.max_pool2d(scores, kernel_size=5, stride=1, padding=2), scores)
+        _, peak_index = torch.topk(scores.flatten(1), k=min(self.head_topk, scores[0, 0].numel()), dim=1)
+
+        encoded_pred = {'heatmap' : heatmap,
+                        'peak_index' : peak_index,
+                        'loc_offset' : conv2d_at(self.tytx_pred[:-1](topdown), self.tytx_pred[-1], peak_index)}
+        if self.mode == '3D':
+            encoded_pred['dim_offset'] = conv2d_at(self.thtwtl_pred[:-1](topdown), self.thtwtl_pred[-1], peak_index)
+            encoded_pred['rotation'] = conv2d_at(fuse_feature, self.orient_pred[0], peak_index)
+        return encoded_pred
 
+    def predict(self, ortho):
         # Apply topdown network to fuse features from different perspectives
         # topdown = self.topdown(ortho) Discarded, topdown layer make model hard to train
         topdown = ortho
@@ -174,9 +499,9 @@ if __name__ == '__main__':
     # model.load_state_dict(state_dict['model_state_dict'])
 
     dataloader = DataLoader(dataset, batch_size=1, num_workers=0, collate_fn=collate)
-    index, images, objects, heatmaps, calibs, grid = next(iter(dataloader))
+    index, images, objects, heatmaps, calibs, grid, _ = next(iter(dataloader))
 
-    encoded_gt = encoder.batch_encode(objects, heatmaps, grid)[0]
+    encoded_gt = encoder.batch_encode(objects, heatmaps, grid)
     gt_heatmap = (encoded_gt['heatmap'][0, 0].detach().cpu().numpy() * 255).astype(np.uint8)
 
     encoded_pred = model(images, calibs, grid, visualize=True, visualize_ortho=False)
@@ -12,6 +12,15 @@ class Trainer(object):
         self.summary = summary
         self.loss_weight = loss_weight
         self.mode = args.mode
+        self.angle_mode = getattr(args, 'angle_mode', 'csl')
+
+    def encode(self, encoder, objects, heatmaps, grid, targets):
+        # The targets are encoded by the DataLoader workers if the dataset has the encoder, see `frameDataset.set_encoder`
+        if targets is None:
+            # the heatmaps of None are rendered by the encoder
+            heatmaps = None if heatmaps is None else heatmaps.to(self.device)
+            return encoder.batch_encode(objects, heatmaps, grid)
+        return {key: value.to(self.device) for key, value in targets.items()}
 
     def train(self, dataloader, encoder, optimizer, epoch, args):
         self.model.train()
@@ -19,8 +28,8 @@ class Trainer(object):
         t_b = time.time()
         t_forward, t_backward = 0, 0
         with tqdm(total=len(dataloader), desc=f'\033[33m[TRAIN]\033[0m Epoch {epoch} / {args.epochs}', postfix=dict, mininterval=0.2) as pbar:
-            for idx, (_, images, objects, heatmaps, calibs, grid) in enumerate(dataloader):
-                images, calibs, heatmaps, grid = images.to(self.device), calibs.to(self.device), heatmaps.to(self.device), grid.to(self.device)
+            for idx, (_, images, objects, heatmaps, calibs, grid, targets) in enumerate(dataloader):
+                images, calibs, grid = images.to(self.device), calibs.to(self.device), grid.to(self.device)
                 
                
                 encoded_pred = self.model(images, calibs, grid)
@@ -28,10 +37,10 @@ class Trainer(object):
                 t_f = time.time()
                 t_forward += t_f - t_b
 
-                encoded_gt = encoder.batch_encode(objects, heatmaps, grid)[0]
+                encoded_gt = self.encode(encoder, objects, heatmaps, grid, targets)
 
                 if self.mode == '3D':
-                    loss, loss_dict = compute_loss3d(encoded_pred, encoded_gt, self.loss_weight)
+                    loss, loss_dict = compute_loss3d(encoded_pred, encoded_gt, self.loss_weight, self.angle_mode)
                 elif self.mode == '2D':
                     loss, loss_dict = compute_loss2d(encoded_pred, encoded_gt, self.loss_weight)
                 
@@ -71,12 +80,12 @@ class Trainer(object):
                         # Decode prediction
                         preds = encoder.batch_decode(encoded_pred, args.cls_thresh)
                         self.summary.add_figure('train/bboxes',
-                                    visualize_bboxes(images[0], calibs[0], objects[0], preds), steps)
+                                    visualize_bboxes(images[0], calibs[0], objects.get_frame(0), preds.get_frame(0)), steps)
                     elif self.mode == '2D':
                         # Decode prediction
                         preds = encoder.batch_decode(encoded_pred, args.cls_thresh)
                         self.summary.add_figure('train/bboxes',
-                                    visualize_bottom(images[0], calibs[0], objects[0], preds, args), steps)
+                                    visualize_bottom(images[0], calibs[0], objects.get_frame(0), preds.get_frame(0), args), steps)
                                     
                     # Visualize image
                     self.summary.add_image('train/image', visualize_image(images[0]), steps)
@@ -93,19 +102,19 @@ class Trainer(object):
         t_b = time.time()
         t_forward, t_backward = 0, 0
         with tqdm(total=len(dataloader), desc=f'\033[31m[VAL]\033[0m Epoch {epoch} / {args.epochs}', postfix=dict, mininterval=3) as pbar:
-            for idx, (_, images, objects, heatmaps, calibs, grid) in enumerate(dataloader):
+            for idx, (_, images, objects, heatmaps, calibs, grid, targets) in enumerate(dataloader):
                 with torch.no_grad():
-                    images, calibs, heatmaps, grid = images.to(self.device), calibs.to(self.device), heatmaps.to(self.device), grid.to(self.device)
+                    images, calibs, grid = images.to(self.device), calibs.to(self.device), grid.to(self.device)
                 
                     encoded_pred = self.model(images, calibs, grid)
                     
                     t_f = time.time()
                     t_forward += t_f - t_b
 
-                    encoded_gt = encoder.batch_encode(objects, heatmaps, grid)[0]
+                    encoded_gt = self.encode(encoder, objects, heatmaps, grid, targets)
 
                     if self.mode == '3D':
-                        _, loss_dict = compute_loss3d(encoded_pred, encoded_gt, self.loss_weight)
+                        _, loss_dict = compute_loss3d(encoded_pred, encoded_gt, self.loss_weight, self.angle_mode)
                     elif self.mode == '2D':
                         _, loss_dict = compute_loss2d(encoded_pred, encoded_gt, self.loss_weight)
                     epoch_loss += loss_dict
@@ -13,6 +13,128 @@ Obj3D = namedtuple('Obj3D',
 Obj2D = namedtuple('Obj2D', 
         ['classname', 'location', 'conf'])
 
+class ObjectBatch(object):
+    """
+        The objects of a batch of frames as columns, instead of a list of Obj3D or Obj2D per frame
+            frame (n, ): the frame of every object in the batch, in ascending order
+            classname (n, ): numpy array of str
+            location (n, 3), and for 3D detection dimension (n, 3) of h, w, l and rotation (n, ) in radian
+            conf (n, ): the confidence of the predictions, None for the labels
+            num_frames: the number of frames of the batch, including the frames without objects
+        [NOTICE]: iterating a batch or indexing it by an int gives the Obj3D or Obj2D of single objects, thus
+                  the code reading the fields of single objects still works, but it is slow for large batches
+    """
+    def __init__(self, frame, classname, location, dimension=None, rotation=None, conf=None, num_frames=None):
+        self.frame = torch.as_tensor(frame, dtype=torch.long)
+        self.classname = np.asarray(classname, dtype=np.str_).reshape(-1)
+        self.location, self.dimension, self.rotation, self.conf = location, dimension, rotation, conf
+        if num_frames is None:
+            num_frames = int(self.frame.max()) + 1 if len(self.frame) else 0
+        self.num_frames = num_frames
+
+    @property
+    def three_d(self):
+        return self.dimension is not None
+
+    @staticmethod
+    def from_objects(objects, three_d=None):
+        """
+            The batch of one frame of a list of Obj3D or Obj2D, three_d=None: infer from the first object
+        """
+        three_d = (len(objects) > 0 and isinstance(objects[0], Obj3D)) if three_d is None else three_d
+        def column(values, *shape):
+            return torch.as_tensor(np.asarray(values, dtype=np.float64).reshape(*shape))
+        batch = ObjectBatch(torch.zeros(len(objects), dtype=torch.long), [obj.classname for obj in objects],
+                            column([obj.location for obj in objects], -1, 3), num_frames=1)
+        if three_d:
+            batch.dimension = column([obj.dimension for obj in objects], -1, 3)
+            batch.rotation = column([obj.rotation for obj in objects], -1)
+        if len(objects) > 0 and objects[0].conf is not None:
+            batch.conf = column([obj.conf for obj in objects], -1)
+        return batch
+
+    @staticmethod
+    def cat(batches):
+        """
+            Concatenate the batches one after another, the frames of every batch follow the frames of the
+            previous ones. The lists of Obj3D or Obj2D in `batches` are batches of one frame.
+        """
+        batches = [batch if isinstance(batch, ObjectBatch) else ObjectBatch.from_objects(batch) for batch in batches]
+        offsets = np.cumsum([0] + [batch.num_frames for batch in batches])
+        frame = torch.cat([batch.frame + int(offset) for batch, offset in zip(batches, offsets)] + [torch.zeros(0, dtype=torch.long)])
+        classname = np.concatenate([batch.classname for batch in batches]) if batches else []
+        def column(name, *shape):
+            values = [getattr(batch, name) for batch in batches]
+            if all(value is None for value in values):
+                return None
+            # the empty frames of a list without any object have no dimension, rotation or conf
+            like = next(value for value in values if value is not None)
+            return torch.cat([like.new_zeros(0, *shape) if value is None else value.to(like.device) for value in values])
+        location = column('location', 3) if batches else torch.zeros(0, 3, dtype=torch.float64)
+        return ObjectBatch(frame, classname, location, column('dimension', 3), column('rotation'), column('conf'),
+                           num_frames=int(offsets[-1]))
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __getitem__(self, key):
+        """
+            key: an int gives the Obj3D or Obj2D of the object, a slice, an index or a bool mask gives a batch
+        """
+        if isinstance(key, (int, np.integer)):
+            conf = None if self.conf is None else self.conf[key]
+            if self.three_d:
+                return Obj3D(classname=str(self.classname[key]), dimension=self.dimension[key],
+                             location=self.location[key], rotation=self.rotation[key], conf=conf)
+            return Obj2D(classname=str(self.classname[key]), location=self.location[key], conf=conf)
+        names = key.cpu().numpy() if isinstance(key, torch.Tensor) else key
+        def column(value):
+            return None if value is None else value[key.to(value.device) if isinstance(key, torch.Tensor) else key]
+        return ObjectBatch(column(self.frame), self.classname[names], column(self.location), column(self.dimension),
+                           column(self.rotation), column(self.conf), num_frames=self.num_frames)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def select(self, classnames):
+        # the objects of the classes in `classnames`
+        return self[torch.from_numpy(np.isin(self.classname, classnames))]
+
+    def get_frame(self, index):
+        # the objects of the `index`-th frame as a batch of one frame
+        batch = self[self.frame == index]
+        batch.frame, batch.num_frames = torch.zeros_like(batch.frame), 1
+        return batch
+
+    def frames(self):
+        """
+            Split into the batches of single frames, see `get_frame`
+        """
+        counts = torch.bincount(self.frame, minlength=self.num_frames).tolist()
+        batches, start = list(), 0
+        for count in counts:
+            batch = self[start:start + count]
+            batch.frame, batch.num_frames = torch.zeros_like(batch.frame), 1
+            batches.append(batch)
+            start += count
+        return batches
+
+    def to(self, device):
+        def column(value):
+            return None if value is None else value.to(device)
+        return ObjectBatch(column(self.frame), self.classname, column(self.location), column(self.dimension),
+                           column(self.rotation), column(self.conf), num_frames=self.num_frames)
+
+    def __getstate__(self):
+        # pickled as numpy arrays, e.g. the config hash of TargetStore and the batches of the DataLoader workers
+        return {name: to_numpy(value) if isinstance(value, torch.Tensor) else value
+                for name, value in self.__dict__.items()}
+
+    def __setstate__(self, state):
+        self.__dict__.update({name: torch.from_numpy(value) if isinstance(value, np.ndarray) and name != 'classname'
+                              else value for name, value in state.items()})
+
 def make_grid(world_size=(3900, 3900), grid_offset=(0, 0, 0), cube_LW=[25, 25], dataset='Wildtrack'):
     """
         *********
@@ -37,15 +159,31 @@ def make_grid(world_size=(3900, 3900), grid_offset=(0, 0, 0), cube_LW=[25, 25],
     return torch.stack([xx, yy, torch.full_like(xx, zoff)], dim=-1)
 
 def collate(batch):
-    index, images, objects, heatmaps, calibs, grid = zip(*batch)
+    index, images, objects, heatmaps, calibs, grid, targets = zip(*batch)
 
     index = torch.LongTensor(index)
     images = torch.stack([image for img_batch in images for image in img_batch])
     calibs = torch.stack([torch.Tensor(calib) for batch_calib in calibs for calib in batch_calib])
     grid = torch.stack(grid)
-    heatmaps = torch.stack(heatmaps)
+    # the objects of all frames as one batch, see `ObjectBatch`
+    objects = ObjectBatch.cat(objects)
+    # None: the heatmaps are rendered by ObjectEncoder.batch_encode
+    heatmaps = None if heatmaps[0] is None else torch.stack(heatmaps)
+    targets = collate_targets(targets)
+
+    return index, images, objects, heatmaps, calibs, grid, targets
 
-    return index, images, objects, heatmaps, calibs, grid
+def collate_targets(targets):
+    """
+        Merge the targets of ObjectEncoder of single frames into the targets of the batch
+    """
+    if targets[0] is None:
+        return None
+    batch = {key: torch.cat([target[key] for target in targets]) for key in targets[0]}
+    if 'index' in batch:
+        # the frame of the sparse targets in the batch
+        batch['index'][:, 0] = torch.cat([torch.full_like(target['index'][:, 0], i) for i, target in enumerate(targets)])
+    return batch
 
 def project(vectors, calib):
     """
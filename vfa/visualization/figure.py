@@ -74,8 +74,10 @@ def _format_bboxes(image, calib, objects, cmap=None, ax=None):
     if cmap is None:
         cmap = cm.get_cmap('tab20', len(objects))  
 
-    for i, obj in enumerate(objects):
-        ax = draw_3DBBox(ax, to_numpy(obj.dimension), to_numpy(obj.rotation), to_numpy(obj.location), to_numpy(calib), cmap(i), 2)
+    # objects: ObjectBatch
+    dimension, rotation, location = to_numpy(objects.dimension), to_numpy(objects.rotation), to_numpy(objects.location)
+    for i in range(len(objects)):
+        ax = draw_3DBBox(ax, dimension[i], rotation[i], location[i], to_numpy(calib), cmap(i), 2)
 
     ax.axis(extents)
     ax.axis(False)
@@ -112,29 +114,24 @@ def _format_bottom(image, calib, objects, args, ax=None, height=None):
     ax.axis(False)
     ax.grid(False)
 
-    # Construct homography coord of bottom
-    bottom = list()
+    # Construct homography coord of bottom, of all objects (ObjectBatch) at once
+    location = to_numpy(objects.location).reshape(-1, 3).astype(np.float32)
+    bottom = np.zeros((len(location), 3), dtype=np.float32)
     head = list()
-    for obj in objects:
-        worldcoord = np.zeros((3), dtype=np.float32)
-        if args.data == MultiviewX.__name__:
-            worldcoord[:2] = MultiviewX.get_worldcoord_from_worldgrid(to_numpy(obj.location[:2]))
-        elif args.data == Wildtrack.__name__:
-            worldcoord[:2] = Wildtrack.get_worldcoord_from_worldgrid(to_numpy(obj.location[:2]))
-            if height is not None:
-                obj.location[2] = height
-                headcoord = Wildtrack.get_worldcoord_from_worldgrid(to_numpy(obj.location))
-        else:
-            raise ValueError('Unknow dataset. Expect {} and {}, but got{}.'\
-                            .format(MultiviewX.__name__, 
-                                    Wildtrack.__name__,
-                                    args.data
-                                    ))
-        bottom.append(worldcoord)
+    if args.data == MultiviewX.__name__:
+        bottom[:, :2] = MultiviewX.get_worldcoord_from_worldgrid(location[:, :2].T).T
+    elif args.data == Wildtrack.__name__:
+        bottom[:, :2] = Wildtrack.get_worldcoord_from_worldgrid(location[:, :2].T).T
         if height is not None:
-            head.append(headcoord)
+            location[:, 2] = height
+            head = Wildtrack.get_worldcoord_from_worldgrid(location.T).T
+    else:
+        raise ValueError('Unknow dataset. Expect {} and {}, but got{}.'\
+                        .format(MultiviewX.__name__, 
+                                Wildtrack.__name__,
+                                args.data
+                                ))
 
-    bottom = np.array(bottom).reshape(-1, 3)
     bottom3d = np.concatenate([bottom, np.ones((bottom.shape[0], 1))], axis=1)
     bottom2d = project(bottom3d, to_numpy(calib))
     # Visualize bottom center 